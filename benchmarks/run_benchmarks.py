@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Offline benchmarks of the classification pipeline.
+
+tensorflow-serving is replaced by pdf_trio.fake_tf_serving with a configurable latency; the
+fastText models and BERT vocab are the real ones, from FT_MODEL, FT_URL_MODEL and
+TF_BERT_VOCAB_PATH. A synthetic corpus (text, scanned, huge, tiny PDFs) is generated first.
+Latency percentiles and throughput are measured for every mode through
+PdfClassifier.classify_pdf_multi and through the Flask app, plus micro-benchmarks of the
+extraction and text preparation steps. Results are written as JSON and compared to a baseline:
+
+    python -m benchmarks.run_benchmarks --output bench.json --baseline benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --save-baseline benchmarks/baseline.json
+
+The exit status is 1 when a benchmark regressed by more than --tolerance.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import concurrent.futures
+
+import numpy as np
+
+from benchmarks import synthetic_pdfs
+
+log = logging.getLogger(__name__)
+
+MODES = ("auto", "linear", "bert", "image", "all")
+
+SAMPLE_URLS = [
+    "https://arxiv.org/pdf/1607.01759.pdf",
+    "https://web.archive.org/web/20180511040716/https://ekja.org/upload/pdf/kjae-57-444.pdf",
+    "https://example.com/maps/foo.pdf",
+    "http://www.city.example.gov/council/minutes/2019-03.pdf",
+]
+
+
+def summarize(latencies, wall_seconds):
+    """
+    :param latencies: seconds per call
+    :param wall_seconds: elapsed time for all the calls
+    :return: map of n, mean/p50/p95/p99 in msec and throughput per sec
+    """
+    ms = np.asarray(latencies) * 1000.0
+    return {
+        "n": len(latencies),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "throughput_per_sec": len(latencies) / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+
+
+def bench(fn, args_list, repeat=1, concurrency=1):
+    """
+    Call fn once per item of args_list, repeat times over, from concurrency threads.
+    :return: summarize results
+    """
+    work = [args for _ in range(repeat) for args in args_list]
+
+    def timed(args):
+        t0 = time.perf_counter()
+        fn(*args)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    if concurrency > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(timed, work))
+    else:
+        latencies = [timed(args) for args in work]
+    return summarize(latencies, time.perf_counter() - t0)
+
+
+def run_all(corpus, repeat=3, concurrency=4, modes=MODES, flask=True):
+    """
+    :param corpus: map of kind to PDF paths, see synthetic_pdfs.make_corpus
+    :return: map of benchmark name to summarize results
+    """
+    from werkzeug.datastructures import FileStorage
+    from pdf_trio import pdf_util, text_prep, extract_pool
+    from pdf_trio.pdf_classifier import PdfClassifier
+    from pdf_trio.url_classifier import UrlClassifier
+
+    results = {}
+    contents = {kind: [open(p, 'rb').read() for p in paths] for kind, paths in corpus.items()}
+
+    # micro-benchmarks
+    text_path = corpus["text"][0]
+    text = pdf_util.extract_pdf_text(text_path)
+    tokens = text_prep.extract_tokens(text)
+    classifier = PdfClassifier()
+    url_classifier = UrlClassifier()
+    results["micro/extract_pdf_text"] = bench(pdf_util.extract_pdf_text, [(p,) for p in corpus["text"]], repeat)
+    results["micro/extract_pdf_text_from_content"] = bench(
+        pdf_util.extract_pdf_text_from_content, [(c,) for c in contents["text"]], repeat)
+
+    def extract_image(path):
+        jpg = pdf_util.extract_pdf_image(path)
+        if jpg:
+            pdf_util.remove_tmp_file(jpg)
+
+    results["micro/extract_pdf_image"] = bench(extract_image, [(p,) for p in corpus["scanned"]], repeat)
+    results["micro/extract_pdf_image_from_content"] = bench(
+        pdf_util.extract_pdf_image_from_content, [(c,) for c in contents["scanned"]], repeat)
+    # concurrent extractions from this process, which holds the models, and through extraction workers
+    pool = extract_pool.ExtractPool(workers=concurrency)
+    for name, kind in (("extract_pdf_text_from_content", "text"), ("extract_pdf_image_from_content", "scanned")):
+        args = [(c,) for c in contents[kind]]
+        results["micro/extract_pool/direct/" + name] = bench(getattr(pdf_util, name), args, repeat, concurrency)
+        pdf_util.use_extract_pool(pool)
+        try:
+            # not timed, the workers start and import pdf_util on first use
+            bench(getattr(pdf_util, name), args * concurrency, 1, concurrency)
+            results["micro/extract_pool/pooled/" + name] = bench(getattr(pdf_util, name), args, repeat, concurrency)
+        finally:
+            pdf_util.use_extract_pool(None)
+    pool.close()
+    results["micro/extract_tokens"] = bench(text_prep.extract_tokens, [(text,)], repeat * 10)
+    bert_tokens = text_prep.trim_tokens(tokens, 512)
+    results["micro/convert_to_bert_vocab"] = bench(
+        text_prep.convert_to_bert_vocab, [(text_prep.load_bert_vocab(os.environ['TF_BERT_VOCAB_PATH']), bert_tokens)],
+        repeat * 10)
+    results["micro/vocab_index_lookup"] = bench(classifier.bert_vocab.lookup_ids, [(bert_tokens,)], repeat * 10)
+    results["micro/bert_features"] = bench(classifier.bert_features, [(bert_tokens,)], repeat * 10)
+    results["micro/classify_url"] = bench(url_classifier.classify_url, [(u,) for u in SAMPLE_URLS], repeat * 10)
+    results["micro/classify_urls"] = bench(url_classifier.classify_urls, [(SAMPLE_URLS * 250,)], repeat)
+
+    # whole pipeline, in process
+    def classify(mode, content, name):
+        fs = FileStorage(stream=io.BytesIO(content), filename=name)
+        classifier.classify_pdf_multi(mode, fs)
+
+    for mode in modes:
+        for kind, paths in corpus.items():
+            args = [(mode, c, os.path.basename(p)) for p, c in zip(paths, contents[kind])]
+            results["classifier/%s/%s" % (mode, kind)] = bench(classify, args, repeat, concurrency)
+
+    # through the Flask app
+    if flask:
+        from pdf_trio import create_app
+        client = create_app().test_client()
+
+        def post(mode, content, name):
+            resp = client.post("/classify/research-pub/" + mode,
+                               data={"pdf_content": (io.BytesIO(content), name, "application/pdf")})
+            if resp.status_code != 200:
+                raise RuntimeError("HTTP %d for %s" % (resp.status_code, name))
+
+        for mode in modes:
+            for kind, paths in corpus.items():
+                args = [(mode, c, os.path.basename(p)) for p, c in zip(paths, contents[kind])]
+                results["flask/%s/%s" % (mode, kind)] = bench(post, args, repeat, concurrency)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of text lines describing regressions, p50 latency up or throughput down by more than tolerance
+    """
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        cur = results.get(name)
+        if cur is None:
+            continue
+        if cur["p50_ms"] > base["p50_ms"] * (1.0 + tolerance):
+            regressions.append("%s p50 %.2f ms, baseline %.2f ms" % (name, cur["p50_ms"], base["p50_ms"]))
+        if cur["throughput_per_sec"] < base["throughput_per_sec"] / (1.0 + tolerance):
+            regressions.append("%s throughput %.2f/s, baseline %.2f/s" %
+                               (name, cur["throughput_per_sec"], base["throughput_per_sec"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks of the classification pipeline")
+    parser.add_argument("--corpus", type=str, default="/tmp/pdf_trio_bench_corpus",
+                        help="dir. for the generated PDFs, reused when present")
+    parser.add_argument("--output", type=str, default="bench_results.json", help="JSON results file")
+    parser.add_argument("--baseline", type=str, default=os.path.join(os.path.dirname(__file__), "baseline.json"),
+                        help="JSON results of a reference run to compare with")
+    parser.add_argument("--save-baseline", type=str, default="", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown, 0.2 by default")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake tensorflow-serving latency per request")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the corpus per benchmark")
+    parser.add_argument("--concurrency", type=int, default=4, help="threads calling the pipeline")
+    parser.add_argument("--modes", type=str, default=",".join(MODES), help="comma sep list of modes to run")
+    parser.add_argument("--no-flask", action="store_true", help="skip the benchmarks through the Flask app")
+    parser.add_argument("--quick", action="store_true", help="small corpus and one pass, for smoke testing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    from pdf_trio.fake_tf_serving import FakeTfServing
+    fake = FakeTfServing(latency_ms=args.latency_ms)
+    base_url = fake.start_rest()
+    os.environ["TF_BERT_SERVER_URL"] = base_url
+    os.environ["TF_IMAGE_SERVER_URL"] = base_url
+    # every pass must do the work again
+    os.environ["RESULT_CACHE_SIZE"] = "0"
+    os.environ.pop("RESULT_CACHE_DB", None)
+    os.environ["SINGLE_FLIGHT"] = "0"
+    os.environ.pop("FEATURE_STORE_DIR", None)
+    os.environ.pop("NEAR_DUP_INDEX_SIZE", None)
+
+    corpus = synthetic_pdfs.make_corpus(args.corpus + ("_quick" if args.quick else ""), quick=args.quick)
+    try:
+        results = run_all(corpus, repeat=1 if args.quick else args.repeat, concurrency=args.concurrency,
+                          modes=args.modes.split(","), flask=not args.no_flask)
+    finally:
+        fake.stop()
+    report = {
+        "meta": {
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "fake_latency_ms": args.latency_ms,
+            "concurrency": args.concurrency,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for name, r in sorted(results.items()):
+        print("%-45s p50 %9.2f ms  p95 %9.2f ms  p99 %9.2f ms  %8.2f/s" %
+              (name, r["p50_ms"], r["p95_ms"], r["p99_ms"], r["throughput_per_sec"]))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("baseline written to %s" % args.save_baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline at %s, record one with --save-baseline on the reference machine" % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print("REGRESSION " + line)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Deterministic synthetic PDFs for benchmarks, written directly without any PDF library:
+text pages use the standard Helvetica font, scanned pages are a single grayscale image
+of text-like blocks with no extractable text.
+"""
+
+import os
+import zlib
+import random
+
+import numpy as np
+
+WORDS = ("the of and to in is we model results data analysis method using study paper this "
+         "that for with are on by from network learning performance proposed based approach "
+         "system figure table section experiments training evaluation dataset algorithm show "
+         "our which can these between each time value error function information research").split()
+
+
+def _pdf(page_objects):
+    """
+    :param page_objects: list of (content stream bytes, resources dict string, extra objects) per page,
+        where extra objects is a list of bytes referenced from the resources as "%d 0 R" placeholders {0}, {1}...
+    :return: PDF bytes
+    """
+    objs = [None, None]  # catalog, pages
+    kids = []
+    font_ref = len(objs) + 1
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for content, resources, extra in page_objects:
+        extra_refs = []
+        for obj in extra:
+            objs.append(obj)
+            extra_refs.append(len(objs))
+        objs.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_ref = len(objs)
+        res = resources.format(*extra_refs, font=font_ref).encode('ascii')
+        objs.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources %s /Contents %d 0 R >>"
+                    % (res, content_ref))
+        kids.append(len(objs))
+    objs[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objs[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for j, obj in enumerate(objs):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % (j + 1) + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return bytes(out)
+
+
+def text_pdf(pages, seed=0, lines_per_page=55):
+    """
+    :return: PDF bytes with pages of random words
+    """
+    rng = random.Random(seed)
+    page_objects = []
+    for _ in range(pages):
+        lines = []
+        for _ in range(lines_per_page):
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 14)))
+            lines.append(b"(" + words.encode('ascii') + b") '")
+        content = b"BT /F1 10 Tf 12 TL 60 750 Td\n" + b"\n".join(lines) + b"\nET"
+        page_objects.append((content, "<< /Font << /F1 {font} 0 R >> >>", []))
+    return _pdf(page_objects)
+
+
+def image_pdf(pages, seed=0):
+    """
+    :return: PDF bytes with pages that look scanned: one grayscale image each, no text
+    """
+    rng = np.random.RandomState(seed)
+    page_objects = []
+    for _ in range(pages):
+        w, h = 306, 396
+        img = np.full((h, w), 245, np.uint8)
+        for y in range(40, 370, 9):
+            x = 30
+            while x < 275:
+                wl = rng.randint(8, 30)
+                img[y:y + 5, x:x + wl] = rng.randint(20, 80)
+                x += wl + rng.randint(3, 6)
+        data = zlib.compress(img.tobytes(), 6)
+        image = (b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+                 b"/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>\nstream\n" % (w, h, len(data)) +
+                 data + b"\nendstream")
+        page_objects.append((b"q 612 0 0 792 0 0 cm /Im0 Do Q", "<< /XObject << /Im0 {0} 0 R >> >>", [image]))
+    return _pdf(page_objects)
+
+
+def tiny_pdf(seed=0):
+    """
+    :return: PDF bytes with one page holding a few words, too little text for the text classifiers
+    """
+    rng = random.Random(seed)
+    words = " ".join(rng.choice(WORDS) for _ in range(6))
+    content = b"BT /F1 10 Tf 60 750 Td (" + words.encode('ascii') + b") Tj ET"
+    return _pdf([(content, "<< /Font << /F1 {font} 0 R >> >>", [])])
+
+
+def make_corpus(out_dir, quick=False):
+    """
+    Write the benchmark corpus.
+    :param quick: fewer and smaller PDFs, for smoke tests
+    :return: map of kind (text, scanned, huge, tiny) to list of PDF paths
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    count = 1 if quick else 4
+    specs = {
+        "text": [("text_%d.pdf" % j, lambda j=j: text_pdf(2 if quick else 8, seed=j)) for j in range(count)],
+        "scanned": [("scanned_%d.pdf" % j, lambda j=j: image_pdf(1, seed=j)) for j in range(count)],
+        "huge": [("huge_0.pdf", lambda: text_pdf(30 if quick else 400, seed=100))],
+        "tiny": [("tiny_%d.pdf" % j, lambda j=j: tiny_pdf(seed=j)) for j in range(count)],
+    }
+    corpus = {}
+    for kind, files in specs.items():
+        corpus[kind] = []
+        for name, make in files:
+            path = os.path.join(out_dir, name)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(make())
+            corpus[kind].append(path)
+    return corpus
@@ -19,7 +19,7 @@ import sys
 import html
 import raven
 from raven.contrib.flask import Sentry
-from flask import Flask
+from flask import Flask, Response
 
 
 def create_app(test_config=None):
@@ -47,6 +47,15 @@ def create_app(test_config=None):
     def toplevel():
         return "okay!"
 
+    @app.route('/metrics', methods = ['GET'])
+    def metrics_view():
+        """
+        Prometheus metrics, like the time spent per classification stage.
+        """
+        from pdf_trio import metrics
+        data, content_type = metrics.generate()
+        return Response(data, content_type=content_type)
+
     @app.route('/api/list', methods = ['GET'])
     def list_api():
         """
@@ -0,0 +1,307 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Bounds on the work in progress, so that a burst of requests is shed early instead of making
+every request slow:
+
+- RequestQueue admits at most API_MAX_ACTIVE classification requests at a time, lets up to
+  API_MAX_QUEUED more wait for a turn, and rejects the others (HTTP 429 with Retry-After).
+- StageLimits caps the concurrent runs of a stage, like page rasterizations or requests to
+  tensorflow-serving in flight, see MAX_CONCURRENT_<STAGE>.
+- A Deadline (REQUEST_DEADLINE, or shorter by the X-Request-Timeout header) goes with the
+  PDFs of a request: subprocess and tensorflow-serving timeouts are cut to the time left, and
+  once it has passed the request fails (HTTP 504) instead of doing work nobody waits for.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+import collections
+
+from pdf_trio import metrics
+
+log = logging.getLogger(__name__)
+
+# the stages that can be limited, named as in metrics.stage
+LIMITED_STAGES = ("extract_text", "extract_image", "bert_request", "image_request")
+
+
+class Overloaded(Exception):
+    """
+    The request was not admitted; retry_after is the suggested wait in seconds.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, retry_after)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.args[0]
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+
+    def __init__(self, seconds=None):
+        """
+        :param seconds: time allowed from now, None for no deadline
+        """
+        # time.monotonic is system wide on linux, so a deadline can be passed to worker processes
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def __repr__(self):
+        remaining = self.remaining()
+        return "Deadline(%s)" % ("none" if remaining is None else "%.3f sec left" % remaining)
+
+    def remaining(self):
+        """
+        :return: seconds left, 0 when passed, None for no deadline
+        """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def check(self, what):
+        """
+        :param what: the work that would be started, for the error message
+        :raise DeadlineExceeded: when the deadline has passed
+        """
+        if self.expired():
+            metrics.DEADLINES_EXCEEDED.labels(stage=what).inc()
+            raise DeadlineExceeded("deadline passed before %s" % what)
+
+    def timeout(self, limit=None, what="request"):
+        """
+        :param limit: the usual timeout in seconds, None for none
+        :param what: the work the timeout is for, for the error message
+        :return: limit, or the time left if that is shorter; None if neither is set
+        :raise DeadlineExceeded: when the deadline has passed
+        """
+        self.check(what)
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        return remaining if limit is None else min(limit, remaining)
+
+
+# for callers without a deadline
+NO_DEADLINE = Deadline()
+
+
+def latest(deadlines):
+    """
+    :param deadlines: list of Deadline, like those of the examples of one tensorflow-serving batch
+    :return: the Deadline that passes last, NO_DEADLINE if any has none
+    """
+    if not deadlines or any(d.expires is None for d in deadlines):
+        return NO_DEADLINE
+    return max(deadlines, key=lambda d: d.expires)
+
+
+class RequestQueue:
+    """
+    At most max_active requests run at a time, up to max_queued more wait for their turn (in
+    arrival order, as far as the thread scheduler goes) for queue_timeout seconds at most, and
+    the others are rejected with Overloaded.
+    """
+
+    def __init__(self, max_active, max_queued=0, queue_timeout=10.0, retry_after=5):
+        """
+        :param max_active: requests run at a time, 0 for no limit
+        :param max_queued: requests that wait for a turn
+        :param queue_timeout: max seconds a request waits
+        :param retry_after: seconds a rejected client is told to wait before trying again
+        """
+        self.max_active = max(0, int(max_active))
+        self.max_queued = max(0, int(max_queued))
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.cond = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.counts = collections.Counter()
+
+    @contextlib.contextmanager
+    def admit(self, deadline=NO_DEADLINE):
+        """
+        Run the request in the with block once it has its turn.
+        :param deadline: Deadline of the request, which also bounds the wait
+        :raise Overloaded: when the queue is full or the turn did not come in time
+        """
+        with self.cond:
+            if self.max_active and self.active >= self.max_active:
+                if self.queued >= self.max_queued:
+                    self._reject("queue_full")
+                self.queued += 1
+                try:
+                    ends = time.monotonic() + deadline.timeout(self.queue_timeout, "admission")
+                    while self.active >= self.max_active:
+                        remaining = ends - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("queue_timeout")
+                        self.cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+                self.counts["queued"] += 1
+            self.active += 1
+            self.counts["admitted"] += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify()
+
+    @contextlib.contextmanager
+    def admit_nowait(self):
+        """
+        Like admit, for asyncio callers, which must not block: up to max_active plus max_queued
+        requests are admitted at once, and the stage limits queue their work.
+        :raise Overloaded: when as many requests are in progress
+        """
+        with self.cond:
+            if self.max_active and self.active >= self.max_active + self.max_queued:
+                self._reject("queue_full")
+            self.active += 1
+            self.counts["admitted"] += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+
+    def _reject(self, reason):
+        # caller holds self.cond
+        self.counts[reason] += 1
+        metrics.REQUESTS_REJECTED.labels(reason=reason).inc()
+        raise Overloaded("too many requests in progress (%s)" % reason.replace("_", " "), self.retry_after)
+
+    def stats(self):
+        with self.cond:
+            stats_map = dict(self.counts)
+            stats_map.update({"active": self.active, "waiting": self.queued,
+                              "max_active": self.max_active, "max_queued": self.max_queued})
+            return stats_map
+
+
+class StageLimits:
+    """
+    Semaphores capping the concurrent runs of each stage of LIMITED_STAGES that has a limit.
+    A caller waits for a slot no longer than its deadline allows.
+    """
+
+    def __init__(self, limits):
+        """
+        :param limits: map of stage name to max concurrent runs, 0 for no limit
+        """
+        for stage in limits:
+            if stage not in LIMITED_STAGES:
+                raise ValueError("unknown stage %s, use one of %s" % (stage, ", ".join(LIMITED_STAGES)))
+        self.limits = {stage: int(limit) for stage, limit in limits.items() if int(limit) > 0}
+        self.semaphores = {stage: threading.BoundedSemaphore(limit) for stage, limit in self.limits.items()}
+        # created on first use, so that they belong to the running event loop
+        self.async_semaphores = {}
+
+    @contextlib.contextmanager
+    def hold(self, stage, deadline=NO_DEADLINE):
+        """
+        Run the with block once the stage has a free slot.
+        :raise DeadlineExceeded: when the deadline passes first
+        """
+        semaphore = self.semaphores.get(stage)
+        if semaphore is None:
+            deadline.check(stage)
+            yield
+            return
+        timeout = deadline.timeout(None, stage)
+        if not semaphore.acquire(timeout=-1 if timeout is None else timeout):
+            metrics.DEADLINES_EXCEEDED.labels(stage=stage).inc()
+            raise DeadlineExceeded("deadline passed waiting for %s" % stage)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def hold_async(self, stage, deadline=NO_DEADLINE):
+        """
+        Like hold, for asyncio callers.
+        """
+        limit = self.limits.get(stage)
+        if limit is None:
+            deadline.check(stage)
+            yield
+            return
+        semaphore = self.async_semaphores.get(stage)
+        if semaphore is None:
+            semaphore = self.async_semaphores[stage] = asyncio.Semaphore(limit)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), deadline.timeout(None, stage))
+        except asyncio.TimeoutError:
+            metrics.DEADLINES_EXCEEDED.labels(stage=stage).inc()
+            raise DeadlineExceeded("deadline passed waiting for %s" % stage)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def request_queue_from_env():
+    """
+    Build the request queue according to env vars API_MAX_ACTIVE (0 by default, no limit),
+    API_MAX_QUEUED (2 * API_MAX_ACTIVE), API_QUEUE_TIMEOUT (10 sec) and API_RETRY_AFTER (5 sec).
+    """
+    max_active = int(os.environ.get('API_MAX_ACTIVE', 0))
+    return RequestQueue(max_active,
+                        max_queued=int(os.environ.get('API_MAX_QUEUED', 2 * max_active)),
+                        queue_timeout=float(os.environ.get('API_QUEUE_TIMEOUT', 10)),
+                        retry_after=int(os.environ.get('API_RETRY_AFTER', 5)))
+
+
+def stage_limits_from_env():
+    """
+    Build the stage limits according to env vars MAX_CONCURRENT_EXTRACT_TEXT (pdftotext runs),
+    MAX_CONCURRENT_EXTRACT_IMAGE (page rasterizations), MAX_CONCURRENT_BERT_REQUEST and
+    MAX_CONCURRENT_IMAGE_REQUEST (tensorflow-serving requests in flight), 0 or unset for no limit.
+    """
+    return StageLimits({stage: int(os.environ.get('MAX_CONCURRENT_' + stage.upper(), 0))
+                        for stage in LIMITED_STAGES})
+
+
+def request_deadline(header_value=None):
+    """
+    :param header_value: the X-Request-Timeout header of the request in seconds, if given
+    :return: Deadline of REQUEST_DEADLINE seconds (0 by default, none), or of the header value if shorter
+    """
+    seconds = float(os.environ.get('REQUEST_DEADLINE', 0)) or None
+    if header_value:
+        try:
+            requested = float(header_value)
+        except ValueError:
+            raise ValueError("X-Request-Timeout must be a number of seconds, got %r" % header_value)
+        if requested > 0:
+            seconds = requested if seconds is None else min(seconds, requested)
+    return Deadline(seconds)
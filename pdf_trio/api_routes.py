@@ -15,12 +15,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import time
 import logging
 
-from flask import request, jsonify, abort, Blueprint
+from flask import request, jsonify, abort, Blueprint, Response, stream_with_context
 
-from pdf_trio import pdf_classifier, url_classifier
+from pdf_trio import pdf_classifier, url_classifier, admission
 
 
 logging.basicConfig(filename='research-pub.log', level=logging.DEBUG)
@@ -30,8 +29,89 @@ log.info("STARTING   STARTING   STARTING   STARTING   STARTING   STARTING   STAR
 
 bp = Blueprint("classify", __name__)
 
-bp.pdf_classifier = pdf_classifier.PdfClassifier()
 bp.url_classifier = url_classifier.UrlClassifier()
+bp.pdf_classifier = pdf_classifier.PdfClassifier(url_classifier=bp.url_classifier)
+# set once the tensorflow-serving backends have answered, see warm_up
+bp.ready = False
+# PDF classification requests in progress, see API_MAX_ACTIVE
+bp.request_queue = admission.request_queue_from_env()
+
+def after_fork():
+    """
+    Call in each worker forked from a process that imported this module, like the
+    gunicorn master with preload_app; the models loaded by the master are shared.
+    """
+    bp.pdf_classifier.after_fork()
+    bp.request_queue = admission.request_queue_from_env()
+    bp.ready = False
+
+def warm_up():
+    """
+    Send one example to each model, until all of them have answered once.
+    :return: list of error messages, empty when ready
+    """
+    if bp.ready:
+        return []
+    errors = bp.pdf_classifier.warm_up()
+    if not errors:
+        bp.url_classifier.classify_url("http://example.com/warm_up.pdf")
+        bp.ready = True
+        log.info("models and backends are warm")
+    return errors
+
+def request_deadline():
+    """
+    :return: admission.Deadline of the current request, see REQUEST_DEADLINE
+    """
+    try:
+        return admission.request_deadline(request.headers.get('X-Request-Timeout'))
+    except ValueError as e:
+        abort(400, str(e))
+
+@bp.errorhandler(admission.Overloaded)
+def overloaded(e):
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 429
+
+@bp.errorhandler(admission.DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({"error": str(e)}), 504
+
+@bp.route('/ready', methods = ['GET'])
+def ready():
+    """
+    Readiness probe: 200 once the models are loaded and tensorflow-serving has answered, 503 before.
+    """
+    errors = warm_up()
+    if errors:
+        return jsonify({"ready": False, "errors": errors}), 503
+    return jsonify({"ready": True})
+
+@bp.route('/api/stats', methods = ['GET'])
+def stats():
+    """
+    Counters for tuning, like the batch sizes and queue wait of the tensorflow-serving batchers.
+    """
+    stats_map = {}
+    if bp.pdf_classifier.bert_batcher:
+        stats_map["bert_batcher"] = bp.pdf_classifier.bert_batcher.stats()
+    if bp.pdf_classifier.result_cache:
+        stats_map["result_cache"] = bp.pdf_classifier.result_cache.stats()
+    if bp.pdf_classifier.feature_store:
+        stats_map["feature_store"] = bp.pdf_classifier.feature_store.stats()
+    if bp.pdf_classifier.near_dup:
+        stats_map["near_dup"] = bp.pdf_classifier.near_dup.stats()
+    if bp.pdf_classifier.single_flight:
+        stats_map["single_flight"] = bp.pdf_classifier.single_flight.stats()
+    if bp.pdf_classifier.image_batcher:
+        stats_map["image_batcher"] = bp.pdf_classifier.image_batcher.stats()
+    if bp.pdf_classifier.extract_processes:
+        stats_map["extract_pool"] = bp.pdf_classifier.extract_processes.stats()
+    stats_map["request_queue"] = bp.request_queue.stats()
+    stats_map["cascade"] = bp.pdf_classifier.cascade.stats()
+    stats_map["url_classifier"] = bp.url_classifier.stats()
+    return jsonify(stats_map)
 
 @bp.route('/classify/research-pub/url', methods = ['POST'])
 def classify_by_url():
@@ -42,24 +122,62 @@ def classify_by_url():
     Parameter urls= in POST: json list of URLs like ["http://foo.com", "http://bar.com"]
     Each URL is separately classified.
     :return: json { "url1": 0.88, "url2": 0.92, "url3": 0.23 }
+
+    With Content-Type application/x-ndjson, the body is a stream of lines, each a URL string
+    or an object with a "url", and the response streams one line per URL, like
+    {"url": "http://foo.com", "confidence": 0.88}; objects are returned with "confidence" added.
     """
-    start_ts = int(time.time()*1000)
+    if request.mimetype == 'application/x-ndjson':
+        lines = bp.url_classifier.classify_ndjson(request.stream)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
     input = request.json or {}
-    url_list = input.get('urls')
-    results_map = {}
-    for url in url_list:
-        confidence = bp.url_classifier.classify_url(url)
-        results_map[url] = confidence
-    log.debug("results_map=%s" % (results_map))
+    url_list = input.get('urls') or []
+    results_map = dict(zip(url_list, bp.url_classifier.classify_urls(url_list)))
+    log.debug("classified %d urls" % (len(results_map)))
     retmap = {"predictions": results_map}
     return jsonify(retmap)
 
+@bp.route('/classify/research-pub/batch', methods = ['POST'])
+def classify_pdf_batch():
+    """
+    Each of the given PDFs is classified as a research publication or not. The PDFs are not stored.
+    params: "type" comma sep. list of { all, auto, image, bert, linear }, auto by default;
+        one "pdf_content" part per PDF; optionally one "url" part per PDF, in the same order,
+        where the PDF was found, for the url stages of auto mode (empty if unknown).
+    :return: json with one result per PDF, in upload order; 429 when too many requests are in
+        progress, 504 when the deadline (REQUEST_DEADLINE, X-Request-Timeout header) passed
+
+    Example result:
+
+        {
+          "results": [
+            { "filename": "a.pdf", "is_research" : 0.94, "linear" : 0.92, "version" : { ... } },
+            { "filename": "b.pdf", "is_research" : 0.12, "linear" : 0.12, "version" : { ... } }
+          ]
+        }
+    """
+    ctype = request.form.get('type', 'auto')
+    pdf_filestorage_list = request.files.getlist('pdf_content')
+    if not pdf_filestorage_list:
+        abort(400, "no pdf_content given")
+    urls = request.form.getlist('url') or None
+    if urls is not None and len(urls) != len(pdf_filestorage_list):
+        abort(400, "%d url parts given for %d pdf_content parts" % (len(urls), len(pdf_filestorage_list)))
+    log.debug("type=%s  pdf_content for %d files" % (ctype, len(pdf_filestorage_list)))
+    deadline = request_deadline()
+    with bp.request_queue.admit(deadline):
+        results = bp.pdf_classifier.classify_pdf_batch(ctype, pdf_filestorage_list, urls, deadline)
+    for pdf_filestorage, result in zip(pdf_filestorage_list, results):
+        result["filename"] = pdf_filestorage.filename
+    return jsonify({"results": results}), 200
+
 @bp.route('/classify/research-pub/<string:ctype>', methods = ['POST'])
 def classify_pdf(ctype):
     """
     The given PDF is classified as a research publication or not. The PDF is not stored.
-    params: "type" comma sep. list of { all, auto, image, bert, linear }
-    :return: json
+    params: "type" comma sep. list of { all, auto, image, bert, linear }; optionally "url"
+        where the PDF was found, for the url stages of auto mode.
+    :return: json; 429 and 504 like the batch endpoint
 
     Example result:
 
@@ -82,6 +200,8 @@ def classify_pdf(ctype):
         ctype = "auto"
     pdf_filestorage = request.files['pdf_content']
     log.debug("type=%s  pdf_content for %s" % (ctype, pdf_filestorage.filename))
-    results = bp.pdf_classifier.classify_pdf_multi(ctype, pdf_filestorage)
+    deadline = request_deadline()
+    with bp.request_queue.admit(deadline):
+        results = bp.pdf_classifier.classify_pdf_multi(ctype, pdf_filestorage, request.form.get('url'), deadline)
     return jsonify(results), 200
 
@@ -0,0 +1,207 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+asyncio (ASGI) variant of the API server, with the same routes and JSON results as the
+Flask app, for keeping many PDFs in flight in one process. Needs starlette, python-multipart
+and httpx; run it with an ASGI server, like:
+
+    uvicorn --factory pdf_trio.asgi:create_app --port 3939
+"""
+
+import html
+import logging
+import contextlib
+
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from pdf_trio import pdf_classifier, url_classifier, async_classifier, metrics, admission
+
+log = logging.getLogger(__name__)
+
+
+class RequestStreamingResponse(StreamingResponse):
+    """
+    Streams a response that is made while the request body is still being read. StreamingResponse
+    may wait for the client disconnect message meanwhile, which would take the body messages.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+def create_app():
+    url_clf = url_classifier.UrlClassifier()
+    classifier = async_classifier.AsyncPdfClassifier(pdf_classifier.PdfClassifier(url_classifier=url_clf))
+    # PDF classification requests in progress, see API_MAX_ACTIVE; they never wait for a turn
+    # here, the stage limits queue their work
+    request_queue = admission.request_queue_from_env()
+
+    async def toplevel(request):
+        return PlainTextResponse("okay!")
+
+    async def list_api(request):
+        """
+        Show the REST api.
+        """
+        apilist = []
+        for route in sorted(app.routes, key=lambda r: r.path):
+            methods = sorted([x for x in route.methods if x != "HEAD"])
+            url = html.escape(route.path)
+            apilist.append("<div><a href='{}'><b>{}</b></a> {}<br/>{}</div>".format(
+                url, url, methods, route.endpoint.__doc__ or ''))
+        header = "<body><section><h2>REST API (%d end-points)</h2>" % len(apilist)
+        return HTMLResponse(header + "<br/>".join(apilist) + "</section></body>")
+
+    async def metrics_view(request):
+        """
+        Prometheus metrics, like the time spent per classification stage.
+        """
+        data, content_type = metrics.generate()
+        return Response(data, headers={"Content-Type": content_type})
+
+    async def stats(request):
+        """
+        Counters for tuning, like PDFs in flight and result cache hits.
+        """
+        stats_map = {"async": classifier.stats()}
+        if classifier.classifier.result_cache:
+            stats_map["result_cache"] = classifier.classifier.result_cache.stats()
+        if classifier.classifier.feature_store:
+            stats_map["feature_store"] = classifier.classifier.feature_store.stats()
+        if classifier.classifier.near_dup:
+            stats_map["near_dup"] = classifier.classifier.near_dup.stats()
+        if classifier.classifier.single_flight:
+            stats_map["single_flight"] = classifier.classifier.single_flight.stats()
+        if classifier.classifier.extract_processes:
+            stats_map["extract_pool"] = classifier.classifier.extract_processes.stats()
+        stats_map["request_queue"] = request_queue.stats()
+        stats_map["cascade"] = classifier.classifier.cascade.stats()
+        stats_map["url_classifier"] = url_clf.stats()
+        return JSONResponse(stats_map)
+
+    async def classify_by_url(request):
+        """
+        The given URL(s) is/are classified as referring to a research publication with a confidence value.
+        Parameter urls= in POST: json list of URLs like ["http://foo.com", "http://bar.com"]
+        :return: json { "predictions": { "url1": 0.88, "url2": 0.92, "url3": 0.23 } }
+        With Content-Type application/x-ndjson, URLs are streamed in and results streamed out,
+        one per line, like the Flask app.
+        """
+        if request.headers.get('content-type', '').split(';')[0].strip() == 'application/x-ndjson':
+            return RequestStreamingResponse(classify_ndjson(request), media_type='application/x-ndjson')
+        body = await request.body()
+        url_list = (await request.json() if body else {}).get('urls') or []
+        confidences = await classifier.run_cpu(url_clf.classify_urls, url_list)
+        log.debug("classified %d urls" % (len(url_list)))
+        return JSONResponse({"predictions": dict(zip(url_list, confidences))})
+
+    async def classify_ndjson(request):
+        """
+        :return: async generator of result lines, a URL_BATCH_SIZE batch at a time
+        """
+        rest = b""
+        lines = []
+        async for chunk in request.stream():
+            lines.extend((rest + chunk).split(b"\n"))
+            rest = lines.pop()
+            if len(lines) >= url_clf.batch_size:
+                yield await classifier.run_cpu(classify_lines, lines)
+                lines = []
+        lines.append(rest)
+        yield await classifier.run_cpu(classify_lines, lines)
+
+    def classify_lines(lines):
+        return "".join(url_clf.classify_ndjson(lines))
+
+    async def classify_pdf_batch(request):
+        """
+        Each of the given PDFs is classified as a research publication or not. The PDFs are not stored.
+        params: "type" comma sep. list of { all, auto, image, bert, linear }, auto by default;
+            one "pdf_content" part per PDF; optionally one "url" part per PDF, in the same order.
+        :return: json {"results": [...]} with one result per PDF, in upload order
+        """
+        form = await request.form()
+        ctype = form.get('type', 'auto')
+        uploads = form.getlist('pdf_content')
+        if not uploads:
+            return PlainTextResponse("no pdf_content given", status_code=400)
+        urls = form.getlist('url') or None
+        if urls is not None and len(urls) != len(uploads):
+            return PlainTextResponse("%d url parts given for %d pdf_content parts" % (len(urls), len(uploads)),
+                                     status_code=400)
+        log.debug("type=%s  pdf_content for %d files" % (ctype, len(uploads)))
+        try:
+            deadline = admission.request_deadline(request.headers.get('X-Request-Timeout'))
+        except ValueError as e:
+            return PlainTextResponse(str(e), status_code=400)
+        pdfs = [(upload.filename, await upload.read()) for upload in uploads]
+        with request_queue.admit_nowait():
+            results = await classifier.classify_pdf_batch(ctype, pdfs, urls, deadline)
+        for (filename, _), result in zip(pdfs, results):
+            result["filename"] = filename
+        return JSONResponse({"results": results})
+
+    async def classify_pdf(request):
+        """
+        The given PDF is classified as a research publication or not. The PDF is not stored.
+        params: "type" comma sep. list of { all, auto, image, bert, linear }; optionally "url"
+            where the PDF was found.
+        :return: json like {"is_research": 0.94, "linear": 0.92, "version": { ... }}
+        """
+        ctype = request.path_params['ctype']
+        form = await request.form()
+        upload = form.get('pdf_content')
+        if upload is None or isinstance(upload, str):
+            return PlainTextResponse("no pdf_content given", status_code=400)
+        log.debug("type=%s  pdf_content for %s" % (ctype, upload.filename))
+        try:
+            deadline = admission.request_deadline(request.headers.get('X-Request-Timeout'))
+        except ValueError as e:
+            return PlainTextResponse(str(e), status_code=400)
+        pdf_content = await upload.read()
+        with request_queue.admit_nowait():
+            results = await classifier.classify_pdf_multi(ctype, upload.filename, pdf_content, form.get('url'),
+                                                          deadline)
+        return JSONResponse(results)
+
+    async def overloaded(request, e):
+        return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+
+    async def deadline_exceeded(request, e):
+        return JSONResponse({"error": str(e)}, status_code=504)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await classifier.aclose()
+
+    app = Starlette(routes=[
+        Route('/', toplevel, methods=['GET']),
+        Route('/api/list', list_api, methods=['GET']),
+        Route('/metrics', metrics_view, methods=['GET']),
+        Route('/api/stats', stats, methods=['GET']),
+        Route('/classify/research-pub/url', classify_by_url, methods=['POST']),
+        Route('/classify/research-pub/batch', classify_pdf_batch, methods=['POST']),
+        Route('/classify/research-pub/{ctype}', classify_pdf, methods=['POST']),
+    ], lifespan=lifespan, exception_handlers={
+        admission.Overloaded: overloaded,
+        admission.DeadlineExceeded: deadline_exceeded,
+    })
+    app.state.classifier = classifier
+    return app
@@ -0,0 +1,451 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+asyncio version of the PDF classification pipeline, used by the ASGI server (see asgi.py).
+
+A PDF in flight costs a coroutine instead of a thread: pdftotext and convert run as asyncio
+subprocesses, tensorflow-serving is called with a non-blocking HTTP client, and only the CPU
+bound steps (fastText, BERT token ids, image decoding) go to a thread pool.
+"""
+
+import os
+import asyncio
+import logging
+import functools
+import contextvars
+import concurrent.futures
+
+from pdf_trio import metrics
+from pdf_trio import admission
+from pdf_trio import pdf_util
+from pdf_trio import text_prep
+from pdf_trio import tf_transport
+from pdf_trio.pdf_classifier import PdfClassifier, _PdfJob
+from pdf_trio.result_cache import ResultCache
+from pdf_trio.single_flight import SingleFlight, LeaderGone
+
+log = logging.getLogger(__name__)
+
+
+class AsyncPdfClassifier:
+    """
+    Same modes and results as PdfClassifier.classify_pdf_batch, for asyncio callers. The models,
+    vocabulary, version map, result cache and settings of the given PdfClassifier are used.
+    """
+
+    def __init__(self, classifier, cpu_workers=None):
+        """
+        :param classifier: PdfClassifier
+        :param cpu_workers: threads for the CPU bound steps, number of CPUs by default
+        """
+        self.classifier = classifier
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=cpu_workers or os.cpu_count() or 4)
+        # None with TF_TRANSPORT=grpc, then the blocking transport of the classifier is called from a thread
+        self.bert_transport = tf_transport.async_transport_from_env('BERT', 'bert_model',
+                                                                    classifier.bert_server_prefix)
+        self.image_transport = tf_transport.async_transport_from_env('IMAGE', 'image_model',
+                                                                     classifier.image_server_prefix,
+                                                                     instances_input=classifier.image_input_name)
+        # limits concurrent pdftotext and convert processes (PDF_EXTRACT_WORKERS), not PDFs in flight;
+        # created on first use so that it belongs to the running event loop
+        self.extract_slots = None
+        self.in_flight = 0
+
+    async def aclose(self):
+        for transport in (self.bert_transport, self.image_transport):
+            if transport:
+                await transport.aclose()
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {"in_flight": self.in_flight}
+
+    async def run_cpu(self, fn, *args):
+        """
+        Run a CPU bound function in the thread pool, in a copy of the context (like asyncio.to_thread),
+        so that it reports to the pdf_util.extraction_status() of the task.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(contextvars.copy_context().run, fn, *args))
+
+    async def classify_pdf_multi(self, modes, name, pdf_content, url=None, deadline=admission.NO_DEADLINE):
+        """
+        :param modes:  comma sep list of 1 or more {auto, image, linear, bert, all}
+        :param name: file name, for logging
+        :param pdf_content: PDF bytes
+        :param url: where the PDF was found, if known, for the url stages of auto mode
+        :param deadline: admission.Deadline of the request
+        :return: map like PdfClassifier.classify_pdf_multi returns
+        """
+        return (await self.classify_pdf_batch(modes, [(name, pdf_content)], [url], deadline))[0]
+
+    async def classify_pdf_batch(self, modes, pdfs, urls=None, deadline=admission.NO_DEADLINE):
+        """
+        :param modes:  comma sep list of 1 or more {auto, image, linear, bert, all}
+        :param pdfs: list of (file name, PDF bytes)
+        :param urls: where each PDF was found (or None), if known, for the url stages of auto mode
+        :param deadline: admission.Deadline of the request; when it passes, the classification is
+            cancelled, which kills its subprocesses
+        :return: list of maps like PdfClassifier.classify_pdf_multi returns, in the same order as given
+        :raise admission.DeadlineExceeded: when the deadline passes before the PDFs are classified
+        """
+        if urls is None:
+            urls = [None] * len(pdfs)
+        mode_list = modes.split(",")
+        # rewrite mode_list if 'all' is requested
+        if 'all' in mode_list:
+            mode_list = ['image', 'linear', 'bert']
+        # hashing the PDFs and the result cache DB would block the event loop, so run in the thread pool;
+        # shielded, the flights begun there must be finished even if this request is cancelled
+        begun = asyncio.ensure_future(self.run_cpu(self.begin_jobs, modes, mode_list, pdfs, urls, deadline))
+        try:
+            results, jobs, job_offsets, waiting = await asyncio.shield(begun)
+        except BaseException as e:
+            begun.add_done_callback(functools.partial(self._abandon_begun, e))
+            raise
+        self.in_flight += len(jobs)
+        try:
+            timeout = deadline.timeout(None, "request")
+            if 'auto' in mode_list:
+                work = self.classify_jobs_auto(jobs)
+            else:
+                work = self.classify_jobs_named(jobs, mode_list)
+            await asyncio.wait_for(work, timeout)
+        except BaseException as e:
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.DEADLINES_EXCEEDED.labels(stage="request").inc()
+                e = admission.DeadlineExceeded("deadline passed classifying %d PDFs" % len(jobs))
+            await asyncio.shield(self.run_cpu(self.abandon_jobs, jobs, e))
+            raise e
+        finally:
+            self.in_flight -= len(jobs)
+        await asyncio.shield(self.run_cpu(self.finish_jobs, jobs, job_offsets, results))
+        for offset, flight in waiting:
+            results[offset] = await self.wait_in_flight(flight, modes, pdfs[offset], urls[offset], deadline)
+        return results
+
+    def begin_jobs(self, modes, mode_list, pdfs, urls, deadline):
+        """
+        Runs in the thread pool: look up the results cache, and begin a single flight for each PDF
+        to classify.
+        :return: results list with the cached results filled in, jobs to classify, offset of each
+            job in results, and (offset, future) of the PDFs classified by another request
+        """
+        cache = self.classifier.result_cache
+        flights = self.classifier.single_flight
+        results = [None] * len(pdfs)
+        jobs = []
+        job_offsets = []
+        waiting = []
+        try:
+            for offset, ((name, pdf_content), url) in enumerate(zip(pdfs, urls)):
+                cache_key = None
+                if cache or flights:
+                    cache_key = ResultCache.make_key(pdf_content, modes, self.classifier.version_map,
+                                                     self.classifier.cache_variant(mode_list, url))
+                if cache:
+                    results[offset] = cache.get(cache_key)
+                    if results[offset] is not None:
+                        log.debug("cached result for %s" % (name))
+                        continue
+                job = _PdfJob(name, pdf_content, None, cache_key, url, deadline)
+                if flights:
+                    flight, first = flights.begin(cache_key)
+                    if not first:
+                        log.debug("waiting for the classification in flight of %s" % (name))
+                        waiting.append((offset, flight))
+                        continue
+                    job.flight = flight
+                jobs.append(job)
+                job_offsets.append(offset)
+        except BaseException as e:
+            self.abandon_jobs(jobs, e)
+            raise
+        return results, jobs, job_offsets, waiting
+
+    def finish_jobs(self, jobs, job_offsets, results):
+        """
+        Runs in the thread pool: fill in results, store them in the result cache, and give them to
+        the requests waiting for the same PDFs.
+        """
+        cache = self.classifier.result_cache
+        for offset, job in zip(job_offsets, jobs):
+            results[offset] = job.results_map(self.classifier.version_map)
+            if cache and job.cacheable():
+                cache.put(job.cache_key, results[offset])
+            if job.flight:
+                self.classifier.single_flight.finish(job.cache_key, job.flight, results[offset])
+
+    def abandon_jobs(self, jobs, error):
+        """
+        Give the error to the requests waiting for the same PDFs as the jobs.
+        """
+        for job in jobs:
+            if job.flight:
+                self.classifier.single_flight.finish(job.cache_key, job.flight, error=error)
+
+    def _abandon_begun(self, error, begun):
+        # the request was cancelled while begin_jobs ran, nobody classifies its jobs
+        if not begun.cancelled() and begun.exception() is None:
+            self.abandon_jobs(begun.result()[1], error)
+
+    async def wait_in_flight(self, flight, modes, pdf, url, deadline):
+        """
+        Like PdfClassifier.wait_in_flight.
+        """
+        try:
+            # shielded, so that the timeout of this request does not cancel the future of the other
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight)),
+                                   deadline.timeout(None, "single_flight"))
+            return SingleFlight.wait(flight)
+        except asyncio.TimeoutError:
+            metrics.DEADLINES_EXCEEDED.labels(stage="single_flight").inc()
+            raise admission.DeadlineExceeded("deadline passed waiting for the classification of %s" % pdf[0])
+        except LeaderGone:
+            deadline.check("single_flight")
+            # the other request ran out of its own time, or was cancelled
+            return (await self.classify_pdf_batch(modes, [pdf], [url], deadline))[0]
+
+    async def classify_jobs_auto(self, jobs):
+        """
+        Like PdfClassifier.classify_jobs_auto. A speculative page 0 render that loses to the
+        text path is cancelled, which kills its convert process.
+        """
+        cascade = self.classifier.cascade
+        all_jobs = jobs
+        await self.run_cascade(cascade.stages("url"), [job for job in jobs if job.url])
+        jobs = [job for job in jobs if not job.decided]
+        page0_tasks = []
+        if self.classifier.speculative_image and cascade.speculative_image():
+            page0_tasks = [asyncio.ensure_future(self.extract_page0(job)) for job in jobs]
+        text_jobs = []
+        image_jobs = []
+        jpgs = []
+        try:
+            policy = self.classifier.text_policy(cascade.text_classifiers() or ["linear"])
+            token_lists = await asyncio.gather(*[self.extract_tokens(job, policy) for job in jobs])
+            for j, (job, pdf_token_list) in enumerate(zip(jobs, token_lists)):
+                job.token_list = pdf_token_list
+                job.cost_ms += cascade.extract_text_cost_ms
+                if len(pdf_token_list) != 0:
+                    text_jobs.append(job)
+                    if page0_tasks:
+                        # the text path wins
+                        page0_tasks[j].cancel()
+                else:
+                    image_jobs.append(job)
+                    if page0_tasks:
+                        jpgs.append(await page0_tasks[j])
+        finally:
+            # the renders not awaited yet when this failed or was cancelled; done tasks are not affected
+            for task in page0_tasks:
+                task.cancel()
+        branches = []
+        if text_jobs:
+            branches.append(functools.partial(self.run_cascade, cascade.stages("text"), text_jobs))
+        if image_jobs:
+            # no tokens, by default use image
+            branches.append(functools.partial(self.run_cascade, cascade.stages("no_text"), image_jobs,
+                                              jpgs if page0_tasks else None))
+        await self.run_branches(branches)
+        cascade.record(all_jobs)
+
+    async def run_cascade(self, stages, jobs, jpgs=None):
+        """
+        Like PdfClassifier.run_cascade.
+        """
+        for stage in stages:
+            if not jobs:
+                break
+            if stage.classifier == "urlmeta":
+                await self.run_cpu(self.classifier.classify_jobs_urlmeta, jobs)
+            elif stage.classifier == "linear":
+                await self.run_cpu(self.classifier.classify_jobs_linear, jobs)
+            elif stage.classifier == "bert":
+                await self.classify_jobs_bert(jobs)
+            else:
+                await self.classify_jobs_image(jobs, jpgs)
+            jpgs = None
+            jobs = self.classifier.cascade.advance(stage, jobs)
+
+    async def classify_jobs_named(self, jobs, mode_list):
+        """
+        Like PdfClassifier.classify_jobs_named.
+        """
+        branches = []
+        if "image" in mode_list:
+            branches.append(functools.partial(self.classify_jobs_image, jobs))
+        text_classifiers = [c for c in mode_list if c in ("linear", "bert")]
+        if text_classifiers:
+            branches.append(functools.partial(self.classify_jobs_text, jobs, text_classifiers))
+        for classifier in mode_list:
+            if classifier not in ("image", "linear", "bert"):
+                log.warning("ignoring unknown classifier ref: " + classifier)
+        await self.run_branches(branches)
+
+    async def classify_jobs_text(self, jobs, text_classifiers):
+        policy = self.classifier.text_policy(text_classifiers)
+        token_lists = await asyncio.gather(*[self.extract_tokens(job, policy) for job in jobs])
+        for job, pdf_token_list in zip(jobs, token_lists):
+            job.token_list = pdf_token_list
+        text_jobs = PdfClassifier.jobs_with_tokens(jobs)
+        for classifier in text_classifiers:
+            if classifier == "linear":
+                await self.run_cpu(self.classifier.classify_jobs_linear, text_jobs)
+            else:
+                await self.classify_jobs_bert(text_jobs)
+
+    async def run_branches(self, branches):
+        """
+        :param branches: functions returning a coroutine, awaited concurrently unless PARALLEL_BRANCHES=0
+        """
+        if self.classifier.parallel_branches:
+            await asyncio.gather(*[branch() for branch in branches])
+        else:
+            for branch in branches:
+                await branch()
+
+    def slots(self):
+        if self.extract_slots is None:
+            self.extract_slots = asyncio.Semaphore(self.classifier.extract_workers)
+        return self.extract_slots
+
+    async def extract_tokens(self, job, policy=pdf_util.WHOLE_DOCUMENT):
+        """
+        :param job: _PdfJob
+        :param policy: pdf_util.TextPolicy, the pages and token budget
+        :return: token list, empty if too little text was found to be useful.
+        """
+        job.token_policy = policy
+        if self.classifier.feature_store:
+            pdf_token_list = await self.run_cpu(self.classifier.stored_tokens, job)
+            if pdf_token_list is not None:
+                return pdf_token_list
+        with pdf_util.extraction_status() as status:
+            async with self.classifier.stage_limits.hold_async("extract_text", job.deadline), self.slots():
+                with metrics.stage("extract_text"):
+                    pdf_raw_text = await pdf_util.extract_pdf_text_from_content_async(job.pdf_content, policy)
+        pdf_token_list = await self.run_cpu(PdfClassifier.tokens_from_text, pdf_raw_text, policy.max_tokens)
+        if self.classifier.feature_store and status.complete:
+            await self.run_cpu(self.classifier.store_tokens, job, pdf_token_list)
+        return pdf_token_list
+
+    async def extract_page0(self, job):
+        """
+        :param job: _PdfJob
+        :return: jpg bytes, or a uint8 array with PDF_RASTERIZER=pdfium or from the feature store;
+            empty or None if no good image produced.
+        """
+        if self.classifier.feature_store:
+            image = await self.run_cpu(self.classifier.stored_page0, job)
+            if image is not None:
+                return image
+        limits = self.classifier.stage_limits
+        with pdf_util.extraction_status() as status:
+            if self.classifier.rasterizer == 'pdfium':
+                async with limits.hold_async("extract_image", job.deadline):
+                    with metrics.stage("extract_image"):
+                        jpg_page0 = await self.run_cpu(pdf_util.render_pdf_page0, job.pdf_content)
+            else:
+                async with limits.hold_async("extract_image", job.deadline), self.slots():
+                    with metrics.stage("extract_image"):
+                        jpg_page0 = await pdf_util.extract_pdf_image_from_content_async(job.pdf_content)
+        if self.classifier.feature_store and status.complete:
+            return await self.run_cpu(self.classifier.store_page0, job, jpg_page0)
+        return jpg_page0
+
+    async def classify_jobs_bert(self, jobs):
+        jobs = await self.run_cpu(self.classifier.reuse_near_dup_scores, jobs, "bert")
+        features = await self.run_cpu(lambda: [self.classifier.job_bert_features(job) for job in jobs])
+        confidences = await self.predict("bert", features, [job.name for job in jobs],
+                                         admission.latest([job.deadline for job in jobs]))
+        for job, confidence_bert in zip(jobs, confidences):
+            job.add_result("bert", confidence_bert)
+        await self.run_cpu(self.classifier.remember_near_dup_scores, jobs, "bert")
+
+    async def classify_jobs_image(self, jobs, jpgs=None):
+        """
+        :param jobs: list of _PdfJob
+        :param jpgs: page 0 jpgs already extracted for the jobs, if any
+        """
+        if jpgs is None:
+            jpgs = await asyncio.gather(*[self.extract_page0(job) for job in jobs])
+        image_jobs = []
+        for job, jpg_page0 in zip(jobs, jpgs):
+            if jpg_page0 is None or len(jpg_page0) == 0:
+                log.debug("no jpg for %s" % (job.name))
+                continue  # skip
+            job.jpg_page0 = jpg_page0
+            image_jobs.append(job)
+        images = await self.run_cpu(lambda: [PdfClassifier.load_pdf_image(job.jpg_page0) for job in image_jobs])
+        confidences = await self.predict("image", images, [job.name for job in image_jobs],
+                                         admission.latest([job.deadline for job in image_jobs]))
+        for job, confidence_image in zip(image_jobs, confidences):
+            job.add_result("image", confidence_image)
+
+    async def predict(self, model, examples, trace_ids, deadline=admission.NO_DEADLINE):
+        """
+        Send the examples to tensorflow-serving, up to TF_MAX_BATCH_SIZE per request, requests in parallel.
+        :param model: bert or image
+        :param examples: list of BERT features or images
+        :param trace_ids: list of doc ids for logging
+        :param deadline: admission.Deadline, which cuts the request timeouts to the time left
+        :return: list of encoded confidences, 0.5 for each example of a failed request
+        """
+        size = self.classifier.tf_max_batch_size
+        if model == "bert":
+            chunks = PdfClassifier.bert_chunks(examples, size)
+        else:
+            chunks = [list(range(offset, min(offset + size, len(examples)))) for offset in range(0, len(examples), size)]
+        results = await asyncio.gather(*[self._predict_chunk(model, [examples[j] for j in chunk],
+                                                             [trace_ids[j] for j in chunk], deadline)
+                                         for chunk in chunks])
+        ret = [0.5] * len(examples)
+        for chunk, confidences in zip(chunks, results):
+            for j, confidence in zip(chunk, confidences):
+                ret[j] = confidence
+        return ret
+
+    async def _predict_chunk(self, model, examples, trace_ids, deadline):
+        ret = [0.5] * len(examples)  # zero confidence encoded default
+        stage = model + "_request"
+        try:
+            if model == "bert":
+                inputs = PdfClassifier.bert_inputs(examples)
+                transport, sync_transport = self.bert_transport, self.classifier.bert_transport
+            else:
+                inputs = self.classifier.image_inputs(examples)
+                transport, sync_transport = self.image_transport, self.classifier.image_transport
+            async with self.classifier.stage_limits.hold_async(stage, deadline):
+                with metrics.stage(stage):
+                    timeout = deadline.timeout(None, stage)
+                    if transport:
+                        outputs = await transport.predict(inputs, timeout)
+                    else:
+                        outputs = await self.run_cpu(sync_transport.predict, inputs, timeout)
+            for j, response_vec in enumerate(outputs[:len(examples)]):
+                log.debug("%s classify %s  other=%.2f research=%.2f" %
+                          (model, trace_ids[j], response_vec[0], response_vec[1]))
+                ret[j] = PdfClassifier.decode_softmax(response_vec)
+        except admission.DeadlineExceeded:
+            raise
+        except Exception as e:
+            deadline.check(stage)
+            metrics.BACKEND_ERRORS.labels(model=model).inc()
+            log.warning("exception occurred processing %s tensorflow-serving for %s: %s" %
+                        (model, ",".join(trace_ids), e))
+        return ret
@@ -0,0 +1,190 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Dynamic micro-batching of examples from concurrent requests into one back-end call.
+"""
+
+import os
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+log = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Callers submit items from any thread and block until their result is ready. Pending items
+    are collected into a batch that is handed to process_batch when it reaches max_batch_size
+    or when its oldest item has waited max_wait_ms, whichever comes first.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait_ms=5.0, workers=1, name="batcher"):
+        """
+        :param process_batch: function taking a list of items and returning a list of results,
+            one per item in the same order. An exception is raised to every caller in the batch.
+        :param max_batch_size: max items per call of process_batch.
+        :param max_wait_ms: max time the first item of a batch waits for more items to arrive.
+        :param workers: number of threads calling process_batch, i.e. max concurrent batches.
+        :param name: used for thread names and logging.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.workers = max(1, int(workers))
+        self.name = name
+        self.cond = threading.Condition()
+        self.pending = collections.deque()  # of (item, future, enqueue time)
+        # threads are started on first use, so that a batcher created before fork() works in the children
+        self.started_pid = None
+        # counters, protected by cond
+        self.batch_count = 0
+        self.item_count = 0
+        self.batch_size_counts = collections.Counter()
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def submit(self, item):
+        """
+        :param item: one example for process_batch
+        :return: its result, once the batch holding it has been processed
+        """
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items, timeout=None):
+        """
+        Queue several items at once (they may be spread over several batches) and wait for all.
+        :param items: list of examples for process_batch
+        :param timeout: max seconds to wait, None for no limit
+        :return: list of results in the same order
+        :raise concurrent.futures.TimeoutError: after timeout seconds; the items not yet taken
+            into a batch are dropped
+        """
+        futures = []
+        with self.cond:
+            self._start_workers()
+            now = time.time()
+            for item in items:
+                future = concurrent.futures.Future()
+                self.pending.append((item, future, now))
+                futures.append(future)
+            self.cond.notify_all()
+        if timeout is None:
+            return [f.result() for f in futures]
+        ends = time.time() + timeout
+        try:
+            return [f.result(max(0.0, ends - time.time())) for f in futures]
+        except concurrent.futures.TimeoutError:
+            for f in futures:
+                f.cancel()
+            raise
+
+    def stats(self):
+        """
+        :return: map of counters for tuning max_batch_size and max_wait_ms
+        """
+        with self.cond:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "batches": self.batch_count,
+                "items": self.item_count,
+                "mean_batch_size": (self.item_count / self.batch_count) if self.batch_count else 0.0,
+                "batch_sizes": {str(k): v for k, v in sorted(self.batch_size_counts.items())},
+                "queue_wait_ms_total": self.queue_wait_total * 1000.0,
+                "queue_wait_ms_mean": (self.queue_wait_total * 1000.0 / self.item_count) if self.item_count else 0.0,
+                "queue_wait_ms_max": self.queue_wait_max * 1000.0,
+                "queued": len(self.pending),
+            }
+
+    def _start_workers(self):
+        # caller holds self.cond
+        if self.started_pid == os.getpid():
+            return
+        self.started_pid = os.getpid()
+        for j in range(self.workers):
+            t = threading.Thread(target=self._run, name="%s-%d" % (self.name, j), daemon=True)
+            t.start()
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = self.pending[0][2] + self.max_wait
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+                if not self.pending:
+                    # another worker took the batch
+                    return []
+            batch = []
+            while self.pending and len(batch) < self.max_batch_size:
+                entry = self.pending.popleft()
+                # false for the items of a caller that stopped waiting
+                if entry[1].set_running_or_notify_cancel():
+                    batch.append(entry)
+            if not batch:
+                return []
+            now = time.time()
+            self.batch_count += 1
+            self.item_count += len(batch)
+            self.batch_size_counts[len(batch)] += 1
+            for _, _, enqueue_ts in batch:
+                wait = now - enqueue_ts
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                results = self.process_batch([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError("%s: got %d results for a batch of %d" % (self.name, len(results), len(batch)))
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                log.warning("%s: batch of %d failed: %s" % (self.name, len(batch), e))
+                for _, future, _ in batch:
+                    future.set_exception(e)
+
+
+def batcher_from_env(prefix, process_batch, default_max_batch_size=1):
+    """
+    Build a MicroBatcher configured by env vars <prefix>_BATCH_SIZE, <prefix>_BATCH_WAIT_MS
+    and <prefix>_BATCH_WORKERS.
+    :param prefix: env var prefix, like BERT
+    :param process_batch: see MicroBatcher
+    :param default_max_batch_size: used when <prefix>_BATCH_SIZE is not set
+    :return: MicroBatcher, or None if batching is disabled (batch size of 1 or less)
+    """
+    max_batch_size = int(os.environ.get(prefix + '_BATCH_SIZE', default_max_batch_size))
+    if max_batch_size <= 1:
+        return None
+    max_wait_ms = float(os.environ.get(prefix + '_BATCH_WAIT_MS', 5))
+    workers = int(os.environ.get(prefix + '_BATCH_WORKERS', 2))
+    log.info("%s batching enabled: max_batch_size=%d max_wait_ms=%.1f workers=%d" %
+             (prefix, max_batch_size, max_wait_ms, workers))
+    return MicroBatcher(process_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                        workers=workers, name=prefix.lower() + "-batcher")
@@ -0,0 +1,230 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Offline bulk classification of directories of PDFs, without the REST API; see pdf_classifier.main.
+
+PDFs are classified in batches by a pool of worker processes, each with the PdfClassifier
+loaded once by the parent before the pool forks; each worker then creates its own connections
+and thread pools, see PdfClassifier.after_fork. Results are appended to a JSONL file, one
+line per PDF, which is also the checkpoint: a rerun with the same output file skips the PDFs
+already in it. When the PDFs come from positive and negative directories, confusion matrices
+per model, and how often the models agree, are computed from the whole output file at the end.
+"""
+
+import io
+import os
+import json
+import time
+import logging
+import functools
+import itertools
+import multiprocessing
+import concurrent.futures
+
+from werkzeug.datastructures import FileStorage
+
+log = logging.getLogger(__name__)
+
+# PdfClassifier of this process, created before the pool forks
+_classifier = None
+
+MODELS = ("linear", "bert", "image", "is_research")
+
+
+def collect_pdf_files(dirs, label, skip=()):
+    """
+    Walk directories for .pdf files, in a stable order so that runs are comparable.
+    :param dirs: comma sep list of directories
+    :param label: research, other or None, given to all files found
+    :param skip: set of file basenames to leave out
+    :return: generator of (path, label)
+    """
+    for top in dirs.split(","):
+        if not top:
+            continue
+        for root, subdirs, files in os.walk(top):
+            subdirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".pdf") and name not in skip:
+                    yield os.path.join(root, name), label
+
+
+def read_checkpoint(output_path):
+    """
+    Read the results of previous runs, dropping a partial last line left by a killed run.
+    :return: list of result maps
+    """
+    rows = []
+    if not os.path.exists(output_path):
+        return rows
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete != len(data):
+            log.warning("dropping partial last line of %s" % output_path)
+            f.truncate(complete)
+    for line in data[:complete].splitlines():
+        if line.strip():
+            rows.append(json.loads(line))
+    return rows
+
+
+def _classify_task(modes, items):
+    """
+    Runs in a worker process.
+    :param items: list of (path, label)
+    :return: list of result maps, with path and label added, or an error message instead of results
+        so that a rerun does not try the same bad PDFs again
+    """
+    pdfs = []
+    rows = []
+    ret = []
+    for path, label in items:
+        try:
+            with open(path, 'rb') as f:
+                pdfs.append(FileStorage(io.BytesIO(f.read()), filename=path))
+            rows.append({"path": path, "label": label})
+        except OSError as e:
+            log.warning("cannot read %s: %s" % (path, e))
+            ret.append({"path": path, "label": label, "error": str(e)})
+    try:
+        results = _classifier.classify_pdf_batch(modes, pdfs) if pdfs else []
+    except Exception as e:
+        log.warning("batch starting with %s failed: %s" % (rows[0]["path"], e))
+        results = [{"error": str(e)}] * len(rows)
+    for row, result in zip(rows, results):
+        row.update(result)
+    return ret + rows
+
+
+def _init_worker():
+    """
+    Runs in each worker process as it starts: the connections, thread pools and result cache DB
+    connection of the classifier were forked from the parent and are unusable here.
+    """
+    _classifier.after_fork()
+
+
+def run(files, output_path, modes="all", processes=None, batch_size=16, classifier=None):
+    """
+    Classify the files, appending one JSON line per PDF to output_path, skipping those in it already.
+    :param files: iterable of (path, label)
+    :param classifier: PdfClassifier to fork into the workers, created from the env if None
+    :return: all rows of the output file, including those of previous runs
+    """
+    rows = read_checkpoint(output_path)
+    done = set(row["path"] for row in rows)
+    if done:
+        log.warning("resuming, %d PDFs are done already" % len(done))
+    todo = (item for item in files if item[0] not in done)
+    batches = iter(lambda: list(itertools.islice(todo, batch_size)), [])
+    return run_batches(functools.partial(_classify_task, modes), batches, output_path, rows,
+                       processes=processes, classifier=classifier)
+
+
+def run_batches(task, batches, output_path, rows, processes=None, classifier=None):
+    """
+    Run the task on each batch in a pool of worker processes, appending the rows it returns to output_path.
+    :param task: picklable function of a batch to a list of result maps, run in a worker where
+        _classifier is the PdfClassifier
+    :param batches: iterator of batches, lists of items
+    :param rows: rows of previous runs, the new ones are appended to it
+    :param classifier: PdfClassifier to fork into the workers, created from the env if None
+    :return: rows
+    """
+    global _classifier
+    if classifier is None:
+        from pdf_trio.pdf_classifier import PdfClassifier
+        classifier = PdfClassifier()
+    _classifier = classifier
+    processes = processes or os.cpu_count() or 4
+    count = 0
+    t0 = time.time()
+    # fork, so that the workers share the models loaded here
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'),
+                                                  initializer=_init_worker)
+    with open(output_path, 'a', encoding='utf-8') as out, pool:
+        pending = set()
+        while True:
+            # keep a bounded number of batches in flight, the file list can be huge
+            while len(pending) < 2 * processes:
+                batch = next(batches, None)
+                if not batch:
+                    break
+                pending.add(pool.submit(task, batch))
+            if not pending:
+                break
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                for row in future.result():
+                    out.write(json.dumps(row) + "\n")
+                    rows.append(row)
+                    count += 1
+            out.flush()
+            log.info("%d PDFs classified, %.1f per sec" % (count, count / (time.time() - t0)))
+    return rows
+
+
+def confusion_matrices(rows):
+    """
+    :param rows: result maps with label research or other; others are ignored
+    :return: map of model to {"tp", "fn", "fp", "tn", "no_score"}, and map of "model1/model2" to
+        {"agree", "disagree"}; a score of exactly 0.5 (no confidence) counts as no score.
+    """
+    matrices = {}
+    agreement = {}
+    for row in rows:
+        if row.get("label") not in ("research", "other"):
+            continue
+        predicted = {}
+        for model in MODELS:
+            if model not in row:
+                continue
+            m = matrices.setdefault(model, {"tp": 0, "fn": 0, "fp": 0, "tn": 0, "no_score": 0})
+            if row[model] == 0.5:
+                m["no_score"] += 1
+                continue
+            predicted[model] = row[model] > 0.5
+            if row["label"] == "research":
+                m["tp" if predicted[model] else "fn"] += 1
+            else:
+                m["fp" if predicted[model] else "tn"] += 1
+        for model1, model2 in itertools.combinations([m for m in MODELS[:3] if m in predicted], 2):
+            a = agreement.setdefault(model1 + "/" + model2, {"agree": 0, "disagree": 0})
+            a["agree" if predicted[model1] == predicted[model2] else "disagree"] += 1
+    return matrices, agreement
+
+
+def format_confusion_matrices(matrices, agreement):
+    """
+    :return: printable text of the confusion_matrices results
+    """
+    lines = []
+    for model in MODELS:
+        if model not in matrices:
+            continue
+        m = matrices[model]
+        total = m["tp"] + m["fn"] + m["fp"] + m["tn"]
+        accuracy = (m["tp"] + m["tn"]) / total if total else 0.0
+        lines.append("%s  (accuracy %.4f of %d, %d without score)" % (model, accuracy, total, m["no_score"]))
+        lines.append("                  predicted research  predicted other")
+        lines.append("  actual research   %16d  %15d" % (m["tp"], m["fn"]))
+        lines.append("  actual other      %16d  %15d" % (m["fp"], m["tn"]))
+    for pair, a in sorted(agreement.items()):
+        total = a["agree"] + a["disagree"]
+        lines.append("%s agree on %.4f of %d" % (pair, a["agree"] / total if total else 0.0, total))
+    return "\n".join(lines)
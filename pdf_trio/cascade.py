@@ -0,0 +1,216 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Cascade of classifiers for the auto mode, declared as JSON (see AUTO_CASCADE):
+
+    {
+      "url": [{"classifier": "urlmeta", "uncertain": [0.1, 0.9], "cost_ms": 1}],
+      "text": [{"classifier": "linear", "uncertain": [0.15, 0.85], "cost_ms": 5},
+               {"classifier": "bert", "cost_ms": 250}],
+      "no_text": [{"classifier": "image", "cost_ms": 400}],
+      "extract_text_cost_ms": 100
+    }
+
+The url stages run first, for PDFs whose source URL was given, before anything is extracted.
+Then the text stages run for PDFs with text, the no_text stages for the others. A PDF goes on
+to the next stage only while the confidence of the last stage is within its uncertain range
+(inclusive); a stage without one is final. The costs are estimates of the compute per PDF,
+used to report the expected cost per PDF of the cascade as it runs.
+"""
+
+import os
+import json
+import logging
+import threading
+import collections
+
+from pdf_trio import metrics
+
+log = logging.getLogger(__name__)
+
+# the classifiers a stage of each cascade can use, and their default costs in msec
+CASCADE_CLASSIFIERS = collections.OrderedDict([
+    ("url", ("urlmeta",)),
+    ("text", ("linear", "bert", "image")),
+    ("no_text", ("image",)),
+])
+DEFAULT_COSTS_MS = {"urlmeta": 1.0, "linear": 5.0, "bert": 250.0, "image": 400.0}
+
+# fastText first, BERT if that is not sure; the image model when there is no text
+DEFAULT_CASCADE = {
+    "url": [],
+    "text": [{"classifier": "linear", "uncertain": [0.15, 0.85]}, {"classifier": "bert"}],
+    "no_text": [{"classifier": "image"}],
+}
+
+
+class Stage(collections.namedtuple('Stage', 'classifier uncertain cost_ms')):
+    """
+    :param classifier: urlmeta, linear, bert or image
+    :param uncertain: (low, high) confidences that go on to the next stage, or None if final
+    :param cost_ms: estimated compute per PDF
+    """
+
+    def is_uncertain(self, confidence):
+        return self.uncertain is not None and self.uncertain[0] <= confidence <= self.uncertain[1]
+
+
+class CascadePolicy:
+
+    def __init__(self, cascades, extract_text_cost_ms=100.0):
+        """
+        :param cascades: map of url, text and no_text to lists of Stage
+        :param extract_text_cost_ms: estimated cost of text extraction per PDF
+        """
+        for name in cascades:
+            if name not in CASCADE_CLASSIFIERS:
+                raise ValueError("unknown cascade %s, use one of %s" % (name, ", ".join(CASCADE_CLASSIFIERS)))
+        self.cascades = {name: list(cascades.get(name, [])) for name in CASCADE_CLASSIFIERS}
+        for name, stages in self.cascades.items():
+            for stage in stages:
+                if stage.classifier not in CASCADE_CLASSIFIERS[name]:
+                    raise ValueError("classifier %s cannot be used in the %s cascade" % (stage.classifier, name))
+                if stage.uncertain is not None and not 0.0 <= stage.uncertain[0] <= stage.uncertain[1] <= 1.0:
+                    raise ValueError("uncertain range of %s must be [low, high] within [0, 1]" % stage.classifier)
+        self.extract_text_cost_ms = extract_text_cost_ms
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.cost_total_ms = 0.0
+
+    @staticmethod
+    def from_json(policy_map):
+        """
+        :param policy_map: map as in the module doc
+        :return: CascadePolicy
+        """
+        try:
+            cascades = {}
+            for name, stage_maps in policy_map.items():
+                if name == "extract_text_cost_ms":
+                    continue
+                cascades[name] = []
+                for stage_map in stage_maps:
+                    classifier = stage_map["classifier"]
+                    uncertain = stage_map.get("uncertain")
+                    cascades[name].append(Stage(
+                        classifier,
+                        (float(uncertain[0]), float(uncertain[1])) if uncertain is not None else None,
+                        float(stage_map.get("cost_ms", DEFAULT_COSTS_MS.get(classifier, 0.0)))))
+            return CascadePolicy(cascades, float(policy_map.get("extract_text_cost_ms", 100.0)))
+        except (KeyError, TypeError, IndexError, AttributeError) as e:
+            raise ValueError("invalid cascade policy %s: %r" % (json.dumps(policy_map), e))
+
+    def to_json(self):
+        policy_map = {name: [{"classifier": s.classifier, "uncertain": list(s.uncertain) if s.uncertain else None,
+                              "cost_ms": s.cost_ms} for s in stages]
+                      for name, stages in self.cascades.items()}
+        policy_map["extract_text_cost_ms"] = self.extract_text_cost_ms
+        return policy_map
+
+    def fingerprint(self):
+        """
+        :return: string that differs for policies that can give different results, for cache keys
+        """
+        return json.dumps({name: [[s.classifier, s.uncertain] for s in stages]
+                           for name, stages in self.cascades.items()}, sort_keys=True)
+
+    def stages(self, name):
+        """
+        :param name: url, text or no_text
+        :return: list of Stage
+        """
+        return self.cascades[name]
+
+    def text_classifiers(self):
+        """
+        :return: the text classifiers used, which the text extraction must provide for
+        """
+        return [s.classifier for s in self.cascades["text"] if s.classifier in ("linear", "bert")]
+
+    def speculative_image(self):
+        """
+        :return: whether the page 0 image of a PDF without text goes to the image model first,
+            so that it can be rendered while the text is extracted
+        """
+        return bool(self.cascades["no_text"]) and self.cascades["no_text"][0].classifier == "image"
+
+    def advance(self, stage, jobs):
+        """
+        Record that the stage ran for the jobs.
+        :param stage: Stage
+        :param jobs: list of _PdfJob
+        :return: the jobs that go on to the next stage
+        """
+        ret = []
+        for job in jobs:
+            job.path.append(stage.classifier)
+            job.cost_ms += stage.cost_ms
+            if stage.is_uncertain(job.results.get(stage.classifier, 0.5)):
+                ret.append(job)
+            else:
+                job.decided = True
+        return ret
+
+    def record(self, jobs):
+        """
+        Count the paths taken and the estimated compute of the jobs, once they are classified.
+        """
+        with self.lock:
+            for job in jobs:
+                self.counts["pdfs"] += 1
+                for classifier in job.path:
+                    self.counts[classifier] += 1
+                self.cost_total_ms += job.cost_ms
+        for job in jobs:
+            metrics.AUTO_PATH.labels(path="_".join(job.path) or "none").inc()
+            metrics.AUTO_COST.inc(job.cost_ms / 1000.0)
+
+    def stats(self):
+        """
+        :return: map of PDFs classified, fraction of them that went through each classifier
+            and the expected (mean) compute per PDF in msec
+        """
+        with self.lock:
+            pdfs = self.counts["pdfs"]
+            stats_map = {
+                "pdfs": pdfs,
+                "expected_cost_ms": self.cost_total_ms / pdfs if pdfs else 0.0,
+            }
+            for classifier, count in self.counts.items():
+                if classifier != "pdfs":
+                    stats_map[classifier + "_rate"] = count / pdfs
+            return stats_map
+
+
+def cascade_policy_from_env():
+    """
+    :return: CascadePolicy of env var AUTO_CASCADE, JSON text or the path of a JSON file, or the
+        default cascade if unset
+    """
+    value = os.environ.get('AUTO_CASCADE', '').strip()
+    if not value:
+        return CascadePolicy.from_json(DEFAULT_CASCADE)
+    if not value.startswith(("{", "[")):
+        with open(value) as f:
+            value = f.read()
+    try:
+        policy_map = json.loads(value)
+    except ValueError as e:
+        raise ValueError("AUTO_CASCADE is not valid JSON: %s" % e)
+    if not isinstance(policy_map, dict):
+        raise ValueError("AUTO_CASCADE must be a JSON object")
+    return CascadePolicy.from_json(policy_map)
@@ -0,0 +1,281 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Pool of long-lived extraction worker processes, see PDF_EXTRACT_PROCESSES.
+
+Once pdf_util.use_extract_pool is given a pool, the pdf_util extraction functions send each
+call to an idle worker process, which runs the same function and sends the result back. The
+workers are started fresh (not forked from the server), so they are small: the pdftotext and
+convert subprocesses are forked from them instead of from the server process with its
+models, and the in-process pdfium renderer, serialized by a lock within a process, runs in
+parallel across workers and keeps its state between PDFs. A worker is replaced after
+max_jobs calls, or when its memory grew over max_rss_mb, and is killed if a call takes more
+than timeout seconds (a backstop, the subprocesses have their usual 30 sec timeouts).
+
+Only the pdfium renderer (PDF_RASTERIZER=pdfium) is long-lived in a worker. pdftotext,
+pdfinfo and convert are still started once per PDF, with their library loading and font
+setup, and the worker adds a pipe round trip; for them the pool only isolates the server
+from runaway extractions. The pdftotext and convert text are what the models were trained
+on, so they are not replaced by in-process pdfium text. See the micro/extract_pool
+benchmarks of benchmarks/run_benchmarks.py for the cost on a given machine.
+"""
+
+import os
+import queue
+import atexit
+import shutil
+import logging
+import threading
+import collections
+import multiprocessing
+
+from pdf_trio import metrics
+from pdf_trio import admission
+
+log = logging.getLogger(__name__)
+
+# the pdf_util functions run by the workers, and what they return when nothing was extracted
+DISPATCHED = {
+    "extract_pdf_text": "",
+    "extract_pdf_image": "",
+    "extract_pdf_text_from_content": "",
+    "extract_pdf_image_from_content": b"",
+    "render_pdf_page0": None,
+}
+
+# subprocess timeouts in a worker are counted by the pool, see _timeout_counts
+TIMEOUT_COMMANDS = ("pdftotext", "pdfinfo", "convert")
+# seconds past the deadline of a call before its worker is killed
+DEADLINE_GRACE = 1.0
+
+
+class _Worker:
+
+    def __init__(self, ctx, tmp_area, max_jobs, max_rss_mb):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, tmp_area, max_jobs, max_rss_mb),
+                                   name="pdf-extract", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ExtractPool:
+
+    def __init__(self, workers=4, max_jobs=500, max_rss_mb=512, timeout=120.0):
+        """
+        :param workers: number of worker processes
+        :param max_jobs: calls handled by a worker before it is replaced
+        :param max_rss_mb: a worker whose resident memory exceeds this after a call is replaced
+        :param timeout: seconds to wait for a call before the worker is killed
+        """
+        self.workers = max(1, int(workers))
+        self.max_jobs = max(1, int(max_jobs))
+        self.max_rss_mb = max_rss_mb
+        self.timeout = timeout
+        self.ctx = multiprocessing.get_context('spawn')
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.counts = collections.Counter()
+        # workers are started on first use, so that a pool created before fork() works in the children
+        self.started_pid = None
+
+    def call(self, fn_name, *args):
+        """
+        Run the pdf_util function in a worker process.
+        :param fn_name: one of DISPATCHED
+        :param args: of the function, the last one is the admission.Deadline of the call
+        :return: what the function returns, or the empty result of DISPATCHED if the worker timed out or died;
+            either way not complete in the pdf_util.extraction_status() of the caller
+        :raise admission.DeadlineExceeded: when the deadline passes waiting for a worker or for the call
+        """
+        from pdf_trio import pdf_util
+        empty = DISPATCHED[fn_name]
+        deadline = args[-1] if args and isinstance(args[-1], admission.Deadline) else admission.NO_DEADLINE
+        self._start_workers()
+        try:
+            # no backstop here, a call waiting for a worker is not stuck
+            worker = self.idle.get(timeout=deadline.timeout(None, "extract_pool"))
+        except queue.Empty:
+            metrics.DEADLINES_EXCEEDED.labels(stage="extract_pool").inc()
+            raise admission.DeadlineExceeded("deadline passed waiting for an extraction worker for %s" % fn_name)
+        try:
+            timeout = deadline.timeout(self.timeout, "extract_pool")
+        except admission.DeadlineExceeded:
+            self.idle.put(worker)
+            raise
+        if timeout < self.timeout:
+            # the function stops at the deadline itself, a worker is only killed if it does not
+            timeout += DEADLINE_GRACE
+        try:
+            worker.conn.send((fn_name, args))
+            finished = worker.conn.poll(timeout)
+            reply = worker.conn.recv() if finished else None
+        except (EOFError, OSError) as e:
+            self._replace(worker, "deaths")
+            log.warning("extraction worker died during %s: %r" % (fn_name, e))
+            pdf_util.mark_incomplete()
+            return empty
+        except BaseException:
+            # the worker may still be busy with the call
+            self._replace(worker, "deaths")
+            raise
+        if not finished:
+            if deadline.expired():
+                self._replace(worker, "deadlines")
+                metrics.DEADLINES_EXCEEDED.labels(stage="extract_pool").inc()
+                raise admission.DeadlineExceeded("deadline passed during %s, worker killed" % fn_name)
+            self._replace(worker, "timeouts")
+            metrics.SUBPROCESS_TIMEOUTS.labels(command="extract_worker").inc()
+            log.warning("%s did not finish in %.0f seconds, worker killed" % (fn_name, self.timeout))
+            pdf_util.mark_incomplete()
+            return empty
+        ok, value, recycle, timeouts, complete = reply
+        if not complete:
+            pdf_util.mark_incomplete()
+        if recycle:
+            threading.Thread(target=self._recycle, args=(worker,), name="pdf-extract-recycle", daemon=True).start()
+        else:
+            self.idle.put(worker)
+        with self.lock:
+            self.counts["calls"] += 1
+        if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            # otherwise the worker has counted them in the shared dir
+            for command, count in timeouts.items():
+                metrics.SUBPROCESS_TIMEOUTS.labels(command=command).inc(count)
+        if not ok:
+            raise value
+        return value
+
+    def stats(self):
+        with self.lock:
+            stats_map = dict(self.counts)
+            stats_map["workers"] = self.workers
+            return stats_map
+
+    def close(self):
+        """
+        Stop the idle workers, for use at shutdown.
+        """
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            worker.kill()
+
+    def _new_worker(self):
+        from pdf_trio import pdf_util
+        return _Worker(self.ctx, pdf_util.tmp_area, self.max_jobs, self.max_rss_mb)
+
+    def _start_workers(self):
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+            self.idle = queue.Queue()
+            for _ in range(self.workers):
+                self.idle.put(self._new_worker())
+
+    def _replace(self, worker, reason):
+        worker.kill()
+        with self.lock:
+            self.counts[reason] += 1
+        self.idle.put(self._new_worker())
+
+    def _recycle(self, worker):
+        """
+        Replace a worker that exits after its last call.
+        """
+        with self.lock:
+            self.counts["recycled"] += 1
+        self.idle.put(self._new_worker())
+        worker.process.join()
+        worker.conn.close()
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        # peak, not current, but still grows with leaks
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _timeout_counts():
+    from prometheus_client import REGISTRY
+    return {command: REGISTRY.get_sample_value('pdf_trio_subprocess_timeouts_total', {'command': command}) or 0.0
+            for command in TIMEOUT_COMMANDS}
+
+
+def _worker_main(conn, tmp_area, max_jobs, max_rss_mb):
+    from pdf_trio import pdf_util
+    # use the tmp area of the server; the one made by importing pdf_util is not needed, and must
+    # not be removed at exit if it happens to be the same
+    atexit.unregister(pdf_util.exit_handler)
+    if pdf_util.tmp_area != tmp_area:
+        shutil.rmtree(pdf_util.tmp_area, ignore_errors=True)
+        pdf_util.tmp_area = tmp_area
+        pdf_util.tmp_path = pdf_util.pathlib.Path(tmp_area)
+    jobs = 0
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        fn_name, args = request
+        before = _timeout_counts()
+        with pdf_util.extraction_status() as status:
+            try:
+                ok, value = True, getattr(pdf_util, fn_name)(*args)
+            except Exception as e:
+                ok, value = False, e
+        jobs += 1
+        recycle = jobs >= max_jobs or _rss_mb() > max_rss_mb
+        after = _timeout_counts()
+        timeouts = {command: after[command] - before[command] for command in TIMEOUT_COMMANDS
+                    if after[command] != before[command]}
+        try:
+            conn.send((ok, value, recycle, timeouts, status.complete))
+        except Exception as e:
+            # like an exception that cannot be pickled
+            conn.send((False, RuntimeError("%s failed: %r" % (fn_name, value if not ok else e)), recycle, timeouts,
+                       status.complete))
+        if recycle:
+            return
+
+
+def extract_pool_from_env():
+    """
+    Build the pool according to env vars PDF_EXTRACT_PROCESSES (number of workers, 0 by default
+    for no pool), PDF_EXTRACT_PROCESS_MAX_JOBS (500), PDF_EXTRACT_PROCESS_MAX_RSS_MB (512) and
+    PDF_EXTRACT_PROCESS_TIMEOUT (120 sec).
+    :return: ExtractPool, or None if disabled
+    """
+    workers = int(os.environ.get('PDF_EXTRACT_PROCESSES', 0))
+    if workers <= 0:
+        return None
+    return ExtractPool(workers=workers,
+                       max_jobs=int(os.environ.get('PDF_EXTRACT_PROCESS_MAX_JOBS', 500)),
+                       max_rss_mb=float(os.environ.get('PDF_EXTRACT_PROCESS_MAX_RSS_MB', 512)),
+                       timeout=float(os.environ.get('PDF_EXTRACT_PROCESS_TIMEOUT', 120)))
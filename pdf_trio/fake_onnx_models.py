@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Tiny random-weight ONNX models with the signatures of the BERT and image models, for
+offline tests of TF_TRANSPORT=onnx (needs the onnx package):
+
+    python -m pdf_trio.fake_onnx_models /tmp/onnx_models
+
+BERT: int32 input_ids, input_mask and segment_ids of shape (batch, seq) in, for any seq up to
+512 like BERT_SEQ_BUCKETS needs, the mean of token embeddings over the mask through a dense
+layer and softmax out; like the attention mask of BERT, padding does not change the scores. Image: float32 image
+of shape (batch, 299, 299, 3) in, the mean color through a dense layer and softmax out.
+Both return "probabilities" of shape (batch, 2), [other, research] like the real models.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# token ids are taken modulo this, to keep the embedding table small
+VOCAB_SIZE = 1000
+EMBEDDING_SIZE = 8
+
+
+def _dense_softmax(helper, nodes, initializers, features, size, rng):
+    """
+    Append a dense layer of size inputs to 2 outputs and a softmax.
+    """
+    from onnx import numpy_helper
+    initializers.append(numpy_helper.from_array(rng.normal(0, 1, (size, 2)).astype(np.float32), "dense_w"))
+    initializers.append(numpy_helper.from_array(rng.normal(0, 0.1, 2).astype(np.float32), "dense_b"))
+    nodes.append(helper.make_node("MatMul", [features, "dense_w"], ["logits_w"]))
+    nodes.append(helper.make_node("Add", ["logits_w", "dense_b"], ["logits"]))
+    nodes.append(helper.make_node("Softmax", ["logits"], ["probabilities"], axis=1))
+
+
+def _save(helper, nodes, inputs, initializers, name, path):
+    import onnx
+    graph = helper.make_graph(nodes, name, inputs,
+                              [helper.make_tensor_value_info("probabilities", onnx.TensorProto.FLOAT, ["batch", 2])],
+                              initializer=initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # readable by older ONNX Runtime releases too
+    model.ir_version = 7
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+    return path
+
+
+def make_bert_model(path, seed=0):
+    """
+    :param path: where to write the .onnx file
+    :return: path
+    """
+    import onnx
+    from onnx import helper, numpy_helper
+    rng = np.random.RandomState(seed)
+    inputs = [helper.make_tensor_value_info(name, onnx.TensorProto.INT32, ["batch", "seq"])
+              for name in ("input_ids", "input_mask", "segment_ids")]
+    initializers = [
+        numpy_helper.from_array(np.array(VOCAB_SIZE, dtype=np.int32), "vocab_size"),
+        numpy_helper.from_array(rng.normal(0, 1, (VOCAB_SIZE, EMBEDDING_SIZE)).astype(np.float32), "embeddings"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "last_axis"),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), "seq_axis"),
+        numpy_helper.from_array(np.array(1.0, dtype=np.float32), "one"),
+    ]
+    nodes = [
+        helper.make_node("Mod", ["input_ids", "vocab_size"], ["token_ids"]),
+        helper.make_node("Gather", ["embeddings", "token_ids"], ["token_vectors"]),
+        helper.make_node("Cast", ["input_mask"], ["mask"], to=onnx.TensorProto.FLOAT),
+        helper.make_node("Unsqueeze", ["mask", "last_axis"], ["mask3"]),
+        helper.make_node("Mul", ["token_vectors", "mask3"], ["masked"]),
+        helper.make_node("ReduceSum", ["masked", "seq_axis"], ["summed"], keepdims=0),
+        helper.make_node("ReduceSum", ["mask3", "seq_axis"], ["counts"], keepdims=0),
+        helper.make_node("Max", ["counts", "one"], ["divisor"]),
+        helper.make_node("Div", ["summed", "divisor"], ["features"]),
+    ]
+    _dense_softmax(helper, nodes, initializers, "features", EMBEDDING_SIZE, rng)
+    return _save(helper, nodes, inputs, initializers, "tiny_bert", path)
+
+
+def make_image_model(path, input_name="image", seed=0):
+    """
+    :param path: where to write the .onnx file
+    :param input_name: name of the image input, like TF_IMAGE_INPUT_NAME
+    :return: path
+    """
+    import onnx
+    from onnx import helper, numpy_helper
+    rng = np.random.RandomState(seed)
+    inputs = [helper.make_tensor_value_info(input_name, onnx.TensorProto.FLOAT, ["batch", 299, 299, 3])]
+    initializers = [numpy_helper.from_array(np.array(1.0 / 255, dtype=np.float32), "scale")]
+    nodes = [
+        helper.make_node("ReduceMean", [input_name], ["colors"], axes=[1, 2], keepdims=0),
+        helper.make_node("Mul", ["colors", "scale"], ["features"]),
+    ]
+    _dense_softmax(helper, nodes, initializers, "features", 3, rng)
+    return _save(helper, nodes, inputs, initializers, "tiny_image", path)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: python -m pdf_trio.fake_onnx_models output_dir")
+        return 1
+    os.makedirs(sys.argv[1], exist_ok=True)
+    print("TF_BERT_ONNX_MODEL=%s" % make_bert_model(os.path.join(sys.argv[1], "bert_model.onnx")))
+    print("TF_IMAGE_ONNX_MODEL=%s" % make_image_model(os.path.join(sys.argv[1], "image_model.onnx")))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Local stand-in for tensorflow-serving predict, REST and gRPC, for offline tests and benchmarks.
+Every example gets the same [other, research] scores after an optional artificial latency.
+
+    python -m pdf_trio.fake_tf_serving --rest-port 8501 --grpc-port 8500 --latency-ms 20
+"""
+
+import json
+import time
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from pdf_trio import tf_transport
+
+log = logging.getLogger(__name__)
+
+
+class FakeTfServing:
+    """
+    Answers /v1/models/<name>:predict (REST) and PredictionService/Predict (gRPC) for any model name.
+    """
+
+    def __init__(self, scores=(0.1, 0.9), latency_ms=0.0, output_key="probabilities"):
+        """
+        :param scores: [other, research] returned for every example
+        :param latency_ms: sleep before answering each request
+        :param output_key: name of the gRPC output tensor
+        """
+        self.scores = list(scores)
+        self.latency = latency_ms / 1000.0
+        self.output_key = output_key
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.examples = 0
+        self.rest_server = None
+        self.grpc_server = None
+
+    def predict(self, batch_size):
+        """
+        :return: float32 array of shape (batch_size, 2)
+        """
+        with self.lock:
+            self.requests += 1
+            self.examples += batch_size
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return np.tile(np.asarray(self.scores, dtype=np.float32), (batch_size, 1))
+
+    def start_rest(self, port=0):
+        """
+        :param port: 0 picks a free port
+        :return: base API URL like http://127.0.0.1:8501/v1
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so that client connection pooling is exercised
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                # model status, as used for health checks
+                self._reply(200, {"model_version_status": [{"version": "1", "state": "AVAILABLE"}]})
+
+            def do_POST(self):
+                if not self.path.endswith(":predict"):
+                    self._reply(404, {"error": "unknown path " + self.path})
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if "instances" in body:
+                    predictions = fake.predict(len(body["instances"]))
+                    self._reply(200, {"predictions": predictions.tolist()})
+                elif "inputs" in body:
+                    first = list(body["inputs"].values())[0]
+                    outputs = fake.predict(len(first))
+                    self._reply(200, {"outputs": outputs.tolist()})
+                else:
+                    self._reply(400, {"error": "missing inputs or instances"})
+
+            def _reply(self, status, obj):
+                data = json.dumps(obj).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        self.rest_server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.rest_server.daemon_threads = True
+        threading.Thread(target=self.rest_server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:%d/v1" % self.rest_server.server_address[1]
+
+    def start_grpc(self, port=0, workers=8):
+        """
+        :param port: 0 picks a free port
+        :return: target like 127.0.0.1:8500
+        """
+        import grpc
+        from concurrent import futures
+
+        def predict(request, context):
+            _, _, inputs = tf_transport.decode_predict_request(request)
+            batch_size = len(list(inputs.values())[0]) if inputs else 0
+            return tf_transport.encode_predict_response({self.output_key: self.predict(batch_size)})
+
+        handler = grpc.method_handlers_generic_handler("tensorflow.serving.PredictionService", {
+            "Predict": grpc.unary_unary_rpc_method_handler(predict),
+        })
+        self.grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+        self.grpc_server.add_generic_rpc_handlers((handler,))
+        bound_port = self.grpc_server.add_insecure_port("127.0.0.1:%d" % port)
+        self.grpc_server.start()
+        return "127.0.0.1:%d" % bound_port
+
+    def stop(self):
+        if self.rest_server:
+            self.rest_server.shutdown()
+            self.rest_server.server_close()
+            self.rest_server = None
+        if self.grpc_server:
+            self.grpc_server.stop(0)
+            self.grpc_server = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rest-port", type=int, default=8501, help="REST port, 0 to disable")
+    parser.add_argument("--grpc-port", type=int, default=0, help="gRPC port, 0 to disable")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="artificial latency per request")
+    parser.add_argument("--research", type=float, default=0.9, help="research score returned for every example")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeTfServing(scores=(1.0 - args.research, args.research), latency_ms=args.latency_ms)
+    if args.rest_port:
+        print("REST predict at %s" % fake.start_rest(args.rest_port))
+    if args.grpc_port:
+        print("gRPC predict at %s" % fake.start_grpc(args.grpc_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Store of the model independent features extracted from PDFs, see FEATURE_STORE_DIR.
+
+Unlike the result cache, whose entries are dropped by any model version change, the features
+(cleaned tokens, BERT token ids, the page 0 image) depend only on the PDF and the extraction
+settings, so re-scoring PDFs with a new model skips pdftotext and convert. Each feature is a
+.npy file named by the SHA-1 of the PDF, the kind of feature and a hash of the settings it was
+extracted with; the files are memory-mapped when read. Files are written to a tmp name and
+renamed, so processes sharing the directory never see partial files.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import collections
+
+import numpy as np
+
+from pdf_trio import metrics
+
+log = logging.getLogger(__name__)
+
+KINDS = ("tokens", "bert_ids", "page0")
+
+
+class FeatureStore:
+
+    def __init__(self, root):
+        """
+        :param root: directory of the feature files, created if needed
+        """
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def path(self, content_sha1, kind, variant):
+        """
+        :param content_sha1: SHA-1 hex digest of the PDF bytes
+        :param kind: one of KINDS
+        :param variant: the extraction settings the feature depends on
+        :return: path of the feature file
+        """
+        variant_sha1 = hashlib.sha1(variant.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, content_sha1[:2], "%s.%s.%s.npy" % (content_sha1, kind, variant_sha1))
+
+    def get_array(self, content_sha1, kind, variant):
+        """
+        :return: the stored array, memory-mapped and read-only, or None
+        """
+        try:
+            array = np.load(self.path(content_sha1, kind, variant), mmap_mode='r', allow_pickle=False)
+        except FileNotFoundError:
+            self._count(kind, "miss")
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("unreadable %s feature of %s: %s" % (kind, content_sha1, e))
+            self._count(kind, "miss")
+            return None
+        self._count(kind, "hit")
+        return array
+
+    def put_array(self, content_sha1, kind, variant, array):
+        """
+        Store the array; failures are logged, as the feature can always be extracted again.
+        """
+        path = self.path(content_sha1, kind, variant)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("could not store %s feature of %s: %s" % (kind, content_sha1, e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._count(kind, "put")
+
+    def get_tokens(self, content_sha1, variant):
+        """
+        :return: the stored token list, or None
+        """
+        array = self.get_array(content_sha1, "tokens", variant)
+        if array is None:
+            return None
+        if len(array) == 0:
+            return []
+        # tokens never contain whitespace, see text_prep.extract_tokens
+        return array.tobytes().decode('utf-8').split('\n')
+
+    def put_tokens(self, content_sha1, variant, tokens):
+        """
+        :param tokens: token list, empty for a PDF with too little text
+        """
+        self.put_array(content_sha1, "tokens", variant,
+                       np.frombuffer('\n'.join(tokens).encode('utf-8'), dtype=np.uint8))
+
+    def stats(self):
+        with self.lock:
+            stats_map = dict(self.counts)
+            stats_map["dir"] = self.root
+            return stats_map
+
+    def _count(self, kind, result):
+        with self.lock:
+            self.counts["%s_%s" % (kind, "misses" if result == "miss" else result + "s")] += 1
+        metrics.FEATURE_STORE_OPS.labels(kind=kind, result=result).inc()
+
+
+def feature_store_from_env():
+    """
+    Build the store according to env var FEATURE_STORE_DIR, unset by default.
+    :return: FeatureStore, or None if disabled
+    """
+    root = os.environ.get('FEATURE_STORE_DIR')
+    if not root:
+        return None
+    return FeatureStore(root)
@@ -0,0 +1,73 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+gunicorn settings for the pre-fork server mode:
+
+    gunicorn -c python:pdf_trio.gunicorn_conf
+
+The master process loads the app, and so the fastText models and BERT vocab, once; the
+workers are forked from it and share the model memory copy-on-write. Each worker creates its
+own thread pools and tensorflow-serving connections, then warms up the models in the
+background; GET /ready answers 200 once that has worked. Workers are recycled after
+API_MAX_REQUESTS requests. kill -HUP of the master replaces the workers (same models);
+to load new models or code, start a new master with kill -USR2, then stop the old one
+with kill -TERM once the new workers are ready.
+"""
+
+import os
+import gc
+import threading
+
+wsgi_app = "pdf_trio:create_app()"
+bind = os.environ.get('API_BIND', '0.0.0.0:3939')
+# load the models in the master, before forking
+preload_app = True
+workers = int(os.environ.get('API_WORKERS', os.cpu_count() or 1))
+# the work is done by subprocesses and tensorflow-serving, so threads keep a worker busy
+worker_class = 'gthread'
+threads = int(os.environ.get('API_THREADS', 8))
+# recycle a worker after this many requests (plus up to the jitter, so that workers do not
+# all restart together), which bounds leaks and copy-on-write growth; 0 to never recycle
+max_requests = int(os.environ.get('API_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('API_MAX_REQUESTS_JITTER', max_requests // 10))
+# seconds, a huge batch upload can take a while
+timeout = int(os.environ.get('API_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('API_GRACEFUL_TIMEOUT', 60))
+accesslog = os.environ.get('API_ACCESS_LOG') or None
+
+
+def when_ready(server):
+    # the objects of the loaded app are never freed, so keep the collector of each worker
+    # from touching them, which would copy their pages
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from pdf_trio import api_routes
+    api_routes.after_fork()
+
+
+def post_worker_init(worker):
+    from pdf_trio import api_routes
+    threading.Thread(target=api_routes.warm_up, name="warm-up", daemon=True).start()
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,79 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Prometheus metrics, served at /metrics.
+
+With several worker processes, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by
+the workers so that /metrics reports the sum over all of them.
+"""
+
+import os
+
+import prometheus_client
+from prometheus_client import multiprocess, CollectorRegistry, Counter, Histogram
+
+# seconds, up to the 30 sec subprocess and tensorflow-serving timeouts
+STAGE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+STAGE_SECONDS = Histogram(
+    'pdf_trio_stage_seconds', 'Time spent per PDF classification stage', ['stage'], buckets=STAGE_BUCKETS)
+AUTO_PATH = Counter(
+    'pdf_trio_auto_path_total', 'PDFs classified in auto mode, by the classifiers used', ['path'])
+AUTO_COST = Counter(
+    'pdf_trio_auto_estimated_cost_seconds_total', 'Compute of auto mode, estimated from the cascade stage costs')
+SUBPROCESS_TIMEOUTS = Counter(
+    'pdf_trio_subprocess_timeouts_total', 'pdftotext and convert runs killed for taking too long', ['command'])
+BACKEND_ERRORS = Counter(
+    'pdf_trio_backend_errors_total', 'Failed tensorflow-serving requests, whose examples got 0.5', ['model'])
+REQUESTS_REJECTED = Counter(
+    'pdf_trio_requests_rejected_total', 'Requests answered 429 by admission control', ['reason'])
+DEADLINES_EXCEEDED = Counter(
+    'pdf_trio_deadlines_exceeded_total', 'Requests failed for their deadline, by the stage it passed in', ['stage'])
+BERT_EXAMPLES = Counter(
+    'pdf_trio_bert_examples_total', 'Examples sent to the BERT model, by the sequence length padded to', ['seq_len'])
+FEATURE_STORE_OPS = Counter(
+    'pdf_trio_feature_store_total', 'Feature store lookups and writes, by feature kind and outcome', ['kind', 'result'])
+NEAR_DUP_LOOKUPS = Counter(
+    'pdf_trio_near_dup_lookups_total', 'Near-duplicate lookups of text classifier scores, by outcome',
+    ['classifier', 'result'])
+CACHE_LOOKUPS = Counter(
+    'pdf_trio_result_cache_lookups_total', 'Result cache lookups, by outcome', ['result'])
+
+
+def stage(name):
+    """
+    Time a stage into STAGE_SECONDS:
+
+        with metrics.stage("extract_text"):
+            ...
+
+    :param name: one of upload_save, extract_text, extract_tokens, linear_predict, bert_features,
+        bert_request, extract_image, image_preprocess, image_request
+    """
+    return STAGE_SECONDS.labels(stage=name).time()
+
+
+def generate():
+    """
+    :return: metrics in the Prometheus text format, and its content type
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,219 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Reuse of text classifier scores for near-duplicate PDFs, see NEAR_DUP_INDEX_SIZE.
+
+The same paper comes as many byte-different PDFs (publisher copy, preprint, watermarked
+mirror), which the result cache keyed by the PDF hash cannot match. Here a PDF is known by
+the MinHash signature of the word shingles of its cleaned tokens. Signatures of recently
+classified PDFs are kept in an LSH index (bands of the signature as hash keys), so that the
+candidates for a new PDF are found without comparing it to every entry; a candidate whose
+estimated Jaccard similarity reaches the threshold gives its linear and BERT scores, when
+they came from the model versions in use.
+"""
+
+import os
+import zlib
+import logging
+import threading
+import collections
+
+import numpy as np
+
+from pdf_trio import metrics
+from pdf_trio import text_prep
+
+log = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 61) - 1
+# the signature is of the first and last tokens, like BERT gets, which are about the same
+# whatever pages the text was extracted from
+SIGNATURE_TOKENS = 512
+# fewer distinct shingles than this give no reliable signature
+MIN_SHINGLES = 20
+
+
+class MinHasher:
+
+    def __init__(self, num_perm=128, shingle_size=3, seed=1):
+        """
+        :param num_perm: number of hash functions, the length of a signature
+        :param shingle_size: tokens per shingle
+        :param seed: of the hash functions; signatures are comparable only with the same seed
+        """
+        rng = np.random.RandomState(seed)
+        # a * x + b mod p, with x a 32-bit hash, stays within 64 bits
+        self.a = rng.randint(1, 1 << 31, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, num_perm).astype(np.uint64)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+    def signature(self, tokens):
+        """
+        :param tokens: cleaned token list
+        :return: uint64 array of num_perm values, None if there are too few tokens
+        """
+        k = self.shingle_size
+        shingles = set(" ".join(tokens[j:j + k]) for j in range(max(0, len(tokens) - k + 1)))
+        if len(shingles) < MIN_SHINGLES:
+            return None
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+        signature = np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        for offset in range(0, len(hashes), 1024):
+            values = (np.outer(self.a, hashes[offset:offset + 1024]) + self.b[:, None]) % MERSENNE_PRIME
+            np.minimum(signature, values.min(axis=1), out=signature)
+        return signature
+
+
+def similarity(signature1, signature2):
+    """
+    :return: estimated Jaccard similarity of the shingle sets
+    """
+    return float(np.count_nonzero(signature1 == signature2)) / len(signature1)
+
+
+class _Entry:
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.scores = {}  # classifier -> (model version, encoded confidence)
+
+
+class NearDupIndex:
+    """
+    Bounded LRU of signatures and their scores, with an LSH index over signature bands.
+    With 16 bands of 8 values, PDFs of similarity 0.9 share a band (and are compared) with
+    probability 0.998, those of similarity 0.5 with 0.06.
+    """
+
+    def __init__(self, max_entries=100000, threshold=0.9, num_perm=128, bands=16):
+        """
+        :param max_entries: signatures kept, the least recently used are evicted
+        :param threshold: min estimated Jaccard similarity of a near-duplicate
+        :param num_perm: signature length, a multiple of bands
+        :param bands: LSH bands
+        """
+        if num_perm % bands:
+            raise ValueError("signature length %d is not a multiple of %d bands" % (num_perm, bands))
+        self.hasher = MinHasher(num_perm)
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.entries = collections.OrderedDict()  # signature bytes -> _Entry
+        self.buckets = collections.defaultdict(set)  # (band, band bytes) -> signature bytes
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def signature(self, tokens):
+        """
+        :param tokens: cleaned token list of a PDF
+        :return: its signature, None if too short for one
+        """
+        return self.hasher.signature(text_prep.trim_tokens(tokens, SIGNATURE_TOKENS))
+
+    def lookup(self, signature, classifier, version):
+        """
+        :param signature: of the PDF, or None
+        :param classifier: linear or bert
+        :param version: of the model in use
+        :return: encoded confidence of the most similar known PDF scored by that model version,
+            None if there is no near-duplicate
+        """
+        best = None
+        best_similarity = self.threshold
+        confidence = None
+        with self.lock:
+            if signature is not None:
+                for key in self._candidates(signature):
+                    entry = self.entries[key]
+                    if entry.scores.get(classifier, (None,))[0] != version:
+                        continue
+                    s = similarity(signature, entry.signature)
+                    if s >= best_similarity:
+                        best, best_similarity = key, s
+            result = "match" if best is not None else "miss"
+            self.counts[classifier + "_lookups"] += 1
+            if best is not None:
+                self.counts[classifier + "_matches"] += 1
+                self.entries.move_to_end(best)
+                confidence = self.entries[best].scores[classifier][1]
+        metrics.NEAR_DUP_LOOKUPS.labels(classifier=classifier, result=result).inc()
+        return confidence
+
+    def add(self, signature, classifier, version, confidence):
+        """
+        Remember the score of a PDF.
+        :param signature: of the PDF, or None, then nothing is remembered
+        """
+        if signature is None or self.max_entries <= 0:
+            return
+        key = signature.tobytes()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = _Entry(signature)
+                for band_key in self._band_keys(signature):
+                    self.buckets[band_key].add(key)
+            self.entries.move_to_end(key)
+            entry.scores[classifier] = (version, confidence)
+            while len(self.entries) > self.max_entries:
+                self._evict()
+
+    def stats(self):
+        with self.lock:
+            stats_map = dict(self.counts)
+            for classifier in ("linear", "bert"):
+                lookups = self.counts[classifier + "_lookups"]
+                stats_map[classifier + "_match_rate"] = (self.counts[classifier + "_matches"] / lookups) if lookups else 0.0
+            stats_map["entries"] = len(self.entries)
+            return stats_map
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(len(signature) // self.rows)]
+
+    def _candidates(self, signature):
+        # caller holds self.lock
+        keys = set()
+        for band_key in self._band_keys(signature):
+            keys.update(self.buckets.get(band_key, ()))
+        return keys
+
+    def _evict(self):
+        # caller holds self.lock
+        key, entry = self.entries.popitem(last=False)
+        for band_key in self._band_keys(entry.signature):
+            bucket = self.buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[band_key]
+        self.counts["evictions"] += 1
+
+
+def near_dup_index_from_env():
+    """
+    Build the index according to env vars NEAR_DUP_INDEX_SIZE (signatures kept, 0 by default
+    for no near-duplicate reuse) and NEAR_DUP_THRESHOLD (min similarity, 0.9 by default).
+    :return: NearDupIndex, or None if disabled
+    """
+    max_entries = int(os.environ.get('NEAR_DUP_INDEX_SIZE', 0))
+    if max_entries <= 0:
+        return None
+    threshold = float(os.environ.get('NEAR_DUP_THRESHOLD', 0.9))
+    if not 0.0 < threshold <= 1.0:
+        raise ValueError('NEAR_DUP_THRESHOLD must be in (0, 1], got %s' % threshold)
+    return NearDupIndex(max_entries=max_entries, threshold=threshold)
@@ -22,24 +22,108 @@ Inference drivers for CNN, FastText, and BERT for PDF classification here.
 import os
 import time
 import json
+import hashlib
 import logging
 import argparse
+import functools
+import itertools
 import subprocess
+import collections
+import concurrent.futures
 
 from cv2 import cv2  # pip install opencv-python  to get this
 import numpy as np
-import requests
 import fasttext
 from fasttext import load_model
 
 from pdf_trio import text_prep
 from pdf_trio import pdf_util
+from pdf_trio import batcher
+from pdf_trio import tf_transport
+from pdf_trio import result_cache
+from pdf_trio import feature_store
+from pdf_trio import near_dup
+from pdf_trio import single_flight
+from pdf_trio import vocab_index
+from pdf_trio import cascade
+from pdf_trio import extract_pool
+from pdf_trio import admission
+from pdf_trio import metrics
 
 
 
 log = logging.getLogger(__name__)
 
 
+class _PdfJob:
+    """
+    State of one PDF while a batch goes through extraction and classification.
+    """
+
+    def __init__(self, name, pdf_content, tmp_pdf_name=None, cache_key=None, url=None,
+                 deadline=admission.NO_DEADLINE):
+        self.name = name
+        self.pdf_content = pdf_content
+        self.tmp_pdf_name = tmp_pdf_name  # None when extracting in memory
+        self.cache_key = cache_key
+        self.url = url  # where the PDF was found, if known
+        self.deadline = deadline  # admission.Deadline of the request
+        self._content_sha1 = None
+        self.token_list = []
+        self.token_policy = None  # pdf_util.TextPolicy token_list was extracted with
+        self.signature = None  # near_dup signature of token_list, once computed
+        self.flight = None  # single_flight future to finish, if other requests may wait for the results
+        self.jpg_page0 = ""  # tmp jpg file name, or jpg bytes when extracting in memory, or image array
+        self.results = {}
+        self.confidence_values = []
+        # auto mode: classifiers run so far, whether a stage was confident, estimated compute
+        self.path = []
+        self.decided = False
+        self.cost_ms = 0.0
+
+    @property
+    def content_sha1(self):
+        # only hashed when the feature store is used
+        if self._content_sha1 is None:
+            self._content_sha1 = hashlib.sha1(self.pdf_content).hexdigest()
+        return self._content_sha1
+
+    def add_result(self, classifier, confidence):
+        self.results[classifier] = confidence
+        self.confidence_values.append(confidence)
+
+    def results_map(self, version_map):
+        results = {"version": version_map}
+        results.update(self.results)
+        #  compute 'is_research' using confidence_values
+        if len(self.confidence_values) != 0:
+            confidence_overall = sum(self.confidence_values) / len(self.confidence_values)
+            # insert confidence_overall
+            results["is_research"] = confidence_overall
+        return results
+
+    def cacheable(self):
+        # a back-end failure shows up as the exact 0.5 default, which must not be remembered
+        return all(confidence != 0.5 for confidence in self.results.values())
+
+
+def bert_seq_buckets_from_env():
+    """
+    :return: sorted sequence lengths of env var BERT_SEQ_BUCKETS (comma sep, like 64,128,256,512),
+        always ending with 512; just 512 by default
+    """
+    value = os.environ.get('BERT_SEQ_BUCKETS', '512')
+    try:
+        buckets = sorted(set(int(b) for b in value.split(',') if b.strip()))
+    except ValueError:
+        raise ValueError('BERT_SEQ_BUCKETS must be comma sep sequence lengths, got %r' % value)
+    if any(b <= 0 or b > 512 for b in buckets):
+        raise ValueError('BERT_SEQ_BUCKETS lengths must be between 1 and 512, got %r' % value)
+    if not buckets or buckets[-1] != 512:
+        buckets.append(512)
+    return buckets
+
+
 class PdfClassifier:
 
 
@@ -51,27 +135,33 @@ class PdfClassifier:
             "bert": "20190923T2215",
             "urlmeta": "20190722"
         }
-        self.json_content_header = {"Content-Type": "application/json"}
 
-        image_server_prefix = os.environ.get('TF_IMAGE_SERVER_URL')
-        if not image_server_prefix:
+        # no tensorflow-serving when the models run in-process, see TF_TRANSPORT
+        in_process = os.environ.get('TF_TRANSPORT', 'rest') == 'onnx'
+        image_server_prefix = os.environ.get('TF_IMAGE_SERVER_URL', '')
+        if not image_server_prefix and not in_process:
             raise ValueError('Missing TF image classifier URL config, ' +
                 'define env var TF_IMAGE_SERVER_URL')
+        self.image_server_prefix = image_server_prefix
         self.image_tf_server_url = image_server_prefix + "/models/image_model:predict"
 
-        bert_server_prefix = os.environ.get('TF_BERT_SERVER_URL')
-        if not bert_server_prefix :
+        bert_server_prefix = os.environ.get('TF_BERT_SERVER_URL', '')
+        if not bert_server_prefix and not in_process:
             raise ValueError('Missing TF BERT classifier URL config, ' +
                 'define env var TF_BERT_SERVER_URL')
+        self.bert_server_prefix = bert_server_prefix
         self.bert_tf_server_url = bert_server_prefix + "/models/bert_model:predict"
 
+        self.image_input_name = os.environ.get('TF_IMAGE_INPUT_NAME', 'image')
+
         vocab_path = os.environ.get('TF_BERT_VOCAB_PATH')
         if not vocab_path:
             raise ValueError('TF_BERT_VOCAB_PATH is not set to the path to vocab.txt')
         if not os.path.exists(vocab_path) and os.path.isfile(vocab_path):
             raise ValueError('TF_BERT_VOCAB_PATH target does not exist: %s' % vocab_path)
         log.warning("Loading BERT model vocabulary...")
-        self.bert_vocab = text_prep.load_bert_vocab(vocab_path)
+        # memory-mapped index shared by all processes, see TF_BERT_VOCAB_INDEX
+        self.bert_vocab = vocab_index.load_vocab_index(vocab_path, os.environ.get('TF_BERT_VOCAB_INDEX'))
 
         model_path = os.environ.get('FT_MODEL')
         if not model_path:
@@ -80,7 +170,106 @@ class PdfClassifier:
         log.warning("Loading fasttext model...")
         self.fasttext_model = fasttext.load_model(model_path)
 
-    def classify_pdf_multi(self, modes, pdf_filestorage):
+        # pipe PDFs through pdftotext and convert instead of writing tmp files
+        self.extract_in_memory = os.environ.get('PDF_EXTRACT_IN_MEMORY', '0') not in ('', '0')
+        # page 0 image by ImageMagick convert (as in training), or rendered in-process by pdfium
+        self.rasterizer = os.environ.get('PDF_RASTERIZER', 'convert')
+        if self.rasterizer not in ('convert', 'pdfium'):
+            raise ValueError('unknown PDF_RASTERIZER %s, use convert or pdfium' % self.rasterizer)
+        # pdftotext and convert run as subprocesses, so threads are enough to run them in parallel
+        self.extract_workers = int(os.environ.get('PDF_EXTRACT_WORKERS', os.cpu_count() or 4))
+        # in auto mode, start rendering page 0 together with text extraction, see AUTO_SPECULATIVE_IMAGE
+        self.speculative_image = os.environ.get('AUTO_SPECULATIVE_IMAGE', '0') not in ('', '0')
+        # pages and token budget of the text each text classifier gets, see LINEAR_HEAD_PAGES etc.;
+        # all of the text by default, one pdftotext run per PDF; BERT sees no more than 512
+        # tokens, the first and last 256 of the text
+        self.text_policies = {
+            "linear": pdf_util.text_policy_from_env('LINEAR'),
+            "bert": pdf_util.text_policy_from_env('BERT', max_tokens=512),
+        }
+        self.bert_max_tokens = min(self.text_policies["bert"].max_tokens or 512, 512)
+        # sequence lengths BERT examples are padded to, see BERT_SEQ_BUCKETS
+        self.bert_seq_buckets = bert_seq_buckets_from_env()
+        # extracted tokens, BERT ids and page 0 images by PDF hash, see FEATURE_STORE_DIR
+        self.feature_store = feature_store.feature_store_from_env()
+        if self.feature_store:
+            with open(vocab_path, 'rb') as f:
+                self.bert_vocab_sha1 = hashlib.sha1(f.read()).hexdigest()
+        # linear and BERT scores of recently classified PDFs by their text, see NEAR_DUP_INDEX_SIZE
+        self.near_dup = near_dup.near_dup_index_from_env()
+        # run the image and text classifier branches concurrently, see PARALLEL_BRANCHES
+        self.parallel_branches = os.environ.get('PARALLEL_BRANCHES', '1') not in ('', '0')
+        # max examples per tensorflow-serving request
+        self.tf_max_batch_size = int(os.environ.get('TF_MAX_BATCH_SIZE', 32))
+        # the classifiers of auto mode, when each is used and what it costs, see AUTO_CASCADE
+        self.cascade = cascade.cascade_policy_from_env()
+        self.url_classifier = kwargs.get('url_classifier')
+        if self.cascade.stages("url") and self.url_classifier is None:
+            from pdf_trio.url_classifier import UrlClassifier
+            self.url_classifier = UrlClassifier()
+        self._init_process_state()
+
+    def _init_process_state(self):
+        """
+        Create what cannot be shared with a forked process: thread pools, batcher threads,
+        extraction worker processes, connections to tensorflow-serving and to the result cache DB.
+        """
+        # REST (pooled keep-alive connections) or gRPC, see TF_TRANSPORT
+        self.image_transport = tf_transport.transport_from_env('IMAGE', 'image_model', self.image_server_prefix,
+                                                               instances_input=self.image_input_name)
+        self.bert_transport = tf_transport.transport_from_env('BERT', 'bert_model', self.bert_server_prefix)
+        self.extract_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.extract_workers)
+        self.branch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(4, 2 * self.extract_workers))
+        # worker processes that run pdftotext, convert and pdfium, see PDF_EXTRACT_PROCESSES
+        self.extract_processes = extract_pool.extract_pool_from_env()
+        pdf_util.use_extract_pool(self.extract_processes)
+        # max concurrent extractions and tensorflow-serving requests, see MAX_CONCURRENT_<STAGE>
+        self.stage_limits = admission.stage_limits_from_env()
+        # classification results by content hash, modes and model versions
+        self.result_cache = result_cache.result_cache_from_env()
+        # concurrent requests for the same PDF wait for the first, see SINGLE_FLIGHT
+        self.single_flight = single_flight.single_flight_from_env()
+        # coalesce BERT examples from concurrent requests, see BERT_BATCH_SIZE
+        self.bert_batcher = batcher.batcher_from_env('BERT', self._post_bert_items)
+        # coalesce page images from concurrent requests, see IMAGE_BATCH_SIZE
+        self.image_batcher = batcher.batcher_from_env('IMAGE', self._post_image_items)
+
+    def after_fork(self):
+        """
+        Call in a process forked after this classifier was created, like a pre-fork server worker.
+        The models (fastText, BERT vocab) are kept, shared copy-on-write with the parent; the
+        per-process state is created anew, the parent's copy is unusable in the child.
+        """
+        self._init_process_state()
+
+    def warm_up(self):
+        """
+        Run one example through each model, so that connections are open and tensorflow-serving
+        has loaded its models before the first real request.
+        :return: list of error messages, empty when all models answered
+        """
+        errors = []
+        try:
+            self.fasttext_model.predict("warm up")
+        except Exception as e:
+            errors.append("linear: %s" % e)
+        try:
+            # one request per sequence length, as a model runtime may prepare each shape on first use
+            for seq_len in self.bert_seq_buckets:
+                blank = np.zeros(seq_len, dtype=np.int32)
+                self.bert_transport.predict(self.bert_inputs([(blank, blank, blank)]))
+        except Exception as e:
+            errors.append("bert: %s" % e)
+        try:
+            blank_page = np.full((224, 224, 3), 255, dtype=np.uint8)
+            self.image_transport.predict(self.image_inputs([self.load_pdf_image(blank_page)]))
+        except Exception as e:
+            errors.append("image: %s" % e)
+        for error in errors:
+            log.warning("warm up failed, %s" % error)
+        return errors
+
+    def classify_pdf_multi(self, modes, pdf_filestorage, url=None, deadline=admission.NO_DEADLINE):
         """
         Use the modes param to pick subclassifiers and make an ensemble conclusion.
 
@@ -97,93 +286,483 @@ class PdfClassifier:
                     }
         :param modes:  comma sep list of 1 or more {auto, image, linear, bert, all}
         :param pdf_filestorage: as FileStorage object (contains a stream).
+        :param url: where the PDF was found, if known, for the url stages of auto mode
+        :param deadline: admission.Deadline of the request
         :return: map
+        :raise admission.DeadlineExceeded: when the deadline passes before the PDF is classified
+        """
+        return self.classify_pdf_batch(modes, [pdf_filestorage], [url], deadline)[0]
+
+    def classify_pdf_batch(self, modes, pdf_filestorage_list, urls=None, deadline=admission.NO_DEADLINE):
+        """
+        Classify many PDFs with the same modes. Text and page images are extracted across a pool of
+        worker threads (the work is done by pdftotext and convert subprocesses), then the BERT and
+        image examples are sent to tensorflow-serving as multi-example requests.
+        :param modes:  comma sep list of 1 or more {auto, image, linear, bert, all}
+        :param pdf_filestorage_list: list of FileStorage objects (each contains a stream).
+        :param urls: where each PDF was found (or None), if known, for the url stages of auto mode
+        :param deadline: admission.Deadline of the request
+        :return: list of maps like classify_pdf_multi returns, in the same order as given
+        :raise admission.DeadlineExceeded: when the deadline passes before the PDFs are classified
         """
-        results = {"version": self.version_map}
-        confidence_values = []
+        pdfs = []
+        for pdf_filestorage in pdf_filestorage_list:
+            with metrics.stage("upload_save"):
+                pdfs.append((pdf_filestorage.filename, pdf_filestorage.read()))
+        return self.classify_pdf_contents(modes, pdfs, urls, deadline)
+
+    def classify_pdf_contents(self, modes, pdfs, urls=None, deadline=admission.NO_DEADLINE):
+        """
+        Like classify_pdf_batch, for PDFs already read.
+        :param pdfs: list of (file name, PDF bytes)
+        """
+        if urls is None:
+            urls = [None] * len(pdfs)
         mode_list = modes.split(",")
-        pdf_token_list = []
         # rewrite mode_list if 'all' is requested
         if 'all' in mode_list:
             mode_list = ['image', 'linear', 'bert']
-        # write pdf content to tmp file
-        tmp_pdf_name = pdf_util.tmp_file_name()
-        pdf_filestorage.save(tmp_pdf_name)
-        log.debug("stored pdf_content for %s in %s" % (pdf_filestorage.filename, tmp_pdf_name))
-        # look ahead to see if text is required, so we can extract that now
-        if ('linear' in mode_list) or ('bert' in mode_list) or ('auto' in mode_list):
-            # extract text
-            pdf_raw_text = pdf_util.extract_pdf_text(tmp_pdf_name)
-            if len(pdf_raw_text) < 300:
-                pdf_token_list = []  # too short to be useful
+        results = [None] * len(pdfs)
+        # write pdf content to tmp files, unless results are cached or in flight for another request
+        jobs = []
+        job_offsets = []
+        waiting = []  # (offset, future) of the PDFs classified by another request
+        try:
+            for offset, ((name, pdf_content), url) in enumerate(zip(pdfs, urls)):
+                cache_key = None
+                if self.result_cache or self.single_flight:
+                    cache_key = result_cache.ResultCache.make_key(pdf_content, modes, self.version_map,
+                                                                  self.cache_variant(mode_list, url))
+                if self.result_cache:
+                    results[offset] = self.result_cache.get(cache_key)
+                    if results[offset] is not None:
+                        log.debug("cached result for %s" % (name))
+                        continue
+                flight = None
+                if self.single_flight:
+                    flight, first = self.single_flight.begin(cache_key)
+                    if not first:
+                        log.debug("waiting for the classification in flight of %s" % (name))
+                        waiting.append((offset, flight))
+                        continue
+                job = _PdfJob(name, pdf_content, None, cache_key, url, deadline)
+                job.flight = flight
+                jobs.append(job)
+                job_offsets.append(offset)
+                if not self.extract_in_memory:
+                    with metrics.stage("upload_save"):
+                        job.tmp_pdf_name = pdf_util.write_tmp_file(pdf_content)
+                    log.debug("stored pdf_content for %s in %s" % (name, job.tmp_pdf_name))
+            if 'auto' in mode_list:
+                self.classify_jobs_auto(jobs)
             else:
-                pdf_token_list = text_prep.extract_tokens(pdf_raw_text)
-        if 'auto' in mode_list:
-            # start with fastest, use confidence thresholds to short circuit
-            if len(pdf_token_list) != 0:
-                # FastText
-                confidence_linear = self.classify_pdf_linear(pdf_token_list)
-                results['linear'] = confidence_linear
-                confidence_values.append(confidence_linear)
-                if .85 >= confidence_linear >= 0.15:
-                    # also check BERT
-                    pdf_token_list_trimmed = text_prep.trim_tokens(pdf_token_list, 512)
-                    confidence_bert = self.classify_pdf_bert(pdf_token_list_trimmed)
-                    results['bert'] = confidence_bert
-                    confidence_values.append(confidence_bert)
+                self.classify_jobs_named(jobs, mode_list)
+        except BaseException as e:
+            for job in jobs:
+                if job.flight:
+                    self.single_flight.finish(job.cache_key, job.flight, error=e)
+            raise
+        finally:
+            for job in jobs:
+                if job.tmp_pdf_name:
+                    pdf_util.discard_tmp_file(job.tmp_pdf_name)
+        for offset, job in zip(job_offsets, jobs):
+            results[offset] = job.results_map(self.version_map)
+            if self.result_cache and job.cacheable():
+                self.result_cache.put(job.cache_key, results[offset])
+            if job.flight:
+                self.single_flight.finish(job.cache_key, job.flight, results[offset])
+        for offset, flight in waiting:
+            results[offset] = self.wait_in_flight(flight, modes, pdfs[offset], urls[offset], deadline)
+        return results
+
+    def wait_in_flight(self, flight, modes, pdf, url, deadline):
+        """
+        Wait for the results of a PDF classified by another request.
+        :param flight: future of single_flight.begin
+        :param pdf: (file name, PDF bytes)
+        :return: results map
+        :raise admission.DeadlineExceeded: when the deadline passes first
+        :raise: the error of the other request
+        """
+        try:
+            return self.single_flight.wait(flight, deadline.timeout(None, "single_flight"))
+        except concurrent.futures.TimeoutError:
+            metrics.DEADLINES_EXCEEDED.labels(stage="single_flight").inc()
+            raise admission.DeadlineExceeded("deadline passed waiting for the classification of %s" % pdf[0])
+        except single_flight.LeaderGone:
+            deadline.check("single_flight")
+            # the other request ran out of its own time, or was cancelled
+            return self.classify_pdf_contents(modes, [pdf], [url], deadline)[0]
+
+    def cache_variant(self, mode_list, url):
+        """
+        :return: what, besides the PDF, modes and model versions, the results depend on
+        """
+        if 'auto' not in mode_list:
+            return ""
+        if url and self.cascade.stages("url"):
+            return self.cascade.fingerprint() + url
+        return self.cascade.fingerprint()
+
+    def classify_jobs_auto(self, jobs):
+        """
+        Run the cascade of AUTO_CASCADE: the url stages for PDFs with a known URL, then for the
+        PDFs still undecided, the text stages if they have text or the no_text stages otherwise.
+        By default, start with fastest and use confidence thresholds to short circuit.
+        """
+        all_jobs = jobs
+        self.run_cascade(self.cascade.stages("url"), [job for job in jobs if job.url])
+        jobs = [job for job in jobs if not job.decided]
+        policy = self.text_policy(self.cascade.text_classifiers() or ["linear"])
+        text_futures = [self.extract_pool.submit(self.extract_tokens, job, policy) for job in jobs]
+        page0_futures = []
+        if self.speculative_image and self.cascade.speculative_image():
+            # render page 0 while the text is extracted, in case there turns out to be too little text
+            page0_futures = [self.extract_pool.submit(self.extract_page0, job) for job in jobs]
+        try:
+            for job, future in zip(jobs, text_futures):
+                job.token_list = future.result()
+                job.cost_ms += self.cascade.extract_text_cost_ms
+        except Exception:
+            for future in page0_futures:
+                self.discard_page0(future)
+            raise
+        text_jobs = []
+        image_jobs = []
+        jpgs = []
+        consumed = 0  # page0_futures looked at
+        try:
+            for j, job in enumerate(jobs):
+                if len(job.token_list) != 0:
+                    text_jobs.append(job)
+                    if page0_futures:
+                        # the text path wins
+                        self.discard_page0(page0_futures[j])
+                else:
+                    image_jobs.append(job)
+                    if page0_futures:
+                        jpgs.append(page0_futures[j].result())
+                consumed = j + 1
+            branches = []
+            if text_jobs:
+                branches.append(functools.partial(self.run_cascade, self.cascade.stages("text"), text_jobs))
+            if image_jobs:
+                # no tokens, by default use image
+                branches.append(functools.partial(self.run_cascade, self.cascade.stages("no_text"), image_jobs,
+                                                  jpgs if page0_futures else None))
+            self.run_branches(branches)
+        finally:
+            # after a failure, the renders not looked at and the jpgs the image stage did not get
+            # to; those it did get are removed already
+            for future in page0_futures[consumed:]:
+                self.discard_page0(future)
+            for jpg in jpgs:
+                if isinstance(jpg, str) and jpg:
+                    pdf_util.discard_tmp_file(jpg)
+        self.cascade.record(all_jobs)
+
+    def run_cascade(self, stages, jobs, jpgs=None):
+        """
+        :param stages: list of cascade.Stage
+        :param jobs: list of _PdfJob
+        :param jpgs: page 0 jpgs already extracted for the jobs, if the first stage is image
+        """
+        for stage in stages:
+            if not jobs:
+                break
+            if stage.classifier == "urlmeta":
+                self.classify_jobs_urlmeta(jobs)
+            elif stage.classifier == "linear":
+                self.classify_jobs_linear(jobs)
+            elif stage.classifier == "bert":
+                self.classify_jobs_bert(jobs)
+            else:
+                self.classify_jobs_image(jobs, jpgs)
+            jpgs = None
+            jobs = self.cascade.advance(stage, jobs)
+
+    def classify_jobs_named(self, jobs, mode_list):
+        """
+        Apply named classifiers. The image branch and the text branch (extraction, then linear
+        and BERT) run concurrently.
+        """
+        branches = []
+        if "image" in mode_list:
+            branches.append(functools.partial(self.classify_jobs_image, jobs))
+        text_classifiers = [c for c in mode_list if c in ("linear", "bert")]
+        if text_classifiers:
+            branches.append(functools.partial(self.classify_jobs_text, jobs, text_classifiers))
+        for classifier in mode_list:
+            if classifier not in ("image", "linear", "bert"):
+                log.warning("ignoring unknown classifier ref: " + classifier)
+        self.run_branches(branches)
+
+    def classify_jobs_text(self, jobs, text_classifiers):
+        token_lists = self.extract_pool.map(functools.partial(self.extract_tokens,
+                                                              policy=self.text_policy(text_classifiers)), jobs)
+        for job, pdf_token_list in zip(jobs, token_lists):
+            job.token_list = pdf_token_list
+        text_jobs = self.jobs_with_tokens(jobs)
+        for classifier in text_classifiers:
+            if classifier == "linear":
+                self.classify_jobs_linear(text_jobs)
             else:
-                # no tokens, so use image
-                jpg_file_page0 = pdf_util.extract_pdf_image(tmp_pdf_name)
-                # classify pdf_image_page0
-                confidence_image = self.classify_pdf_image(jpg_file_page0)
-                results['image'] = confidence_image
-                confidence_values.append(confidence_image)
-                # remove tmp jpg
-                if logging.getLogger().getEffectiveLevel() != logging.DEBUG:
-                    pdf_util.remove_tmp_file(jpg_file_page0)
+                self.classify_jobs_bert(text_jobs)
+
+    def run_branches(self, branches):
+        """
+        Run independent classification branches, concurrently unless PARALLEL_BRANCHES=0.
+        The first branch runs in the calling thread. Branches must not call run_branches themselves,
+        so that no thread of the branch pool waits for another.
+        """
+        if not self.parallel_branches or len(branches) < 2:
+            for branch in branches:
+                branch()
+            return
+        futures = [self.branch_pool.submit(branch) for branch in branches[1:]]
+        try:
+            branches[0]()
+        finally:
+            for future in futures:
+                future.result()
+
+    @staticmethod
+    def discard_page0(future):
+        """
+        Cancel a speculative page 0 render, or remove its jpg once it finishes.
+        """
+        if future.cancel():
+            return
+
+        def remove_jpg(f):
+            if f.cancelled() or f.exception() is not None:
+                return
+            if isinstance(f.result(), str) and f.result():
+                pdf_util.discard_tmp_file(f.result())
+
+        future.add_done_callback(remove_jpg)
+
+    def text_policy(self, text_classifiers):
+        """
+        :param text_classifiers: list of linear and/or bert
+        :return: pdf_util.TextPolicy giving each of the text classifiers all the text it needs
+        """
+        return functools.reduce(pdf_util.TextPolicy.union, [self.text_policies[c] for c in text_classifiers])
+
+    def extract_tokens(self, job, policy=pdf_util.WHOLE_DOCUMENT):
+        """
+        Extract text from the PDF and clean it into tokens.
+        :param job: _PdfJob
+        :param policy: pdf_util.TextPolicy, the pages and token budget
+        :return: token list, empty if too little text was found to be useful.
+        """
+        job.token_policy = policy
+        pdf_token_list = self.stored_tokens(job)
+        if pdf_token_list is not None:
+            return pdf_token_list
+        with pdf_util.extraction_status() as status, self.stage_limits.hold("extract_text", job.deadline), \
+                metrics.stage("extract_text"):
+            if job.tmp_pdf_name:
+                pdf_raw_text = pdf_util.extract_pdf_text(job.tmp_pdf_name, policy, job.deadline)
+            else:
+                pdf_raw_text = pdf_util.extract_pdf_text_from_content(job.pdf_content, policy, job.deadline)
+        pdf_token_list = PdfClassifier.tokens_from_text(pdf_raw_text, policy.max_tokens)
+        if status.complete:
+            # not the partial text of a timed out pdftotext, extracted again next time
+            self.store_tokens(job, pdf_token_list)
+        return pdf_token_list
+
+    def stored_tokens(self, job):
+        """
+        :param job: _PdfJob with token_policy set
+        :return: token list from the feature store, None if not stored or no store
+        """
+        if not self.feature_store:
+            return None
+        return self.feature_store.get_tokens(job.content_sha1, "policy=%d,%d,%d" % job.token_policy)
+
+    def store_tokens(self, job, pdf_token_list):
+        if self.feature_store:
+            self.feature_store.put_tokens(job.content_sha1, "policy=%d,%d,%d" % job.token_policy, pdf_token_list)
+
+    def job_bert_features(self, job):
+        """
+        :param job: _PdfJob with extracted tokens
+        :return: BERT features of the tokens, see bert_features; the token ids come from the
+            feature store if there
+        """
+        pdf_token_list = text_prep.trim_tokens(job.token_list, self.bert_max_tokens)
+        if not self.feature_store or job.token_policy is None:
+            return self.bert_features(pdf_token_list)
+        variant = "policy=%d,%d,%d|vocab=%s|max_tokens=%d" % (tuple(job.token_policy) +
+                                                              (self.bert_vocab_sha1, self.bert_max_tokens))
+        token_ids = self.feature_store.get_array(job.content_sha1, "bert_ids", variant)
+        if token_ids is None:
+            with metrics.stage("bert_features"):
+                token_ids = self.bert_vocab.lookup_ids(pdf_token_list)
+            self.feature_store.put_array(job.content_sha1, "bert_ids", variant, np.asarray(token_ids, dtype=np.int32))
+        return self.bert_features(token_ids=token_ids)
+
+    @staticmethod
+    def tokens_from_text(pdf_raw_text, max_tokens=0):
+        """
+        :param max_tokens: token budget, 0 for no limit
+        :return: token list, empty if too little text was found to be useful.
+        """
+        if len(pdf_raw_text) < 300:
+            return []  # too short to be useful
+        with metrics.stage("extract_tokens"):
+            return text_prep.extract_tokens(pdf_raw_text, max_tokens)
+
+    @staticmethod
+    def jobs_with_tokens(jobs):
+        """
+        :return: the jobs that have extracted tokens; the text classifiers cannot be used on the others.
+        """
+        ret = []
+        for job in jobs:
+            if len(job.token_list) == 0:
+                log.debug("no tokens extracted for %s" % (job.name))
+                continue  # skip
+            ret.append(job)
+        return ret
+
+    def classify_jobs_urlmeta(self, jobs):
+        confidences = self.url_classifier.classify_urls([job.url for job in jobs])
+        for job, confidence_url in zip(jobs, confidences):
+            job.add_result("urlmeta", confidence_url)
+
+    def classify_jobs_linear(self, jobs):
+        jobs = self.reuse_near_dup_scores(jobs, "linear")
+        max_tokens = self.text_policies["linear"].max_tokens
+        for job in jobs:
+            token_list = text_prep.trim_tokens(job.token_list, max_tokens) if max_tokens else job.token_list
+            job.add_result("linear", self.classify_pdf_linear(token_list))
+        self.remember_near_dup_scores(jobs, "linear")
+
+    def classify_jobs_bert(self, jobs):
+        jobs = self.reuse_near_dup_scores(jobs, "bert")
+        confidences = self.classify_bert_features_batch([self.job_bert_features(job) for job in jobs],
+                                                        [job.name for job in jobs],
+                                                        admission.latest([job.deadline for job in jobs]))
+        for job, confidence_bert in zip(jobs, confidences):
+            job.add_result("bert", confidence_bert)
+        self.remember_near_dup_scores(jobs, "bert")
+
+    def job_signature(self, job):
+        if job.signature is None:
+            job.signature = self.near_dup.signature(job.token_list)
+        return job.signature
+
+    def reuse_near_dup_scores(self, jobs, classifier):
+        """
+        Give the jobs that are near-duplicates of recently classified PDFs their scores.
+        :param jobs: list of _PdfJob with extracted tokens
+        :param classifier: linear or bert
+        :return: the other jobs, which need the model
+        """
+        if not self.near_dup:
+            return jobs
+        ret = []
+        for job in jobs:
+            confidence = self.near_dup.lookup(self.job_signature(job), classifier, self.version_map[classifier])
+            if confidence is None:
+                ret.append(job)
+            else:
+                log.debug("%s score of a near-duplicate reused for %s" % (classifier, job.name))
+                job.add_result(classifier, confidence)
+        return ret
+
+    def remember_near_dup_scores(self, jobs, classifier):
+        if not self.near_dup:
+            return
+        for job in jobs:
+            confidence = job.results.get(classifier, 0.5)
+            # not the default of a failed back-end request
+            if confidence != 0.5:
+                self.near_dup.add(self.job_signature(job), classifier, self.version_map[classifier], confidence)
+
+    def extract_page0(self, job):
+        """
+        :param job: _PdfJob
+        :return: tmp jpg file name, or jpg bytes when extracting in memory, or a uint8 array with
+            PDF_RASTERIZER=pdfium or from the feature store; empty or None if no good image produced.
+        """
+        image = self.stored_page0(job)
+        if image is not None:
+            return image
+        with pdf_util.extraction_status() as status, self.stage_limits.hold("extract_image", job.deadline), \
+                metrics.stage("extract_image"):
+            if self.rasterizer == 'pdfium':
+                jpg_page0 = pdf_util.render_pdf_page0(job.tmp_pdf_name or job.pdf_content, 0, job.deadline)
+            elif job.tmp_pdf_name:
+                jpg_page0 = pdf_util.extract_pdf_image(job.tmp_pdf_name, 0, job.deadline)
+            else:
+                jpg_page0 = pdf_util.extract_pdf_image_from_content(job.pdf_content, 0, job.deadline)
+        if not status.complete:
+            # no image because convert timed out, not a blank page; rendered again next time
+            return jpg_page0
+        return self.store_page0(job, jpg_page0)
+
+    def stored_page0(self, job):
+        """
+        :return: uint8 page 0 image from the feature store, empty if no good image was produced,
+            None if not stored or no store
+        """
+        if not self.feature_store:
+            return None
+        return self.feature_store.get_array(job.content_sha1, "page0", "rasterizer=" + self.rasterizer)
+
+    def store_page0(self, job, jpg_page0):
+        """
+        :param jpg_page0: as extract_page0 returns
+        :return: jpg_page0, or the decoded uint8 image when stored (the tmp jpg file is removed)
+        """
+        if not self.feature_store:
+            return jpg_page0
+        if jpg_page0 is None or len(jpg_page0) == 0:
+            image = np.zeros((0, 0, 3), dtype=np.uint8)
+        elif isinstance(jpg_page0, np.ndarray):
+            image = jpg_page0
+        elif isinstance(jpg_page0, bytes):
+            image = cv2.imdecode(np.frombuffer(jpg_page0, dtype=np.uint8), cv2.IMREAD_COLOR)
         else:
-            # apply named classifiers
-            for classifier in mode_list:
-                if classifier == "image":
-                    jpg_file_page0 = pdf_util.extract_pdf_image(tmp_pdf_name)
-                    if len(jpg_file_page0) == 0:
-                        log.debug("no jpg for %s" % (pdf_filestorage.filename))
-                        continue  # skip
-                    # classify pdf_image_page0
-                    confidence_image = self.classify_pdf_image(jpg_file_page0)
-                    results[classifier] = confidence_image
-                    confidence_values.append(confidence_image)
-                    # remove tmp jpg
-                    if logging.getLogger().getEffectiveLevel() != logging.DEBUG:
-                        pdf_util.remove_tmp_file(jpg_file_page0)
-                elif classifier == "linear":
-                    if len(pdf_token_list) == 0:
-                        # cannot use this classifier if no tokens extracted
-                        log.debug("no tokens extracted for %s" % (pdf_filestorage.filename))
-                        continue  # skip
-                    confidence_linear = self.classify_pdf_linear(pdf_token_list)
-                    results[classifier] = confidence_linear
-                    confidence_values.append(confidence_linear)
-                elif classifier == "bert":
-                    if len(pdf_token_list) == 0:
-                        # cannot use this classifier if no tokens extracted
-                        log.debug("no tokens extracted for %s" % (pdf_filestorage.filename))
-                        continue  # skip
-                    pdf_token_list_trimmed = text_prep.trim_tokens(pdf_token_list, 512)
-                    confidence_bert = self.classify_pdf_bert(pdf_token_list_trimmed)
-                    results[classifier] = confidence_bert
-                    confidence_values.append(confidence_bert)
-                else:
-                    log.warning("ignoring unknown classifier ref: " + classifier)
-        if logging.getLogger().getEffectiveLevel() != logging.DEBUG:
-            pdf_util.remove_tmp_file(tmp_pdf_name)
-        #  compute 'is_research' using confidence_values
-        if len(confidence_values) != 0:
-            confidence_overall = sum(confidence_values) / len(confidence_values)
-            # insert confidence_overall
-            results["is_research"] = confidence_overall
-        return results
+            image = cv2.imread(jpg_page0)
+        if image is None:
+            # not decodable, which the image model would fail on too
+            return jpg_page0
+        if isinstance(jpg_page0, str):
+            pdf_util.discard_tmp_file(jpg_page0)
+        self.feature_store.put_array(job.content_sha1, "page0", "rasterizer=" + self.rasterizer, image)
+        return image if len(image) else jpg_page0
 
+    def classify_jobs_image(self, jobs, jpgs=None):
+        """
+        :param jobs: list of _PdfJob
+        :param jpgs: page 0 jpgs already extracted for the jobs, if any
+        """
+        if jpgs is None:
+            jpgs = self.extract_pool.map(self.extract_page0, jobs)
+        image_jobs = []
+        for job, jpg_page0 in zip(jobs, jpgs):
+            if jpg_page0 is None or len(jpg_page0) == 0:
+                log.debug("no jpg for %s" % (job.name))
+                continue  # skip
+            job.jpg_page0 = jpg_page0
+            image_jobs.append(job)
+        try:
+            # classify pdf_image_page0
+            confidences = self.classify_pdf_image_batch([job.jpg_page0 for job in image_jobs],
+                                                        [job.name for job in image_jobs],
+                                                        admission.latest([job.deadline for job in image_jobs]))
+            for job, confidence_image in zip(image_jobs, confidences):
+                job.add_result("image", confidence_image)
+        finally:
+            # remove tmp jpg
+            for job in image_jobs:
+                if isinstance(job.jpg_page0, str):
+                    pdf_util.discard_tmp_file(job.jpg_page0)
 
     @staticmethod
     def encode_confidence(label, confidence):
@@ -226,13 +805,46 @@ class PdfClassifier:
         :return: encoded confidence as type float with range [0.5,1.0] that example is positive
         """
         #  classify using fastText model
-        results = self.fasttext_model.predict(" ".join(pdf_token_list))
+        with metrics.stage("linear_predict"):
+            results = self.fasttext_model.predict(" ".join(pdf_token_list))
         label = results[0][0]
         confidence = results[1][0]
         log.debug("classify_pdf_linear: label=%s confidence=%.2f" % (label, confidence))
         return self.encode_confidence(label, confidence)
 
 
+    @staticmethod
+    def decode_softmax(response_vec):
+        """
+        :param response_vec: [confidence_other, confidence_research] as returned by tensorflow-serving
+        :return: encoded confidence as type float with range [0.0,1.0]
+        """
+        confidence_other = float(response_vec[0])
+        confidence_research = float(response_vec[1])
+        if confidence_research > confidence_other:
+            return PdfClassifier.encode_confidence("research", confidence_research)
+        return PdfClassifier.encode_confidence("other", confidence_other)
+
+    def bert_features(self, pdf_token_list=None, token_ids=None):
+        """
+        Map tokens to BERT vocab ids and pad to the smallest sequence length of BERT_SEQ_BUCKETS
+        that holds them, 512 by default.
+        :param pdf_token_list: cleaned tokens list, trimmed to not exceed max tokens (512)
+        :param token_ids: the vocab ids of the tokens, if already known, instead of the tokens
+        :return: input_ids, input_mask, segment_ids as int32 arrays of the bucket length
+        """
+        if token_ids is None:
+            with metrics.stage("bert_features"):
+                token_ids = self.bert_vocab.lookup_ids(pdf_token_list)
+        tcount = len(token_ids)
+        seq_len = next(b for b in self.bert_seq_buckets if b >= tcount)
+        input_ids = np.zeros(seq_len, dtype=np.int32)
+        input_ids[:tcount] = token_ids
+        input_mask = np.zeros(seq_len, dtype=np.int32)
+        input_mask[:tcount] = 1
+        segment_ids = np.zeros(seq_len, dtype=np.int32)
+        return input_ids, input_mask, segment_ids
+
     def classify_pdf_bert(self, pdf_token_list, trace_id=""):
         """
         Apply BERT model to content to classify given token list.
@@ -241,47 +853,118 @@ class PdfClassifier:
         :param trace_id: string for doc id, if known.
         :return: encoded confidence as type float with range [0.5,1.0] that example is positive
         """
-        token_ids = text_prep.convert_to_bert_vocab(self.bert_vocab, pdf_token_list)
-        tcount = len(token_ids)
-        if tcount < 512:
-            for j in range(tcount, 512):
-                token_ids.append(0)
-        # add entries so that token_ids is 512 length
-        # for REST request, need examples=[{"input_ids": [], "input_mask":[], "label_ids":[0], "segment_ids":[]}]
-        input_ids = token_ids
-        if tcount < 512:
-            input_mask = np.concatenate((np.ones(tcount, dtype=int), np.zeros(512-tcount, dtype=int)), axis=0).tolist()
-        else:
-            input_mask = np.ones(512, dtype=int).tolist()
-        label_ids = [0]  # dummy, one int, not needed for prediction
-        segment_ids = np.zeros(512, dtype=int).tolist()
+        return self.classify_pdf_bert_batch([pdf_token_list], [trace_id])[0]
+
+    def classify_pdf_bert_batch(self, pdf_token_lists, trace_ids=None, deadline=admission.NO_DEADLINE):
+        """
+        Apply BERT model to classify each of the given token lists, sending up to TF_MAX_BATCH_SIZE
+        examples per request.
+
+        :param pdf_token_lists: list of cleaned token lists, each trimmed to not exceed max tokens (512)
+        :param trace_ids: list of strings for doc ids, if known.
+        :param deadline: admission.Deadline
+        :return: list of encoded confidences, in the same order as pdf_token_lists
+        """
+        if trace_ids is None:
+            trace_ids = [""] * len(pdf_token_lists)
+        return self.classify_bert_features_batch([self.bert_features(t) for t in pdf_token_lists], trace_ids,
+                                                 deadline)
+
+    def classify_bert_features_batch(self, features, trace_ids, deadline=admission.NO_DEADLINE):
+        """
+        Like classify_pdf_bert_batch, for examples already mapped by bert_features.
+        """
+        if self.bert_batcher:
+            return self.submit_batched(self.bert_batcher, "bert_request",
+                                       [(f, trace_id, deadline) for f, trace_id in zip(features, trace_ids)],
+                                       deadline)
+        ret = [0.5] * len(features)
+        for chunk in self.bert_chunks(features, self.tf_max_batch_size):
+            confidences = self._post_bert([features[j] for j in chunk], [trace_ids[j] for j in chunk], deadline)
+            for j, confidence in zip(chunk, confidences):
+                ret[j] = confidence
+        return ret
+
+    @staticmethod
+    def bert_chunks(features, size):
+        """
+        Split BERT examples into requests, examples of the same sequence length together, so
+        that few are padded to the length of a longer one.
+        :param features: list of (input_ids, input_mask, segment_ids)
+        :param size: max examples per request
+        :return: list of lists of indexes into features
+        """
+        # stable, so in their order when all have the same length
+        order = sorted(range(len(features)), key=lambda j: len(features[j][0]))
+        return [order[offset:offset + size] for offset in range(0, len(order), size)]
+
+    @staticmethod
+    def submit_batched(micro_batcher, stage, items, deadline):
+        """
+        Queue items on a batcher and wait for their results until the deadline.
+        """
+        try:
+            return micro_batcher.submit_many(items, timeout=deadline.timeout(None, stage))
+        except concurrent.futures.TimeoutError:
+            metrics.DEADLINES_EXCEEDED.labels(stage=stage).inc()
+            raise admission.DeadlineExceeded("deadline passed waiting for %s" % stage)
+
+    def _post_bert_items(self, items):
+        """
+        :param items: list of (features, trace_id, deadline) as queued on the BERT batcher
+        :return: list of encoded confidences
+        """
+        return self._post_bert([item[0] for item in items], [item[1] for item in items],
+                               admission.latest([item[2] for item in items]))
+
+    @staticmethod
+    def bert_inputs(features):
+        """
+        :param features: list of (input_ids, input_mask, segment_ids), padded to the longest of them
+        :return: ordered map of BERT model input name to int32 array
+        """
         # The released BERT graph has been tweaked to use 4 input placeholders,
         #   so we use "inputs" columnar format REST style.
-        #   Columnar format means each named input can have a list of values, but we actually are only submitting
-        #   one at a time here.
-        #   label_ids is a scalar (placeholder shape [None]).
-        evalue = {"input_ids": [input_ids],
-                "input_mask": [input_mask],
-                "label_ids": label_ids,
-                "segment_ids": [segment_ids]}
-        req_json = json.dumps({"signature_name": "serving_default", "inputs":  evalue})
-        log.debug("BERT: request to %s is: %s ... %s" % (self.bert_tf_server_url, req_json[:80], req_json[len(req_json)-50:]))
-        ret = 0.5  # zero confidence encoded default
+        #   Columnar format means each named input has a list of values, one per example.
+        #   label_ids is a scalar per example (placeholder shape [None]), a dummy not needed for prediction.
+        seq_len = max(len(f[0]) for f in features)
+        metrics.BERT_EXAMPLES.labels(seq_len=str(seq_len)).inc(len(features))
+
+        def padded(column):
+            values = np.zeros((len(features), seq_len), dtype=np.int32)
+            for j, f in enumerate(features):
+                values[j, :len(f[column])] = f[column]
+            return values
+
+        inputs = collections.OrderedDict()
+        inputs["input_ids"] = padded(0)
+        inputs["input_mask"] = padded(1)
+        inputs["label_ids"] = np.zeros(len(features), dtype=np.int32)
+        inputs["segment_ids"] = padded(2)
+        return inputs
+
+    def _post_bert(self, features, trace_ids, deadline=admission.NO_DEADLINE):
+        """
+        :param features: list of (input_ids, input_mask, segment_ids)
+        :param trace_ids: list of doc ids for logging
+        :param deadline: admission.Deadline, which cuts the request timeout to the time left
+        :return: list of encoded confidences, 0.5 for each example if the request failed
+        :raise admission.DeadlineExceeded: when the deadline passes first
+        """
+        ret = [0.5] * len(features)  # zero confidence encoded default
         try:
-            response = requests.post(self.bert_tf_server_url, data=req_json, headers=self.json_content_header)
-            if response.status_code == 200:
-                response_vec = response.json()["outputs"][0]
-                confidence_other = response_vec[0]
-                confidence_research = response_vec[1]
-                log.debug("bert classify %s  other=%.2f research=%.2f" % (trace_id, confidence_other, confidence_research))
-                if confidence_research > confidence_other:
-                    ret = self.encode_confidence("research", confidence_research)
-                else:
-                    ret = self.encode_confidence("other", confidence_other)
-            elif response.status_code == 400:
-                log.warning("HTTP 400 from tf-serving of bert, %s" % response.json())
-        except Exception:
-            log.warning("exception occurred processing REST BERT tensorflow-serving for %s" % trace_id)
+            with self.stage_limits.hold("bert_request", deadline), metrics.stage("bert_request"):
+                outputs = self.bert_transport.predict(self.bert_inputs(features),
+                                                      timeout=deadline.timeout(None, "bert_request"))
+            for j, response_vec in enumerate(outputs[:len(features)]):
+                log.debug("bert classify %s  other=%.2f research=%.2f" % (trace_ids[j], response_vec[0], response_vec[1]))
+                ret[j] = self.decode_softmax(response_vec)
+        except admission.DeadlineExceeded:
+            raise
+        except Exception as e:
+            deadline.check("bert_request")
+            metrics.BACKEND_ERRORS.labels(model="bert").inc()
+            log.warning("exception occurred processing BERT tensorflow-serving for %s: %s" % (",".join(trace_ids), e))
         return ret
 
 
@@ -339,6 +1022,23 @@ class PdfClassifier:
         return ret
 
 
+    @staticmethod
+    def load_pdf_image(jpg_file):
+        """
+        :param jpg_file: tmp jpg image file name, full path, or jpg bytes, or uint8 image array.
+        :return: float32 array of shape (299, 299, 3) for the image model
+        """
+        with metrics.stage("image_preprocess"):
+            if isinstance(jpg_file, np.ndarray):
+                img = jpg_file.astype(np.float32)
+            elif isinstance(jpg_file, bytes):
+                img = cv2.imdecode(np.frombuffer(jpg_file, dtype=np.uint8), cv2.IMREAD_COLOR).astype(np.float32)
+            else:
+                img = cv2.imread(jpg_file).astype(np.float32)
+            # we have 224x224, resize to 299x299 for shape (224, 224, 3)
+            # ToDo: target size could vary, depending on the pre-trained model, should auto-adjust
+            return cv2.resize(img, dsize=(299, 299), interpolation=cv2.INTER_LINEAR)
+
     def classify_pdf_image(self, jpg_file):
         """
         Apply image model to content image using tensorflow-serving.
@@ -346,44 +1046,100 @@ class PdfClassifier:
         :param jpg_file: tmp jpg image file name, full path.
         :return: encoded confidence as type float with range [0.5,1.0] that example is positive
         """
-        ret = 0.5  # lowest confidence encoded value
-        img = cv2.imread(jpg_file).astype(np.float32)
-        # we have 224x224, resize to 299x299 for shape (224, 224, 3)
-        # ToDo: target size could vary, depending on the pre-trained model, should auto-adjust
-        img299 = cv2.resize(img, dsize=(299, 299), interpolation=cv2.INTER_LINEAR)
-        my_images = np.reshape(img299, (-1, 299, 299, 3))
-        req_json = json.dumps({"signature_name": "serving_default", "instances": my_images.tolist()})
+        return self.classify_pdf_image_batch([jpg_file])[0]
+
+    def classify_pdf_image_batch(self, jpg_files, trace_ids=None, deadline=admission.NO_DEADLINE):
+        """
+        Apply image model to each of the given images, sending up to TF_MAX_BATCH_SIZE
+        examples per request.
+
+        :param jpg_files: list of tmp jpg image file names, full path, or jpg bytes, or uint8 image arrays.
+        :param trace_ids: list of strings for doc ids, if known; file names are used by default.
+        :param deadline: admission.Deadline
+        :return: list of encoded confidences, in the same order as jpg_files
+        """
+        if trace_ids is None:
+            trace_ids = [f if isinstance(f, str) else "" for f in jpg_files]
+        if self.image_batcher:
+            return self.submit_batched(self.image_batcher, "image_request",
+                                       [(self.load_pdf_image(f), trace_id, deadline)
+                                        for f, trace_id in zip(jpg_files, trace_ids)], deadline)
+        ret = []
+        for offset in range(0, len(jpg_files), self.tf_max_batch_size):
+            chunk = jpg_files[offset:offset + self.tf_max_batch_size]
+            chunk_ids = trace_ids[offset:offset + self.tf_max_batch_size]
+            ret.extend(self._post_image([self.load_pdf_image(f) for f in chunk], chunk_ids, deadline))
+        return ret
+
+    def _post_image_items(self, items):
+        """
+        :param items: list of (image, trace_id, deadline) as queued on the image batcher
+        :return: list of encoded confidences
+        """
+        return self._post_image([item[0] for item in items], [item[1] for item in items],
+                                admission.latest([item[2] for item in items]))
+
+    def image_inputs(self, images):
+        """
+        :param images: list of float32 arrays of shape (299, 299, 3)
+        :return: map of image model input name to the stacked images
+        """
+        return {self.image_input_name: np.reshape(np.stack(images), (-1, 299, 299, 3))}
+
+    def _post_image(self, images, trace_ids, deadline=admission.NO_DEADLINE):
+        """
+        :param images: list of float32 arrays of shape (299, 299, 3)
+        :param trace_ids: list of image names for logging
+        :param deadline: admission.Deadline, which cuts the request timeout to the time left
+        :return: list of encoded confidences, 0.5 (lowest confidence) for each image if the request failed
+        :raise admission.DeadlineExceeded: when the deadline passes first
+        """
+        ret = [0.5] * len(images)  # lowest confidence encoded value
         try:
-            response = requests.post(self.image_tf_server_url, data=req_json, headers=self.json_content_header)
-            if response.status_code == 200:
-                response_vec = response.json()["predictions"][0]
-                confidence_other = response_vec[0]
-                confidence_research = response_vec[1]
-                log.debug("image classify %s  other=%.2f research=%.2f" % (jpg_file, confidence_other, confidence_research))
-                if confidence_research > confidence_other:
-                    ret = self.encode_confidence("research", confidence_research)
-                else:
-                    ret = self.encode_confidence("other", confidence_other)
-        except Exception:
-            log.warning("exception occurred processing REST tensorflow-serving for %s" % jpg_file)
+            with self.stage_limits.hold("image_request", deadline), metrics.stage("image_request"):
+                predictions = self.image_transport.predict(self.image_inputs(images),
+                                                           timeout=deadline.timeout(None, "image_request"))
+            for j, response_vec in enumerate(predictions[:len(images)]):
+                log.debug("image classify %s  other=%.2f research=%.2f" % (trace_ids[j], response_vec[0], response_vec[1]))
+                ret[j] = self.decode_softmax(response_vec)
+        except admission.DeadlineExceeded:
+            raise
+        except Exception as e:
+            deadline.check("image_request")
+            metrics.BACKEND_ERRORS.labels(model="image").inc()
+            log.warning("exception occurred processing image tensorflow-serving for %s: %s" % (",".join(trace_ids), e))
         return ret
 
 
 def main():
     """
-    Apply the preprocessing to generate
+    Bulk classification of directories of PDFs, without the REST API. One JSON line per PDF is
+    appended to the output, which also lets a killed run resume where it stopped. With positive
+    and negative directories, the confusion matrices per model, and how often the models agree,
+    are printed at the end.
+
+        python -m pdf_trio.pdf_classifier --input_positive research/ --input_negative other/ \
+            --output results.jsonl --processes 16
     """
-    #  ToDo: process PDF files using all classifiers and create various confusion matrices to see where
-    #     models agree/disagree. Data comes from directories associated with a defined category.
-    #     REST api is not used.
     # init the arg parser
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_positive", type=str, default='',
-                        help="dir. with positive PDF files to process, use a comma sep for multiple dirs",
-                        required=True)
+                        help="dir. with positive PDF files to process, use a comma sep for multiple dirs")
     parser.add_argument("--input_negative", type=str, default='',
-                        help="dir. with negative PDF files to process, use a comma sep for multiple dirs",
-                        required=True)
+                        help="dir. with negative PDF files to process, use a comma sep for multiple dirs")
+    parser.add_argument("--input", type=str, default='',
+                        help="dir. with unlabeled PDF files to process, use a comma sep for multiple dirs")
+    parser.add_argument("--output", type=str, default='classify_results.jsonl',
+                        help="JSONL results file, appended to; PDFs already in it are skipped")
+    parser.add_argument("--modes", type=str, default='all',
+                        help="comma sep list of {auto, image, linear, bert, all}, all by default")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes, number of CPUs by default")
+    parser.add_argument("--batch_size", type=int, default=16,
+                        help="PDFs per worker task, their BERT and image examples share requests")
+    parser.add_argument("--feature_store", type=str, default='',
+                        help="dir. of extracted features (FEATURE_STORE_DIR), re-scoring the same PDFs "
+                             "with new models then skips extraction, optional")
     parser.add_argument("--temp", type=str, default='/tmp', help="temp dir to use during extraction, /tmp default",
                         required=False)
     parser.add_argument("--skip", type=str, default='',
@@ -393,8 +1149,31 @@ def main():
 
     # read arguments from the command line
     args = parser.parse_args()
+    if not (args.input_positive or args.input_negative or args.input):
+        parser.error("give at least one of --input_positive, --input_negative, --input")
+
+    from pdf_trio import bulk
+    logging.basicConfig(level=logging.DEBUG if args.testing else logging.INFO)
+    pdf_util.use_temp_dir(args.temp)
+    if args.feature_store:
+        os.environ['FEATURE_STORE_DIR'] = args.feature_store
+    # the processes give the parallelism, few extraction threads are needed in each
+    os.environ.setdefault('PDF_EXTRACT_WORKERS', '2')
+    skip = set()
+    if args.skip:
+        with open(args.skip, 'r') as f:
+            skip = set(line.strip() for line in f if line.strip())
+    files = itertools.chain(bulk.collect_pdf_files(args.input_positive, "research", skip),
+                            bulk.collect_pdf_files(args.input_negative, "other", skip),
+                            bulk.collect_pdf_files(args.input, None, skip))
+    if args.testing:
+        files = itertools.islice(files, 20)
+    rows = bulk.run(files, args.output, modes=args.modes, processes=args.processes, batch_size=args.batch_size)
+    print("%d PDFs in %s" % (len(rows), args.output))
+    matrices, agreement = bulk.confusion_matrices(rows)
+    if matrices:
+        print(bulk.format_confusion_matrices(matrices, agreement))
 
-    # TODO: doesn't actually call anything
 
 if __name__ == '__main__':
     main()
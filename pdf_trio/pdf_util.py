@@ -18,15 +18,28 @@ limitations under the License.
 """
 
 import os
+import sys
 import time
+import asyncio
+import functools
 import pathlib
 import time
 import shutil
 import subprocess
 import random
 import datetime
+import threading
 import atexit
 import logging
+import contextlib
+import contextvars
+import collections
+
+import numpy as np
+from cv2 import cv2
+
+from pdf_trio import metrics
+from pdf_trio.admission import NO_DEADLINE
 
 log = logging.getLogger(__name__)
 
@@ -34,6 +47,14 @@ log = logging.getLogger(__name__)
 PDF processing.
 We use pdftotext (exec'ed) because it works more often than PyPDF2.
 Images from PDFs are created by ImageMagick (and ghostscript).
+The *_from_content variants pipe the PDF bytes to the tools and read their results from
+stdout, so nothing is written to disk.
+Text can be limited to the head and tail pages of a PDF, see TextPolicy.
+render_pdf_page0 does the page image in-process with pdfium (optional pypdfium2 package).
+The subprocesses are killed after SUBPROCESS_TIMEOUT seconds, or earlier at the deadline
+(admission.Deadline) given, which then raises admission.DeadlineExceeded.
+With use_extract_pool, the extraction functions (not the *_async ones) run in the worker
+processes of an extract_pool.ExtractPool instead.
 """
 
 if not shutil.which('pdftotext'):
@@ -48,10 +69,17 @@ TEMP = os.environ.get('TEMP')
 if TEMP is None:
     TEMP = "/tmp"
 
+# seconds a pdftotext, pdfinfo or convert run may take
+SUBPROCESS_TIMEOUT = 30
+
+# keep tmp files for inspection instead of removing them after use
+KEEP_TMP_FILES = os.environ.get('KEEP_TMP_FILES', '0') not in ('', '0')
+
 start_datetime = datetime.datetime.now()
 start_timestamp = start_datetime.isoformat().split('.')[0]
 start_timestamp = start_timestamp.replace(":", "").replace("-", "")
-tmp_area = TEMP + "/research-pub-area_" + start_timestamp
+# with the pid, extraction worker processes started in the same second import this too
+tmp_area = "%s/research-pub-area_%s_%d" % (TEMP, start_timestamp, os.getpid())
 tmp_path = pathlib.Path(tmp_area)
 tmp_path.mkdir(parents=True, exist_ok=True)
 
@@ -63,6 +91,75 @@ def exit_handler():
 atexit.register(exit_handler)  # remove tmp_area on exit
 
 
+def use_temp_dir(temp_dir):
+    """
+    Move the tmp area under temp_dir, like setting TEMP before this module is imported.
+    """
+    global TEMP, tmp_area, tmp_path
+    shutil.rmtree(tmp_area, ignore_errors=True)
+    TEMP = temp_dir
+    tmp_area = "%s/research-pub-area_%s_%d" % (TEMP, start_timestamp, os.getpid())
+    tmp_path = pathlib.Path(tmp_area)
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+
+# extract_pool.ExtractPool that runs the extraction functions, None to run them in this process
+_extract_pool = None
+
+
+def use_extract_pool(pool):
+    """
+    Run extract_pdf_text, extract_pdf_image, their *_from_content variants and render_pdf_page0
+    in the worker processes of pool, or in this process if pool is None.
+    """
+    global _extract_pool
+    _extract_pool = pool
+
+
+class ExtractionStatus:
+    """
+    Whether the extractions run within extraction_status() completed: complete is False once a
+    command timed out, or an extraction worker died or was killed, so the result may be partial
+    or empty for a temporary reason rather than describe the PDF.
+    """
+
+    def __init__(self):
+        self.complete = True
+
+
+# ExtractionStatus of the thread or asyncio task, set by extraction_status()
+_status = contextvars.ContextVar('pdf_util_extraction_status', default=None)
+
+
+@contextlib.contextmanager
+def extraction_status():
+    """
+    Track the extractions run in the block, in this thread or asyncio task:
+
+        with pdf_util.extraction_status() as status:
+            text = pdf_util.extract_pdf_text(...)
+        if status.complete:
+            ...
+
+    :return: ExtractionStatus
+    """
+    status = ExtractionStatus()
+    token = _status.set(status)
+    try:
+        yield status
+    finally:
+        _status.reset(token)
+
+
+def mark_incomplete():
+    """
+    Record in the current extraction_status() that an extraction did not complete.
+    """
+    status = _status.get()
+    if status is not None:
+        status.complete = False
+
+
 def tmp_file_name(prefix="f", suffix=".pdf"):
     return str(tmp_path) + "/" + str(prefix) + str(random.randint(1, 1000000000)) + suffix
 
@@ -83,6 +180,14 @@ def remove_tmp_file(name):
         os.remove(name)
 
 
+def discard_tmp_file(name):
+    """
+    Remove a tmp file after use, unless KEEP_TMP_FILES is set.
+    """
+    if not KEEP_TMP_FILES:
+        remove_tmp_file(name)
+
+
 def extract_pdf_text_prev(pdf_tmp_file):
     """
     Extract text from PDF. The text is extracted in human-reading order. EOL chars are present.
@@ -110,27 +215,166 @@ def extract_pdf_text_prev(pdf_tmp_file):
     return text
 
 
-def extract_pdf_text(pdf_tmp_file):
+class TextPolicy(collections.namedtuple('TextPolicy', ['head_pages', 'tail_pages', 'max_tokens'])):
+    """
+    How much of a PDF the text of a classifier comes from: the first head_pages and the last
+    tail_pages pages, all pages if both are 0, then at most max_tokens tokens (0 for no limit)
+    split between the head and tail of the text like text_prep.trim_tokens does.
+    """
+
+    def whole_document(self):
+        return self.head_pages == 0 and self.tail_pages == 0
+
+    def union(self, other):
+        """
+        :return: policy extracting enough text for both policies
+        """
+        if self.whole_document() or other.whole_document():
+            pages = (0, 0)
+        else:
+            pages = (max(self.head_pages, other.head_pages), max(self.tail_pages, other.tail_pages))
+        if self.max_tokens == 0 or other.max_tokens == 0:
+            max_tokens = 0
+        else:
+            max_tokens = max(self.max_tokens, other.max_tokens)
+        return TextPolicy(pages[0], pages[1], max_tokens)
+
+
+# all of the text
+WHOLE_DOCUMENT = TextPolicy(0, 0, 0)
+
+
+def text_policy_from_env(prefix, head_pages=0, tail_pages=0, max_tokens=0):
+    """
+    :param prefix: like LINEAR, the env vars are <prefix>_HEAD_PAGES, <prefix>_TAIL_PAGES, <prefix>_MAX_TOKENS
+    :return: TextPolicy with the given defaults for unset env vars
+    """
+    policy = TextPolicy(int(os.environ.get(prefix + '_HEAD_PAGES', head_pages)),
+                        int(os.environ.get(prefix + '_TAIL_PAGES', tail_pages)),
+                        int(os.environ.get(prefix + '_MAX_TOKENS', max_tokens)))
+    if min(policy) < 0:
+        raise ValueError('%s_HEAD_PAGES, %s_TAIL_PAGES and %s_MAX_TOKENS must not be negative' %
+                         (prefix, prefix, prefix))
+    return policy
+
+
+def parse_page_count(pdfinfo_output):
+    """
+    :param pdfinfo_output: stdout of pdfinfo, bytes
+    :return: number of pages, 0 if not found
+    """
+    for line in pdfinfo_output.decode('utf-8', errors='replace').splitlines():
+        if line.startswith("Pages:"):
+            try:
+                return int(line.split(":", 1)[1])
+            except ValueError:
+                break
+    return 0
+
+
+def page_ranges(page_count, policy):
+    """
+    :param page_count: pages in the PDF, 0 if unknown
+    :return: list of (first, last) page numbers (from 1) to extract, or [None] for all pages
+    """
+    if policy.whole_document() or page_count <= 0 or page_count <= policy.head_pages + policy.tail_pages:
+        return [None]
+    ranges = []
+    if policy.head_pages:
+        ranges.append((1, policy.head_pages))
+    if policy.tail_pages:
+        ranges.append((page_count - policy.tail_pages + 1, page_count))
+    return ranges
+
+
+def text_page_ranges(policy, page_count):
+    """
+    :param policy: TextPolicy
+    :param page_count: function returning the number of pages, 0 if unknown; only called (pdfinfo
+        is one more process per PDF) when the policy has tail pages
+    :return: list of (first, last) page numbers (from 1) to extract, or [None] for all pages
+    """
+    if policy.whole_document():
+        return [None]
+    if not policy.tail_pages:
+        # pdftotext stops at the last page by itself
+        return [(1, policy.head_pages)]
+    return page_ranges(page_count(), policy)
+
+
+def page_range_args(page_range):
+    """
+    :return: pdftotext args limiting it to the (first, last) page range, none for None
+    """
+    if page_range is None:
+        return []
+    return ['-f', str(page_range[0]), '-l', str(page_range[1])]
+
+
+def pdftotext_pipe_args(page_range=None):
+    """
+    :return: pdftotext command reading the PDF from stdin and writing the text of the page range to stdout
+    """
+    return PDFTOTEXT_PIPE_ARGS[:-2] + page_range_args(page_range) + ['-', '-']
+
+
+def pdf_page_count(pdf_tmp_file, deadline=NO_DEADLINE):
+    """
+    :param pdf_tmp_file: path to (temp) pdf file.
+    :param deadline: admission.Deadline
+    :return: number of pages according to pdfinfo, 0 if unknown
+    """
+    try:
+        return parse_page_count(subprocess.run(['pdfinfo', pdf_tmp_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                               timeout=deadline.timeout(SUBPROCESS_TIMEOUT, "pdfinfo")).stdout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        deadline.check("pdfinfo")
+        if isinstance(e, subprocess.TimeoutExpired):
+            mark_incomplete()
+        log.warning("pdfinfo failed on %s: %s" % (pdf_tmp_file, e))
+        return 0
+
+
+def extract_pdf_text(pdf_tmp_file, policy=WHOLE_DOCUMENT, deadline=NO_DEADLINE):
     """
     Extract text from PDF. The text is extracted in human-reading order. EOL chars are present.
     :param pdf_tmp_file: path to (temp) pdf file.
+    :param policy: TextPolicy, the pages to extract; max_tokens is left to the caller
+    :param deadline: admission.Deadline
     :return: string of extracted human readable text from PDF, zero length string if could not extract or no text.
     """
+    if _extract_pool is not None:
+        return _extract_pool.call('extract_pdf_text', pdf_tmp_file, policy, deadline)
+    ranges = text_page_ranges(policy, lambda: pdf_page_count(pdf_tmp_file, deadline))
+    return "\n".join(_extract_pdf_text_range(pdf_tmp_file, page_range, deadline) for page_range in ranges)
+
+
+def _extract_pdf_text_range(pdf_tmp_file, page_range, deadline=NO_DEADLINE):
     txt_name = pdf_tmp_file + ".txt"
     # start subprocess
-    p_args = ['pdftotext', '-nopgbrk', '-eol', 'unix', '-enc', 'UTF-8', pdf_tmp_file, txt_name]
+    p_args = ['pdftotext', '-nopgbrk', '-eol', 'unix', '-enc', 'UTF-8'] + page_range_args(page_range) + \
+        [pdf_tmp_file, txt_name]
+    timeout = deadline.timeout(SUBPROCESS_TIMEOUT, "pdftotext")
     t0 = time.time()
     pp = subprocess.Popen(p_args, encoding='utf-8', bufsize=1, universal_newlines=True,
                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     try:
-        outs, errs = pp.communicate(timeout=30)
+        outs, errs = pp.communicate(timeout=timeout)
         # outs and errs are file handles
     except subprocess.TimeoutExpired:
         pp.kill()
         # drain residue so subprocess can really finish
         outs, errs = pp.communicate()
+        if deadline.expired():
+            remove_tmp_file(txt_name)
+            deadline.check("pdftotext")
+        mark_incomplete()
+        metrics.SUBPROCESS_TIMEOUTS.labels(command="pdftotext").inc()
         log.warning("pdftotext, command did not terminate in %.2f seconds, terminating." % (time.time() - t0))
     # get text from file
+    if not os.path.exists(txt_name):
+        # killed before it wrote anything
+        return ""
     with open(txt_name, 'r', encoding='utf-8') as f:
         text = f.read()
     remove_tmp_file(txt_name)
@@ -183,15 +427,18 @@ def extract_pdf_image_prev(pdf_tmp_file, page=0):
     return ""
 
 
-def extract_pdf_image(pdf_tmp_file, page=0):
+def extract_pdf_image(pdf_tmp_file, page=0, deadline=NO_DEADLINE):
     """
     ImageMagick (and ghostscript) is used to generate the image.
     Caller is responsible for removing the jpg.
     :param pdf_tmp_file: path to temp file holding pdf content.
     :param page:  page number (from 0)
+    :param deadline: admission.Deadline
     :return: filename of jpg image in temporary area, caller should remove it when done to avoid accumulation,
         empty string returned if no good image produced.
     """
+    if _extract_pool is not None:
+        return _extract_pool.call('extract_pdf_image', pdf_tmp_file, page, deadline)
     jpg_name = pdf_tmp_file + ".jpg"
     pageSpec = "[" + str(page) + "]"
     # start subprocess
@@ -204,15 +451,21 @@ def extract_pdf_image(pdf_tmp_file, page=0):
                    '224x224', jpg_name]
     if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
         log.debug("ImageMagick Command=" + " ".join(convert_cmd))
+    timeout = deadline.timeout(SUBPROCESS_TIMEOUT, "convert")
     t0 = time.time()
     pp = subprocess.Popen(convert_cmd, encoding='utf-8', bufsize=1, universal_newlines=True,
                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     try:
-        outs, errs = pp.communicate(timeout=30)
+        outs, errs = pp.communicate(timeout=timeout)
     except subprocess.TimeoutExpired:
         pp.kill()
         # drain residue so subprocess can really finish
         outs, errs = pp.communicate()
+        if deadline.expired():
+            remove_tmp_file(jpg_name)
+            deadline.check("convert")
+        mark_incomplete()
+        metrics.SUBPROCESS_TIMEOUTS.labels(command="convert").inc()
         log.warning("convert command (imagemagick) on %s did not terminate in %.2f seconds, terminating." %
                     (pdf_tmp_file, time.time()-t0))
     # check if jpg file exists and sufficient size
@@ -229,3 +482,181 @@ def extract_pdf_image(pdf_tmp_file, page=0):
         # no jpg file was produced
         log.warning("no jpg produced by imagemagick for %s" % pdf_tmp_file)
         return ""
+
+
+def run_piped(p_args, input_bytes, timeout=SUBPROCESS_TIMEOUT, deadline=NO_DEADLINE):
+    """
+    Run a command with input_bytes on its stdin.
+    :param deadline: admission.Deadline, which cuts the timeout to the time left
+    :return: stdout bytes, possibly partial if the command did not finish within timeout seconds
+    """
+    timeout = deadline.timeout(timeout, p_args[0])
+    t0 = time.time()
+    pp = subprocess.Popen(p_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        outs, errs = pp.communicate(input=input_bytes, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        pp.kill()
+        # drain residue so subprocess can really finish
+        outs, errs = pp.communicate()
+        deadline.check(p_args[0])
+        mark_incomplete()
+        metrics.SUBPROCESS_TIMEOUTS.labels(command=p_args[0]).inc()
+        log.warning("%s command did not terminate in %.2f seconds, terminating." % (p_args[0], time.time() - t0))
+    if errs and logging.getLogger().getEffectiveLevel() == logging.DEBUG:
+        log.debug("%s stderr: %s" % (p_args[0], errs[:1000]))
+    return outs
+
+
+async def run_piped_async(p_args, input_bytes, timeout=SUBPROCESS_TIMEOUT):
+    """
+    Like run_piped, for asyncio callers. The command is killed if the calling task is cancelled.
+    :return: stdout bytes, possibly partial if the command did not finish within timeout seconds
+    """
+    if sys.version_info < (3, 8) and threading.current_thread() is not threading.main_thread():
+        # before 3.8 the child watcher only works for an event loop in the main thread
+        # in a copy of the context, for the extraction_status() of the task
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(contextvars.copy_context().run, run_piped, p_args, input_bytes, timeout))
+    t0 = time.time()
+    pp = await asyncio.create_subprocess_exec(*p_args, stdin=asyncio.subprocess.PIPE,
+                                              stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        outs, errs = await asyncio.wait_for(pp.communicate(input=input_bytes), timeout=timeout)
+    except asyncio.TimeoutError:
+        pp.kill()
+        await pp.wait()
+        mark_incomplete()
+        metrics.SUBPROCESS_TIMEOUTS.labels(command=p_args[0]).inc()
+        log.warning("%s command did not terminate in %.2f seconds, terminating." % (p_args[0], time.time() - t0))
+        return b""
+    except asyncio.CancelledError:
+        pp.kill()
+        raise
+    if errs and logging.getLogger().getEffectiveLevel() == logging.DEBUG:
+        log.debug("%s stderr: %s" % (p_args[0], errs[:1000]))
+    return outs
+
+
+# pdftotext reading the PDF from stdin and writing the text to stdout
+PDFTOTEXT_PIPE_ARGS = ['pdftotext', '-nopgbrk', '-eol', 'unix', '-enc', 'UTF-8', '-', '-']
+
+
+def convert_pipe_args(page=0):
+    """
+    :return: ImageMagick command reading the PDF from stdin and writing the jpg of the page to stdout
+    """
+    # the parameters here must match training to maximize accuracy
+    return ['convert', 'pdf:-[' + str(page) + ']', '-background', 'white',
+            '-alpha', 'remove', '-equalize', '-quality', '95',
+            '-thumbnail', '156x', '-gravity', 'north', '-extent',
+            '224x224', 'jpg:-']
+
+
+def check_jpg(jpg):
+    """
+    :return: the jpg bytes, or empty if too small, which means a blank page or no image produced.
+    """
+    if len(jpg) <= 3000:
+        log.debug("jpg of %d bytes is too small, so assumed to be a blank page" % len(jpg))
+        return b""
+    return jpg
+
+
+def extract_pdf_text_from_content(pdf_content, policy=WHOLE_DOCUMENT, deadline=NO_DEADLINE):
+    """
+    Like extract_pdf_text, but the PDF is piped through pdftotext, no file is written.
+    :param pdf_content: PDF bytes
+    :param policy: TextPolicy, the pages to extract; max_tokens is left to the caller
+    :param deadline: admission.Deadline
+    :return: string of extracted human readable text from PDF, zero length string if could not extract or no text.
+    """
+    if _extract_pool is not None:
+        return _extract_pool.call('extract_pdf_text_from_content', pdf_content, policy, deadline)
+    ranges = text_page_ranges(policy, lambda: parse_page_count(run_piped(['pdfinfo', '-'], pdf_content,
+                                                                          deadline=deadline)))
+    return "\n".join(run_piped(pdftotext_pipe_args(page_range), pdf_content, deadline=deadline)
+                     .decode('utf-8', errors='replace') for page_range in ranges)
+
+
+def extract_pdf_image_from_content(pdf_content, page=0, deadline=NO_DEADLINE):
+    """
+    Like extract_pdf_image, but the PDF is piped through ImageMagick and the jpg returned in memory.
+    :param pdf_content: PDF bytes
+    :param page:  page number (from 0)
+    :param deadline: admission.Deadline
+    :return: jpg bytes, empty if no good image produced.
+    """
+    if _extract_pool is not None:
+        return _extract_pool.call('extract_pdf_image_from_content', pdf_content, page, deadline)
+    return check_jpg(run_piped(convert_pipe_args(page), pdf_content, deadline=deadline))
+
+
+async def extract_pdf_text_from_content_async(pdf_content, policy=WHOLE_DOCUMENT):
+    """
+    Like extract_pdf_text_from_content, for asyncio callers.
+    """
+    if policy.whole_document() or not policy.tail_pages:
+        ranges = text_page_ranges(policy, None)
+    else:
+        ranges = page_ranges(parse_page_count(await run_piped_async(['pdfinfo', '-'], pdf_content)), policy)
+    texts = [await run_piped_async(pdftotext_pipe_args(page_range), pdf_content) for page_range in ranges]
+    return "\n".join(text.decode('utf-8', errors='replace') for text in texts)
+
+
+async def extract_pdf_image_from_content_async(pdf_content, page=0):
+    """
+    Like extract_pdf_image_from_content, for asyncio callers.
+    """
+    return check_jpg(await run_piped_async(convert_pipe_args(page), pdf_content))
+
+
+# pdfium is not thread safe, calls into it are serialized
+_pdfium_lock = threading.Lock()
+
+
+def render_pdf_page0(pdf, page=0, deadline=NO_DEADLINE):
+    """
+    In-process alternative to extract_pdf_image: pdfium renders the page at 72 dpi (the
+    ImageMagick default density) directly into an array, then the convert steps used for
+    training are applied: white background with alpha removed, per channel equalize,
+    thumbnail to 156 px wide, north gravity extent to 224x224 on white, and the quality 95
+    jpg encoding. The page is not rendered at the thumbnail size: convert equalizes the 72 dpi
+    page before the thumbnail, and equalizing a smaller render changes the image a lot more
+    than the rasterizers differ.
+    :param pdf: path to (temp) pdf file, or PDF bytes
+    :param page:  page number (from 0)
+    :param deadline: admission.Deadline, checked before rendering, which cannot be interrupted
+    :return: uint8 BGR array of shape (224, 224, 3), None if no good image produced.
+    """
+    if _extract_pool is not None:
+        return _extract_pool.call('render_pdf_page0', pdf, page, deadline)
+    deadline.check("extract_image")
+    import pypdfium2  # optional, only needed for PDF_RASTERIZER=pdfium
+    try:
+        with _pdfium_lock:
+            doc = pypdfium2.PdfDocument(pdf)
+            try:
+                bitmap = doc[page].render(scale=1, fill_color=(255, 255, 255, 255))
+                # BGRx, like cv2.imread; copy out of the pdfium buffer before it is released
+                img = np.ascontiguousarray(bitmap.to_numpy()[:, :, :3])
+            finally:
+                doc.close()
+    except Exception as e:
+        log.warning("pdfium could not render page %d: %s" % (page, e))
+        return None
+    for c in range(3):
+        img[:, :, c] = cv2.equalizeHist(np.ascontiguousarray(img[:, :, c]))
+    h, w = img.shape[:2]
+    thumb_h = max(1, int(round(h * 156.0 / w)))
+    thumb = cv2.resize(img, (156, thumb_h), interpolation=cv2.INTER_AREA)
+    canvas = np.full((224, 224, 3), 255, dtype=np.uint8)
+    x0 = (224 - 156) // 2
+    rows = min(224, thumb_h)
+    canvas[:rows, x0:x0 + 156] = thumb[:rows]
+    # the jpg of the convert path, and the same blank page criterion: the jpg is too small
+    ok, jpg = cv2.imencode('.jpg', canvas, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok or len(jpg) <= 3000:
+        log.debug("page image too plain, so assumed to be a blank page")
+        return None
+    return cv2.imdecode(jpg, cv2.IMREAD_COLOR)
@@ -0,0 +1,172 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Content-addressed cache of classification results.
+
+The key is derived from the SHA-1 of the PDF bytes, the requested modes and the model
+version map, so deploying a new model version naturally stops old entries from matching.
+There is an in-process LRU tier and an optional SQLite tier, shared by all processes using
+the same file, with size-based eviction of the least recently used entries.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import collections
+
+from pdf_trio import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ResultCache:
+
+    def __init__(self, max_entries=1000, db_path=None, max_db_mb=1024):
+        """
+        :param max_entries: size of the in-process LRU tier, 0 to disable it.
+        :param db_path: path of the SQLite file for the persistent tier, None to disable it.
+        :param max_db_mb: max size of the stored results in the persistent tier.
+        """
+        self.max_entries = max_entries
+        self.lru = collections.OrderedDict()  # key -> json string
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.db = None
+        self.max_db_bytes = max_db_mb * 1024 * 1024
+        if db_path:
+            self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, atime REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS results_atime ON results (atime)")
+            self.db_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def make_key(pdf_content, modes, version_map, variant=""):
+        """
+        :param pdf_content: PDF bytes
+        :param modes: comma sep list of modes as requested
+        :param version_map: model name to version
+        :param variant: anything else the results depend on, like the auto mode cascade
+        :return: key string
+        """
+        content_sha1 = hashlib.sha1(pdf_content).hexdigest()
+        mode_key = ",".join(sorted(set(modes.split(","))))
+        version_key = json.dumps(version_map, sort_keys=True)
+        if variant:
+            version_key += "|" + variant
+        return content_sha1 + ":" + hashlib.sha1((mode_key + "|" + version_key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: a fresh copy of the cached results map, or None
+        """
+        with self.lock:
+            value = self.lru.get(key)
+            if value is not None:
+                self.lru.move_to_end(key)
+                self.counts["memory_hits"] += 1
+                metrics.CACHE_LOOKUPS.labels(result="memory_hit").inc()
+                return json.loads(value)
+            if self.db is not None:
+                row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE results SET atime = ? WHERE key = ?", (time.time(), key))
+                    self._lru_put(key, row[0])
+                    self.counts["disk_hits"] += 1
+                    metrics.CACHE_LOOKUPS.labels(result="disk_hit").inc()
+                    return json.loads(row[0])
+            self.counts["misses"] += 1
+            metrics.CACHE_LOOKUPS.labels(result="miss").inc()
+            return None
+
+    def put(self, key, results):
+        """
+        :param results: JSON serializable results map
+        """
+        value = json.dumps(results)
+        with self.lock:
+            self.counts["puts"] += 1
+            self._lru_put(key, value)
+            if self.db is not None:
+                old = self.db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO results (key, value, size, atime) VALUES (?, ?, ?, ?)",
+                                (key, value, len(value), time.time()))
+                self.db_bytes += len(value) - (old[0] if old else 0)
+                if self.db_bytes > self.max_db_bytes:
+                    self._evict_db()
+
+    def stats(self):
+        with self.lock:
+            hits = self.counts["memory_hits"] + self.counts["disk_hits"]
+            lookups = hits + self.counts["misses"]
+            stats_map = dict(self.counts)
+            stats_map.update({
+                "hit_rate": (hits / lookups) if lookups else 0.0,
+                "memory_entries": len(self.lru),
+            })
+            if self.db is not None:
+                stats_map["disk_bytes"] = self.db_bytes
+            return stats_map
+
+    def _lru_put(self, key, value):
+        # caller holds self.lock
+        if self.max_entries <= 0:
+            return
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+            self.counts["memory_evictions"] += 1
+
+    def _evict_db(self):
+        # caller holds self.lock; other processes may share the file, so recount first
+        self.db_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        target = int(self.max_db_bytes * 0.9)
+        if self.db_bytes <= self.max_db_bytes:
+            return
+        evicted = 0
+        while self.db_bytes > target:
+            rows = self.db.execute("SELECT key, size FROM results ORDER BY atime LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.db_bytes <= target:
+                    break
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.db_bytes -= size
+                evicted += 1
+        self.counts["disk_evictions"] += evicted
+        log.info("result cache evicted %d entries, %d bytes remain" % (evicted, self.db_bytes))
+
+
+def result_cache_from_env():
+    """
+    Build the cache according to env vars RESULT_CACHE_SIZE (in-process entries, 1000 by default),
+    RESULT_CACHE_DB (SQLite path, unset by default) and RESULT_CACHE_DB_MB (1024 by default).
+    :return: ResultCache, or None if both tiers are disabled
+    """
+    max_entries = int(os.environ.get('RESULT_CACHE_SIZE', 1000))
+    db_path = os.environ.get('RESULT_CACHE_DB')
+    if max_entries <= 0 and not db_path:
+        return None
+    return ResultCache(max_entries=max_entries, db_path=db_path,
+                       max_db_mb=float(os.environ.get('RESULT_CACHE_DB_MB', 1024)))
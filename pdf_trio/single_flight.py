@@ -0,0 +1,113 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Coalescing of concurrent classifications of the same PDF, see SINGLE_FLIGHT.
+
+When a crawler retries, or several harvesters fetch the same URL, copies of a PDF arrive at
+the same time. The first request for a key (the result cache key: PDF hash, modes, model
+versions) classifies the PDF; the requests for the same key that arrive while it is in
+flight wait for its result instead of running the pipeline again. An error of the first
+request is raised to every waiter, except when it only ended the first request (its deadline
+passed, or it was cancelled), which LeaderGone tells the waiters.
+"""
+
+import os
+import copy
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from pdf_trio import admission
+
+log = logging.getLogger(__name__)
+
+
+class LeaderGone(Exception):
+    """
+    The first request stopped for a reason of its own, its deadline or a cancellation; a
+    waiter with time left classifies the PDF itself.
+    """
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> concurrent.futures.Future of the results map
+        self.counts = collections.Counter()
+
+    def begin(self, key):
+        """
+        :param key: what the results depend on, like ResultCache.make_key gives
+        :return: (future, True) if the caller is the first for the key and must call finish,
+            (future of the first request, False) if one is in flight
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.counts["coalesced"] += 1
+                return future, False
+            future = self.in_flight[key] = concurrent.futures.Future()
+            self.counts["leaders"] += 1
+            return future, True
+
+    def finish(self, key, future, results=None, error=None):
+        """
+        Hand the results, or the error, of the first request to the waiters.
+        """
+        # on python 3.7, asyncio.CancelledError is concurrent.futures.CancelledError, an Exception
+        if error is not None and (isinstance(error, (admission.DeadlineExceeded, asyncio.CancelledError,
+                                                     concurrent.futures.CancelledError))
+                                  or not isinstance(error, Exception)):
+            error = LeaderGone("the first request stopped: %r" % error)
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+            if error is not None:
+                self.counts["errors"] += 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(results)
+
+    @staticmethod
+    def wait(future, timeout=None):
+        """
+        :param timeout: max seconds to wait, None for no limit
+        :return: a copy of the results map of the first request
+        :raise concurrent.futures.TimeoutError: after timeout seconds
+        :raise LeaderGone: when the first request stopped for a reason of its own
+        :raise: the exception of the first request
+        """
+        return copy.deepcopy(future.result(timeout))
+
+    def stats(self):
+        with self.lock:
+            stats_map = dict(self.counts)
+            stats_map["in_flight"] = len(self.in_flight)
+            return stats_map
+
+
+def single_flight_from_env():
+    """
+    :return: SingleFlight, or None if disabled by env var SINGLE_FLIGHT=0 (on by default)
+    """
+    if os.environ.get('SINGLE_FLIGHT', '1') in ('', '0'):
+        return None
+    return SingleFlight()
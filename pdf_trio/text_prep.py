@@ -20,6 +20,7 @@ Text tokenization helpers.
 """
 
 import collections
+import itertools
 import re
 import logging
 import string
@@ -37,23 +38,59 @@ for i in range(8192, 8303):
         continue
     expanded_punct = expanded_punct + chr(i)
 
-def extract_tokens(str_content):
+# a token as split by extract_tokens: a run of non-whitespace, non-control chars
+_token_re = re.compile(r'[^\s\x00-\x1F]+')
+
+
+def extract_tokens(str_content, max_tokens=0):
     """
     Clean given string and return the cleaned list of tokens.
     Punctuation, excess whitespace, control chars, funny stuff, is removed.
     :param str_content: raw string
+    :param max_tokens: token budget, 0 for no limit; when the text has more tokens, only its head
+        and tail are scanned and the result is the same as trim_tokens(extract_tokens(str_content), max_tokens)
     :return: token list, preserving order from document.
     """
-    # convert control and EOL chars to space
-    str_content = re.sub(r'[\x00-\x1F]+', ' ', str_content)
-    # split by whitespace
-    tokens = str_content.split()
+    if max_tokens:
+        tokens = _head_tail_tokens(str_content, max_tokens)
+    else:
+        # convert control and EOL chars to space
+        str_content = re.sub(r'[\x00-\x1F]+', ' ', str_content)
+        # split by whitespace
+        tokens = str_content.split()
 
     ttable = str.maketrans('', '', expanded_punct)
     tokens = [w.translate(ttable) for w in tokens]
     return tokens
 
 
+def _head_tail_tokens(str_content, max_tokens):
+    """
+    :return: raw tokens split like extract_tokens does, with the same head and tail split as trim_tokens,
+        without splitting the middle of the text.
+    """
+    head_count = int(max_tokens/2)
+    tail_count = max_tokens - head_count
+    head = []
+    head_end = 0
+    for m in itertools.islice(_token_re.finditer(str_content), head_count):
+        head.append(m.group())
+        head_end = m.end()
+    if len(head) < head_count:
+        return head  # all of the text
+    # scan back from the end with a growing window until enough tail tokens are found
+    window = 16 * tail_count
+    while True:
+        start = max(head_end, len(str_content) - window)
+        tail = _token_re.findall(str_content, start)
+        if start > head_end and _token_re.match(str_content, start - 1):
+            tail = tail[1:]  # the window starts inside a token
+        if len(tail) >= tail_count or start == head_end:
+            break
+        window *= 2
+    return head + tail[-tail_count:]
+
+
 def basename(fpath):
     offset_slash = fpath.rfind("/")
     if offset_slash >= 0:
@@ -0,0 +1,498 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Inference transports to tensorflow-serving.
+
+Each transport has predict(inputs) where inputs is an ordered map of input name to a numpy
+array whose first dimension is the batch, and returns a numpy array with one row per example.
+A timeout given to predict, like the time left until the deadline of a request, shortens the
+configured timeouts of that call.
+
+RestTransport uses JSON over HTTP with a keep-alive connection pool.
+GrpcTransport sends TensorProto messages with binary tensor_content over gRPC; it only needs
+the grpcio package because the few protobuf messages involved are encoded here directly
+instead of pulling in tensorflow-serving-api (and so tensorflow).
+OnnxTransport runs an ONNX export of the model in-process with ONNX Runtime on CPU, no
+tensorflow-serving needed.
+"""
+
+import os
+import json
+import asyncio
+import struct
+import logging
+import collections
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+PREDICT_METHOD = '/tensorflow.serving.PredictionService/Predict'
+
+
+class TransportError(Exception):
+    pass
+
+
+class RestTransport:
+    """
+    tensorflow-serving REST predict API over a pooled, keep-alive requests.Session.
+    """
+
+    def __init__(self, server_prefix, model_name, instances_input=None, signature_name="serving_default",
+                 pool_size=16, connect_timeout=5.0, read_timeout=30.0):
+        """
+        :param server_prefix: base API URL like http://localhost:8501/v1
+        :param model_name: like bert_model
+        :param instances_input: if set, the named input is sent in row format ("instances") and
+            the "predictions" are returned; otherwise all inputs are sent in columnar format ("inputs").
+        :param pool_size: max kept-alive connections, should be at least the number of concurrent callers.
+        """
+        self.url = server_prefix + "/models/" + model_name + ":predict"
+        self.instances_input = instances_input
+        self.signature_name = signature_name
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.json_content_header = {"Content-Type": "application/json"}
+
+    def __str__(self):
+        return self.url
+
+    def predict(self, inputs, timeout=None):
+        """
+        :param inputs: ordered map of input name to numpy array, batch is the first dimension.
+        :param timeout: seconds, if shorter than the configured connect and read timeouts
+        :return: numpy array of model outputs, one row per example
+        """
+        req_json, result_key = rest_request(inputs, self.instances_input, self.signature_name)
+        log.debug("request to %s is: %s ... %s" % (self.url, req_json[:80], req_json[len(req_json)-50:]))
+        response = self.session.post(self.url, data=req_json, headers=self.json_content_header,
+                                     timeout=self.timeout if timeout is None else
+                                     tuple(min(t, timeout) for t in self.timeout))
+        if response.status_code != 200:
+            raise TransportError("HTTP %d from %s: %s" % (response.status_code, self.url, response.text[:500]))
+        return np.asarray(response.json()[result_key], dtype=np.float64)
+
+
+class AsyncRestTransport:
+    """
+    Like RestTransport, for asyncio callers, over a pooled httpx.AsyncClient.
+    """
+
+    def __init__(self, server_prefix, model_name, instances_input=None, signature_name="serving_default",
+                 pool_size=100, connect_timeout=5.0, read_timeout=30.0):
+        """
+        See RestTransport. pool_size can be much larger, since a connection costs no thread here.
+        """
+        import httpx  # optional, only needed for the asyncio server
+        self.url = server_prefix + "/models/" + model_name + ":predict"
+        self.instances_input = instances_input
+        self.signature_name = signature_name
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        self.json_content_header = {"Content-Type": "application/json"}
+
+    def __str__(self):
+        return self.url
+
+    async def predict(self, inputs, timeout=None):
+        """
+        :param inputs: ordered map of input name to numpy array, batch is the first dimension.
+        :param timeout: seconds, if shorter than the configured connect and read timeouts
+        :return: numpy array of model outputs, one row per example
+        """
+        # encoding a batch of images as JSON takes a while, keep it off the event loop
+        req_json, result_key = await asyncio.get_running_loop().run_in_executor(
+            None, rest_request, inputs, self.instances_input, self.signature_name)
+        if timeout is None:
+            response = await self.client.post(self.url, content=req_json, headers=self.json_content_header)
+        else:
+            import httpx
+            configured = self.client.timeout
+            response = await self.client.post(self.url, content=req_json, headers=self.json_content_header,
+                                              timeout=httpx.Timeout(min(configured.read, timeout),
+                                                                    connect=min(configured.connect, timeout)))
+        if response.status_code != 200:
+            raise TransportError("HTTP %d from %s: %s" % (response.status_code, self.url, response.text[:500]))
+        return np.asarray(response.json()[result_key], dtype=np.float64)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def rest_request(inputs, instances_input, signature_name):
+    """
+    :return: JSON body of a REST predict request, and the key of the results in the response
+    """
+    if instances_input:
+        req = {"signature_name": signature_name, "instances": inputs[instances_input].tolist()}
+        return json.dumps(req), "predictions"
+    req = {"signature_name": signature_name, "inputs": {k: v.tolist() for k, v in inputs.items()}}
+    return json.dumps(req), "outputs"
+
+
+class GrpcTransport:
+    """
+    tensorflow-serving gRPC PredictionService/Predict, tensors sent as binary tensor_content.
+    """
+
+    def __init__(self, target, model_name, output_key=None, signature_name="serving_default",
+                 timeout=30.0, max_message_mb=64):
+        """
+        :param target: host:port of the tensorflow-serving gRPC port (8500 by default)
+        :param model_name: like bert_model
+        :param output_key: name of the output tensor to return, or None if the model has just one
+        """
+        import grpc  # optional, only needed for this transport
+        self.target = target
+        self.model_name = model_name
+        self.output_key = output_key
+        self.signature_name = signature_name
+        self.timeout = timeout
+        max_bytes = max_message_mb * 1024 * 1024
+        self.channel = grpc.insecure_channel(target, options=[
+            ('grpc.max_send_message_length', max_bytes),
+            ('grpc.max_receive_message_length', max_bytes),
+        ])
+        self.predict_call = self.channel.unary_unary(PREDICT_METHOD)
+
+    def __str__(self):
+        return "grpc://%s/%s" % (self.target, self.model_name)
+
+    def predict(self, inputs, timeout=None):
+        """
+        :param inputs: ordered map of input name to numpy array, batch is the first dimension.
+        :param timeout: seconds, if shorter than the configured timeout
+        :return: numpy array of model outputs, one row per example
+        """
+        import grpc
+        request = encode_predict_request(self.model_name, self.signature_name, inputs)
+        if timeout is not None:
+            timeout = min(self.timeout, timeout)
+        try:
+            response = self.predict_call(request, timeout=self.timeout if timeout is None else timeout)
+        except grpc.RpcError as e:
+            raise TransportError("gRPC error from %s: %s" % (self, e))
+        outputs = decode_predict_response(response)
+        if self.output_key:
+            if self.output_key not in outputs:
+                raise TransportError("output %s not in response from %s, got %s" %
+                                     (self.output_key, self, sorted(outputs)))
+            return outputs[self.output_key]
+        if len(outputs) != 1:
+            raise TransportError("set an output key, %s returned outputs %s" % (self, sorted(outputs)))
+        return list(outputs.values())[0]
+
+
+# ONNX Runtime input types
+ONNX_TO_NP = {"tensor(float)": np.float32, "tensor(double)": np.float64,
+              "tensor(int32)": np.int32, "tensor(int64)": np.int64}
+
+
+class OnnxTransport:
+    """
+    In-process inference of an ONNX model with ONNX Runtime on CPU. Takes the same inputs as
+    the tensorflow-serving transports: inputs the model does not have (like the BERT label_ids
+    dummy) are left out, and they are cast to the integer or float type the model expects.
+    """
+
+    def __init__(self, model_path, output_key=None, intra_op_threads=0):
+        """
+        :param model_path: path of the .onnx file
+        :param output_key: name of the output to return, or None if the model has just one
+        :param intra_op_threads: threads used within an operator, 0 for one per physical core
+        """
+        import onnxruntime  # optional, only needed for this transport
+        self.model_path = model_path
+        self.output_key = output_key
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = int(intra_op_threads)
+        # callers run predict from several threads already
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_types = collections.OrderedDict(
+            (i.name, ONNX_TO_NP.get(i.type, np.float32)) for i in self.session.get_inputs())
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        if output_key and output_key not in self.output_names:
+            raise ValueError("output %s not in %s, it has %s" % (output_key, model_path, ", ".join(self.output_names)))
+        if not output_key and len(self.output_names) != 1:
+            raise ValueError("set an output key, %s has outputs %s" % (model_path, ", ".join(self.output_names)))
+
+    def __str__(self):
+        return "onnx://%s" % self.model_path
+
+    def predict(self, inputs, timeout=None):
+        """
+        :param inputs: ordered map of input name to numpy array, batch is the first dimension.
+        :param timeout: ignored, an in-process run cannot be interrupted
+        :return: numpy array of model outputs, one row per example
+        """
+        feed = {}
+        for name, dtype in self.input_types.items():
+            if name in inputs:
+                value = inputs[name]
+            elif len(inputs) == 1 and len(self.input_types) == 1:
+                # the one input of an image model, whatever its name
+                value = list(inputs.values())[0]
+            else:
+                raise TransportError("input %s of %s not given, got %s" % (name, self, ", ".join(inputs)))
+            feed[name] = np.ascontiguousarray(value, dtype=dtype)
+        try:
+            outputs = self.session.run([self.output_key or self.output_names[0]], feed)
+        except Exception as e:
+            raise TransportError("ONNX Runtime error from %s: %s" % (self, e))
+        return np.asarray(outputs[0], dtype=np.float64)
+
+
+def transport_from_env(prefix, model_name, server_prefix, instances_input=None):
+    """
+    Build the transport for one model according to env vars:
+    TF_TRANSPORT rest (default), grpc or onnx; TF_<prefix>_GRPC_TARGET host:port for grpc;
+    TF_<prefix>_OUTPUT_KEY output tensor name for grpc and onnx; TF_<prefix>_ONNX_MODEL path
+    of the .onnx file and ONNX_INTRA_OP_THREADS (0, one per core) for onnx; TF_POOL_SIZE,
+    TF_CONNECT_TIMEOUT and TF_READ_TIMEOUT (seconds).
+    :param prefix: BERT or IMAGE
+    :param model_name: model name in tensorflow-serving
+    :param server_prefix: REST base API URL, like the value of TF_BERT_SERVER_URL
+    :param instances_input: see RestTransport
+    """
+    kind = os.environ.get('TF_TRANSPORT', 'rest')
+    read_timeout = float(os.environ.get('TF_READ_TIMEOUT', 30))
+    if kind == 'grpc':
+        target = os.environ.get('TF_%s_GRPC_TARGET' % prefix)
+        if not target:
+            raise ValueError('TF_TRANSPORT=grpc requires env var TF_%s_GRPC_TARGET=host:port' % prefix)
+        return GrpcTransport(target, model_name, output_key=os.environ.get('TF_%s_OUTPUT_KEY' % prefix),
+                             timeout=read_timeout)
+    if kind == 'onnx':
+        model_path = os.environ.get('TF_%s_ONNX_MODEL' % prefix)
+        if not model_path:
+            raise ValueError('TF_TRANSPORT=onnx requires env var TF_%s_ONNX_MODEL=path of the .onnx file' % prefix)
+        return OnnxTransport(model_path, output_key=os.environ.get('TF_%s_OUTPUT_KEY' % prefix),
+                             intra_op_threads=int(os.environ.get('ONNX_INTRA_OP_THREADS', 0)))
+    if kind != 'rest':
+        raise ValueError('unknown TF_TRANSPORT %s, use rest, grpc or onnx' % kind)
+    return RestTransport(server_prefix, model_name, instances_input=instances_input,
+                         pool_size=int(os.environ.get('TF_POOL_SIZE', 16)),
+                         connect_timeout=float(os.environ.get('TF_CONNECT_TIMEOUT', 5)),
+                         read_timeout=read_timeout)
+
+
+def async_transport_from_env(prefix, model_name, server_prefix, instances_input=None):
+    """
+    Build the asyncio transport for one model according to the env vars used by transport_from_env,
+    with TF_ASYNC_POOL_SIZE max connections (100 by default).
+    :return: AsyncRestTransport, or None with TF_TRANSPORT=grpc or onnx, where the blocking transport
+        is used from a thread instead.
+    """
+    if os.environ.get('TF_TRANSPORT', 'rest') != 'rest':
+        return None
+    return AsyncRestTransport(server_prefix, model_name, instances_input=instances_input,
+                              pool_size=int(os.environ.get('TF_ASYNC_POOL_SIZE', 100)),
+                              connect_timeout=float(os.environ.get('TF_CONNECT_TIMEOUT', 5)),
+                              read_timeout=float(os.environ.get('TF_READ_TIMEOUT', 30)))
+
+
+#
+#    Minimal protobuf wire format for PredictRequest/PredictResponse (tensorflow_serving/apis/predict.proto)
+#
+
+# tensorflow DataType enum values
+DT_FLOAT = 1
+DT_DOUBLE = 2
+DT_INT32 = 3
+DT_INT64 = 9
+DTYPE_TO_NP = {DT_FLOAT: np.float32, DT_DOUBLE: np.float64, DT_INT32: np.int32, DT_INT64: np.int64}
+NP_TO_DTYPE = {np.dtype(v): k for k, v in DTYPE_TO_NP.items()}
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_BYTES = 2
+WIRE_FIXED32 = 5
+
+
+def _varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _field_bytes(field, payload):
+    return _varint((field << 3) | WIRE_BYTES) + _varint(len(payload)) + payload
+
+
+def _field_varint(field, value):
+    return _varint((field << 3) | WIRE_VARINT) + _varint(value)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf):
+    """
+    :return: generator of (field number, wire type, value); value is an int or bytes
+    """
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == WIRE_VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire == WIRE_BYTES:
+            length, pos = _read_varint(buf, pos)
+            value = bytes(buf[pos:pos + length])
+            pos += length
+        elif wire == WIRE_FIXED32:
+            value = bytes(buf[pos:pos + 4])
+            pos += 4
+        elif wire == WIRE_FIXED64:
+            value = bytes(buf[pos:pos + 8])
+            pos += 8
+        else:
+            raise TransportError("unsupported protobuf wire type %d" % wire)
+        yield field, wire, value
+
+
+def encode_tensor(array):
+    """
+    :param array: numpy array of float32, float64, int32 or int64
+    :return: serialized TensorProto with little-endian tensor_content
+    """
+    array = np.asarray(array)
+    dtype = NP_TO_DTYPE.get(array.dtype)
+    if dtype is None:
+        raise TransportError("unsupported tensor dtype %s" % array.dtype)
+    # TensorShapeProto { repeated Dim dim = 2; }  Dim { int64 size = 1; }
+    shape = b"".join(_field_bytes(2, _field_varint(1, d)) for d in array.shape)
+    content = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<')).tobytes()
+    # TensorProto { DataType dtype = 1; TensorShapeProto tensor_shape = 2; bytes tensor_content = 4; }
+    return _field_varint(1, dtype) + _field_bytes(2, shape) + _field_bytes(4, content)
+
+
+def decode_tensor(buf):
+    """
+    :param buf: serialized TensorProto, values in tensor_content or the typed repeated fields
+    :return: numpy array
+    """
+    dtype = DT_FLOAT
+    shape = []
+    content = None
+    values = []
+    for field, wire, value in _iter_fields(buf):
+        if field == 1:
+            dtype = value
+        elif field == 2:
+            for dim_field, _, dim in _iter_fields(value):
+                if dim_field == 2:
+                    shape.append(dict((f, v) for f, _, v in _iter_fields(dim)).get(1, 0))
+        elif field == 4:
+            content = value
+        elif field == 5:  # float_val
+            values.extend(np.frombuffer(value, dtype='<f4') if wire == WIRE_BYTES else struct.unpack('<f', value))
+        elif field == 6:  # double_val
+            values.extend(np.frombuffer(value, dtype='<f8') if wire == WIRE_BYTES else struct.unpack('<d', value))
+        elif field in (7, 10):  # int_val, int64_val
+            if wire == WIRE_BYTES:
+                pos = 0
+                while pos < len(value):
+                    v, pos = _read_varint(value, pos)
+                    values.append(v)
+            else:
+                values.append(value)
+    np_dtype = DTYPE_TO_NP.get(dtype)
+    if np_dtype is None:
+        raise TransportError("unsupported tensor dtype enum %d" % dtype)
+    if content is not None:
+        array = np.frombuffer(content, dtype=np.dtype(np_dtype).newbyteorder('<')).astype(np_dtype)
+    else:
+        array = np.asarray(values, dtype=np_dtype)
+        if shape and array.size == 1 and int(np.prod(shape)) > 1:
+            array = np.full(int(np.prod(shape)), array[0], dtype=np_dtype)  # a single value fills the tensor
+    return array.reshape(shape)
+
+
+def _encode_tensor_map(field, tensors):
+    # map<string, TensorProto> is a repeated entry message { string key = 1; TensorProto value = 2; }
+    return b"".join(_field_bytes(field, _field_bytes(1, k.encode('utf-8')) + _field_bytes(2, encode_tensor(v)))
+                    for k, v in tensors.items())
+
+
+def _decode_tensor_map(buf, field):
+    tensors = {}
+    for f, _, entry in _iter_fields(buf):
+        if f != field:
+            continue
+        entry_fields = dict((ef, v) for ef, _, v in _iter_fields(entry))
+        tensors[entry_fields.get(1, b"").decode('utf-8')] = decode_tensor(entry_fields.get(2, b""))
+    return tensors
+
+
+def encode_predict_request(model_name, signature_name, inputs):
+    # ModelSpec { string name = 1; string signature_name = 3; }
+    model_spec = _field_bytes(1, model_name.encode('utf-8')) + _field_bytes(3, signature_name.encode('utf-8'))
+    # PredictRequest { ModelSpec model_spec = 1; map<string, TensorProto> inputs = 2; }
+    return _field_bytes(1, model_spec) + _encode_tensor_map(2, inputs)
+
+
+def decode_predict_request(buf):
+    """
+    :return: model name, signature name, map of input tensors
+    """
+    model_name = signature_name = ""
+    for field, _, value in _iter_fields(buf):
+        if field == 1:
+            spec = dict((f, v) for f, _, v in _iter_fields(value))
+            model_name = spec.get(1, b"").decode('utf-8')
+            signature_name = spec.get(3, b"").decode('utf-8')
+    return model_name, signature_name, _decode_tensor_map(buf, 2)
+
+
+def encode_predict_response(outputs):
+    # PredictResponse { map<string, TensorProto> outputs = 1; }
+    return _encode_tensor_map(1, outputs)
+
+
+def decode_predict_response(buf):
+    """
+    :return: map of output name to numpy array
+    """
+    return _decode_tensor_map(buf, 1)
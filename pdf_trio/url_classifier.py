@@ -19,7 +19,10 @@ Classify whether a pdf is a research work based only on it's URL.
 """
 
 import os
+import json
 import logging
+import threading
+import collections
 
 import fasttext
 from fasttext import load_model
@@ -42,6 +45,14 @@ class UrlClassifier:
             raise ValueError('Missing fasttext model, define env var FT_URL_MODEL=full_path_to_basename')
         log.warning("Loading fasttext URL model...")
         self.fasttext_url_model = fasttext.load_model(model_path)
+        # URLs per fastText predict call, see classify_urls
+        self.batch_size = int(os.environ.get('URL_BATCH_SIZE', 1000))
+        # confidences by token string, i.e. by domain and path without the file name, which is
+        # all the model sees; many URLs of a crawl share them. See URL_CACHE_SIZE
+        self.cache_size = int(os.environ.get('URL_CACHE_SIZE', 100000))
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
 
     @staticmethod
     def remove_wayback_prefix(url):
@@ -72,11 +83,13 @@ class UrlClassifier:
         return p
 
     @staticmethod
-    def extract_uri(url):
+    def extract_uri(url, domain=None):
         """
         return the URI part, but not the filename
+        :param domain: extract_domain of the url, if already known
         """
-        domain = UrlClassifier.extract_domain(url)
+        if domain is None:
+            domain = UrlClassifier.extract_domain(url)
         url_no_domain = url[url.find(domain)+len(domain):]
         offset_colon = url_no_domain.find(":")
         if offset_colon == 0:
@@ -96,7 +109,7 @@ class UrlClassifier:
         Note: some items are empty
         """
         d = UrlClassifier.extract_domain(url)
-        uri = UrlClassifier.extract_uri(url)
+        uri = UrlClassifier.extract_uri(url, d)
         tokens = uri.split('/')
         tokens.append(d)
         return tokens
@@ -109,19 +122,94 @@ class UrlClassifier:
         r = " U_".join(tlist)
         return r
 
+    def url_features(self, url):
+        """
+        :param url: one URL
+        :return: the string of tokens given to the fastText model
+        """
+        # the model input is a single line
+        return self.gen_tokens(self.extract_url_tokens(self.remove_wayback_prefix(url))).replace("\n", " ")
+
     def classify_url(self, url):
         """
         :param url: one URL to classify
         :return: confidence [0.0,1.0] that url points to positive case
         """
-        tokens_concat = UrlClassifier.gen_tokens(
-            self.extract_url_tokens(self.remove_wayback_prefix(url)),
-        )
-        log.debug("classify_url: url=%s tokens=%s" % (url, tokens_concat))
-        #  classify using fastText model for urlmeta
-        results = self.fasttext_url_model.predict(tokens_concat)
-        label = results[0][0]
-        confidence = results[1][0]
-        log.info("classify_url: label=%s confidence=%.2f url=%s" % (label, confidence, url))
-        return pdf_classifier.PdfClassifier.encode_confidence(label, confidence)
+        confidence = self.classify_urls([url])[0]
+        log.debug("classify_url: confidence=%.2f url=%s" % (confidence, url))
+        return confidence
 
+    def classify_urls(self, urls):
+        """
+        Classify many URLs, with one fastText predict call per URL_BATCH_SIZE distinct token strings
+        that are not cached yet.
+        :param urls: list of URLs
+        :return: list of confidences [0.0,1.0] that the url points to positive case, in the same order
+        """
+        features = [self.url_features(url) for url in urls]
+        confidences = {}
+        with self.lock:
+            for f in set(features):
+                confidence = self.cache.get(f)
+                if confidence is not None:
+                    self.cache.move_to_end(f)
+                    confidences[f] = confidence
+        # each distinct token string once
+        missing = [f for f in dict.fromkeys(features) if f not in confidences]
+        for offset in range(0, len(missing), self.batch_size):
+            chunk = missing[offset:offset + self.batch_size]
+            labels, probabilities = self.fasttext_url_model.predict(chunk)
+            for f, label, probability in zip(chunk, labels, probabilities):
+                confidences[f] = pdf_classifier.PdfClassifier.encode_confidence(label[0], float(probability[0]))
+        with self.lock:
+            self.counts["urls"] += len(features)
+            self.counts["predictions"] += len(missing)
+            if self.cache_size > 0:
+                for f in missing:
+                    self.cache[f] = confidences[f]
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return [confidences[f] for f in features]
+
+    def classify_ndjson(self, lines):
+        """
+        Classify a stream of URLs, URL_BATCH_SIZE at a time.
+        :param lines: iterable of NDJSON lines (str or bytes), each a URL string or an object with a "url"
+        :return: generator of one NDJSON line per input line, the object with its "confidence"
+            added, or {"url": url, "confidence": c} for a URL string; {"error": ...} for an invalid line.
+            Blank lines are skipped.
+        """
+        batch = []  # of (item, whether it is valid)
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if isinstance(item, str):
+                    item = {"url": item}
+                if not isinstance(item, dict) or not isinstance(item.get("url"), str):
+                    raise ValueError("expected a URL string or an object with a url")
+                batch.append((item, True))
+            except ValueError as e:
+                batch.append(({"error": "%s: %s" % (e, line.strip()[:200])}, False))
+            if len(batch) >= self.batch_size:
+                yield from self._classify_batch(batch)
+                batch = []
+        yield from self._classify_batch(batch)
+
+    def _classify_batch(self, batch):
+        valid = [item for item, is_valid in batch if is_valid]
+        for item, confidence in zip(valid, self.classify_urls([item["url"] for item in valid])):
+            item["confidence"] = confidence
+        for item, _ in batch:
+            yield json.dumps(item) + "\n"
+
+    def stats(self):
+        with self.lock:
+            stats_map = dict(self.counts)
+            stats_map["cache_entries"] = len(self.cache)
+            if self.counts["urls"]:
+                stats_map["hit_rate"] = 1.0 - self.counts["predictions"] / self.counts["urls"]
+            return stats_map
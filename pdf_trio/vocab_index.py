@@ -0,0 +1,221 @@
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Precompiled BERT vocabulary index, a replacement for the dict of text_prep.load_bert_vocab.
+
+The index is an open addressing hash table saved as a .npy file next to the vocab file, rows
+of 64-bit token hash, vocab id and UTF-8 length per slot. It is memory-mapped read-only, so
+all worker processes share the same pages instead of each building a dict at startup. A whole
+token list is looked up at once: the tokens are encoded as one buffer, hashed together from
+prefix sums, and the fixed window of slots each token can be in is read for all tokens.
+
+The index is built on first use (or by running this module), and rebuilt when the vocab file
+is newer:
+
+    python -m pdf_trio.vocab_index model_snapshots/bert_models/multi_cased_L-12_H-768_A-12_vocab.txt
+"""
+
+import os
+import sys
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# polynomial hash of the bytes of a token, mod 2**64
+HASH_BASE = 0x100000001b3
+# HASH_BASE * HASH_BASE_INVERSE == 1 mod 2**64; a literal, pow(HASH_BASE, -1, 2 ** 64) needs python 3.8
+HASH_BASE_INVERSE = 0xce965057aff6957b
+
+# max distance of a token from its home slot, so that a lookup reads a fixed window of slots
+PROBE_WINDOW = 16
+
+# powers of HASH_BASE and of its inverse, grown as needed
+_powers = (np.ones(1, dtype=np.uint64), np.ones(1, dtype=np.uint64))
+
+
+def power_tables(n):
+    """
+    :return: arrays of the first n (or more) powers of HASH_BASE and HASH_BASE_INVERSE
+    """
+    global _powers
+    powers = _powers
+    if len(powers[0]) < n:
+        size = max(n, 2 * len(powers[0]), 4096)
+        tables = []
+        for base in (HASH_BASE, HASH_BASE_INVERSE):
+            table = np.full(size, base, dtype=np.uint64)
+            table[0] = 1
+            tables.append(np.cumprod(table, dtype=np.uint64))
+        powers = _powers = tuple(tables)
+    return powers
+
+
+def token_hashes(tokens):
+    """
+    Hash of each token as sum of byte[i] * HASH_BASE**i, for all tokens at once: the tokens are
+    concatenated and the hash of a token is the difference of the prefix sums at its ends,
+    shifted back to position 0 by the inverse powers. The ends come from the byte length of each
+    token, not from a separator, so any string (newlines, the empty token) gets its own hash.
+    :param tokens: list of strings
+    :return: non-zero uint64 hashes (0 marks an empty slot of the table), byte lengths
+    """
+    if not tokens:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    encoded = [token.encode('utf-8') for token in tokens]
+    buf = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    powers, inverse_powers = power_tables(len(buf) + 1)
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    prefix = np.zeros(len(buf) + 1, dtype=np.uint64)
+    np.cumsum(buf * powers[:len(buf)], out=prefix[1:])
+    hashes = (prefix[ends] - prefix[starts]) * inverse_powers[starts]
+    # with the length, so that the empty token is not 0, then the murmur3 finalizer, so that
+    # the top bits used for the slot depend on all bytes even for short tokens
+    hashes += (lengths.astype(np.uint64) + np.uint64(1)) * np.uint64(0x9e3779b97f4a7c15)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    hashes[hashes == 0] = 1
+    return hashes, lengths
+
+
+def build_vocab_index(vocab_file, index_file=None):
+    """
+    :param vocab_file:  path to vocab.txt from pre-trained BERT model, one token per line, id is the line number
+    :param index_file: where to write the index, or None to only return it
+    :return: uint64 array of shape (3, slots): hash, id and length per slot, hash 0 for empty slots
+    """
+    with open(vocab_file, 'r', encoding='utf-8') as f:
+        tokens = [line.strip() for line in f]
+    hashes, lengths = token_hashes(tokens)
+    # at most half full, a power of 2 so that the top bits of the hash are the slot
+    bits = max(4, (2 * len(tokens)).bit_length())
+    table = None
+    while table is None:
+        table = _fill_table(tokens, hashes.tolist(), lengths.tolist(), bits)
+        bits += 1
+    if index_file:
+        # written under a tmp name first, other processes may be loading it
+        tmp_name = "%s.%d.tmp.npy" % (index_file, os.getpid())
+        np.save(tmp_name, table)
+        os.replace(tmp_name, index_file)
+    return table
+
+
+def _fill_table(tokens, hashes, lengths, bits):
+    """
+    Linear probing insert of all tokens into a table of 2**bits slots.
+    :return: the table, or None if a token would be more than PROBE_WINDOW slots from its home slot
+    """
+    size = 1 << bits
+    slot_hashes = [0] * size
+    slot_ids = [0] * size
+    slot_lengths = [0] * size
+    slot_tokens = {}
+    for token_id, (token, h, length) in enumerate(zip(tokens, hashes, lengths)):
+        home = h >> (64 - bits)
+        for distance in range(PROBE_WINDOW):
+            slot = (home + distance) & (size - 1)
+            if slot_hashes[slot] == 0 or slot_hashes[slot] == h:
+                break
+        else:
+            return None
+        if slot_hashes[slot] == h and slot_tokens[slot] != token:
+            raise ValueError("hash collision between vocab tokens %r and %r" % (slot_tokens[slot], token))
+        # same as load_bert_vocab, the last id wins for a token given more than once
+        slot_hashes[slot] = h
+        slot_ids[slot] = token_id
+        slot_lengths[slot] = length
+        slot_tokens[slot] = token
+    return np.array([slot_hashes, slot_ids, slot_lengths], dtype=np.uint64)
+
+
+class VocabIndex:
+
+    def __init__(self, table):
+        """
+        :param table: array as returned by build_vocab_index, or memory-mapped from its file
+        """
+        self.hashes = table[0]
+        self.ids = table[1]
+        self.lengths = table[2]
+        self.size = int(np.count_nonzero(self.hashes))
+        self.bits = len(self.hashes).bit_length() - 1
+        self.window = np.arange(PROBE_WINDOW)
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, items):
+        """
+        :param items: list of tokens (strings)
+        :return: int32 array of vocab ids, -1 for tokens not in the vocab
+        """
+        hashes, lengths = token_hashes(items)
+        homes = (hashes >> np.uint64(64 - self.bits)).astype(np.int64)
+        # the slots a token can be in, one row per token
+        slots = (homes[:, None] + self.window) & (len(self.hashes) - 1)
+        hits = self.hashes[slots] == hashes[:, None]
+        slot = slots[np.arange(len(items)), hits.argmax(axis=1)]
+        found = hits.any(axis=1) & (self.lengths[slot] == lengths)
+        return np.where(found, self.ids[slot], -1).astype(np.int32)
+
+    def lookup_ids(self, items):
+        """
+        Like text_prep.convert_to_bert_vocab: tokens not in the vocab are skipped.
+        :param items: list of tokens (strings)
+        :return: int32 array of vocab ids
+        """
+        ids = self.lookup(items)
+        return ids[ids >= 0]
+
+
+def load_vocab_index(vocab_file, index_file=None):
+    """
+    Memory-map the index of the vocab file, building it first if missing or older than the vocab file.
+    :param vocab_file:  path to vocab.txt from pre-trained BERT model
+    :param index_file: path of the index, vocab_file + ".index.npy" by default
+    :return: VocabIndex
+    """
+    index_file = index_file or vocab_file + ".index.npy"
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(vocab_file):
+        log.warning("building BERT vocab index %s" % index_file)
+        try:
+            build_vocab_index(vocab_file, index_file)
+        except OSError as e:
+            # like a read-only model dir; works, but every process has its own copy
+            log.warning("cannot write %s (%s), keeping the BERT vocab index in memory" % (index_file, e))
+            return VocabIndex(build_vocab_index(vocab_file))
+    # a plain ndarray view of the mapped file, memmap slicing is slower
+    return VocabIndex(np.load(index_file, mmap_mode='r').view(np.ndarray))
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("usage: python -m pdf_trio.vocab_index vocab.txt [index.npy]")
+        return 1
+    index_file = sys.argv[2] if len(sys.argv) == 3 else sys.argv[1] + ".index.npy"
+    table = build_vocab_index(sys.argv[1], index_file)
+    print("%d tokens indexed in %s" % (np.count_nonzero(table[0]), index_file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2020 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+Classification of the PDFs of crawl WARC files, without unpacking them (needs warcio):
+
+    python -m pdf_trio.warc_ingest --warc crawl-00000.warc.gz --output results.jsonl --processes 16
+
+WARC files are read record by record; the application/pdf responses are picked, and the URL
+classifier scores their URLs first. Only PDFs whose URL confidence reaches WARC_URL_THRESHOLD,
+or is in the WARC_URL_UNCERTAIN range, are read and classified by a pool of worker processes
+like in bulk; the others get a line with their URL confidence only. With CDX indexes of the
+WARC files instead, the PDFs are picked from the CDX lines and the selected records are read
+at their offsets, so the payloads of the skipped ones are not even decompressed.
+
+Each PDF gets a JSON line with the CDX fields of its record (url, timestamp, mime, status,
+digest, length, offset, filename), which also is the checkpoint: a rerun with the same output
+file skips the records already in it.
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import functools
+import itertools
+
+from pdf_trio import bulk
+
+log = logging.getLogger(__name__)
+
+PDF_MIMETYPES = ("application/pdf", "application/x-pdf")
+# field letters of the CDX line format of wayback, when the file has no header
+CDX11_FIELDS = "N b a m s k r M S V g"
+CDX_FIELD_NAMES = {"a": "url", "b": "timestamp", "m": "mime", "s": "status", "k": "digest",
+                   "S": "length", "V": "offset", "g": "filename"}
+
+
+class UrlPrefilter:
+    """
+    Decides, by the URL classifier, which PDFs of a crawl are worth classifying.
+    """
+
+    def __init__(self, url_classifier, threshold=0.5, uncertain=None):
+        """
+        :param url_classifier: UrlClassifier
+        :param threshold: PDFs with a URL confidence of at least this are classified
+        :param uncertain: (low, high) range of URL confidences also classified, or None
+        """
+        self.url_classifier = url_classifier
+        self.threshold = threshold
+        self.uncertain = uncertain
+
+    def wanted(self, confidence):
+        """
+        :param confidence: URL confidence [0.0,1.0] that the PDF is research
+        :return: whether to classify the PDF
+        """
+        if confidence >= self.threshold:
+            return True
+        return self.uncertain is not None and self.uncertain[0] <= confidence <= self.uncertain[1]
+
+    def score(self, records):
+        """
+        Add the URL confidence as urlmeta to the records, and mark those not worth classifying
+        as skipped.
+        :param records: list of record maps with a url
+        """
+        for record, confidence in zip(records, self.url_classifier.classify_urls([r["url"] for r in records])):
+            record["urlmeta"] = confidence
+            if not self.wanted(confidence):
+                record["skipped"] = "url_prior"
+
+
+def url_prefilter_from_env(url_classifier=None):
+    """
+    Build the prefilter according to env vars WARC_URL_THRESHOLD (0.5 by default, 0 to classify
+    all PDFs) and WARC_URL_UNCERTAIN (comma sep low,high, 0.15,0.85 by default, empty for none).
+    :param url_classifier: UrlClassifier, created from the env if None
+    :return: UrlPrefilter
+    """
+    threshold = float(os.environ.get('WARC_URL_THRESHOLD', 0.5))
+    if not 0.0 <= threshold <= 1.0:
+        raise ValueError('WARC_URL_THRESHOLD must be in [0, 1], got %s' % threshold)
+    uncertain = None
+    value = os.environ.get('WARC_URL_UNCERTAIN', '0.15,0.85')
+    if value:
+        try:
+            low, high = (float(v) for v in value.split(","))
+        except ValueError:
+            raise ValueError('WARC_URL_UNCERTAIN must be low,high, got %s' % value)
+        if not 0.0 <= low <= high <= 1.0:
+            raise ValueError('WARC_URL_UNCERTAIN must be a range within [0, 1], got %s' % value)
+        uncertain = (low, high)
+    if url_classifier is None:
+        from pdf_trio.url_classifier import UrlClassifier
+        url_classifier = UrlClassifier()
+    return UrlPrefilter(url_classifier, threshold, uncertain)
+
+
+def cdx_timestamp(warc_date):
+    """
+    :param warc_date: WARC-Date, like 2020-01-02T03:04:05Z, maybe with fractions of seconds
+    :return: 14 digit CDX timestamp, like 20200102030405
+    """
+    return re.sub(r'[^0-9]', '', warc_date or '')[:14]
+
+
+def is_pdf(mime, status):
+    return (mime or '').split(';')[0].strip().lower() in PDF_MIMETYPES and str(status) == "200"
+
+
+def warc_pdf_records(warc_path, prefilter=None, done=()):
+    """
+    Read a WARC file record by record, for its PDF responses.
+    :param prefilter: UrlPrefilter, the payloads of the PDFs it skips are not kept; None to keep all
+    :param done: set of (filename, offset) of the records to leave out
+    :return: generator of (record map, warc_path, PDF bytes or None if skipped)
+    """
+    from warcio.archiveiterator import ArchiveIterator
+    filename = os.path.basename(warc_path)
+    with open(warc_path, 'rb') as f:
+        records = ArchiveIterator(f)
+        for record in records:
+            if record.rec_type != 'response' or record.http_headers is None:
+                continue
+            mime = record.http_headers.get_header('Content-Type')
+            status = record.http_headers.get_statuscode()
+            if not is_pdf(mime, status):
+                continue
+            digest = record.rec_headers.get_header('WARC-Payload-Digest') or ''
+            row = {
+                "url": record.rec_headers.get_header('WARC-Target-URI'),
+                "timestamp": cdx_timestamp(record.rec_headers.get_header('WARC-Date')),
+                "mime": mime.split(';')[0].strip().lower(),
+                "status": status,
+                "digest": digest.split(':', 1)[-1],
+            }
+            if prefilter is not None:
+                prefilter.score([row])
+            content = None if row.get("skipped") else record.content_stream().read()
+            # offset and length are known once the iterator is past the record
+            records.read_to_end(record)
+            row["length"] = records.get_record_length()
+            row["offset"] = records.get_record_offset()
+            row["filename"] = filename
+            # warcio gives the offset only after the record, so the PDFs done already are read again
+            if (filename, row["offset"]) in done:
+                continue
+            yield row, warc_path, content
+
+
+def read_cdx(cdx_path):
+    """
+    Read a CDX file, with the field letters of its " CDX ..." header line, or CDX11_FIELDS.
+    :return: generator of maps of CDX_FIELD_NAMES to values
+    """
+    fields = CDX11_FIELDS.split()
+    with open(cdx_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith(" CDX "):
+                fields = line.split()[1:]
+                continue
+            values = line.split()
+            if len(values) != len(fields):
+                continue
+            yield dict((CDX_FIELD_NAMES[k], v) for k, v in zip(fields, values) if k in CDX_FIELD_NAMES)
+
+
+def cdx_pdf_records(cdx_path, warc_dir=None, prefilter=None, done=(), batch_size=1000):
+    """
+    The PDF responses of a CDX index, with their URLs scored batch_size at a time.
+    :param warc_dir: dir. of the WARC files, the dir. of the CDX file by default
+    :param prefilter: UrlPrefilter, or None to keep all PDFs
+    :param done: set of (filename, offset) of the records to leave out
+    :return: generator of (record map, WARC file path, None); the workers read the PDFs
+    """
+    if warc_dir is None:
+        warc_dir = os.path.dirname(cdx_path)
+    todo = (row for row in read_cdx(cdx_path) if is_pdf(row.get("mime"), row.get("status")))
+    while True:
+        rows = list(itertools.islice(todo, batch_size))
+        if not rows:
+            break
+        for row in rows:
+            row["offset"] = int(row["offset"])
+            row["length"] = int(row["length"])
+        rows = [row for row in rows if (row["filename"], row["offset"]) not in done]
+        if prefilter is not None and rows:
+            prefilter.score(rows)
+        for row in rows:
+            yield row, os.path.join(warc_dir, row["filename"]), None
+
+
+def read_warc_payload(warc_path, offset):
+    """
+    :return: the HTTP payload of the record at offset of the WARC file
+    """
+    from warcio.archiveiterator import ArchiveIterator
+    with open(warc_path, 'rb') as f:
+        f.seek(offset)
+        for record in ArchiveIterator(f):
+            return record.content_stream().read()
+    raise ValueError("no WARC record at %s:%d" % (warc_path, offset))
+
+
+def _classify_task(modes, items):
+    """
+    Runs in a worker process, like bulk._classify_task.
+    :param items: list of (record map, warc_path, PDF bytes or None to read them)
+    :return: list of record maps with the results added
+    """
+    rows = []
+    pdfs = []
+    pdf_rows = []
+    for row, warc_path, content in items:
+        if row.get("skipped"):
+            rows.append(row)
+            continue
+        if content is None:
+            try:
+                content = read_warc_payload(warc_path, row["offset"])
+            except Exception as e:
+                log.warning("cannot read %s at %d: %s" % (warc_path, row["offset"], e))
+                row["error"] = str(e)
+                rows.append(row)
+                continue
+        pdfs.append(("%s:%d" % (row["filename"], row["offset"]), content))
+        pdf_rows.append(row)
+    try:
+        results = bulk._classifier.classify_pdf_contents(modes, pdfs, [row["url"] for row in pdf_rows]) if pdfs else []
+    except Exception as e:
+        log.warning("batch starting with %s failed: %s" % (pdfs[0][0], e))
+        results = [{"error": str(e)}] * len(pdf_rows)
+    for row, result in zip(pdf_rows, results):
+        row.update(result)
+    return rows + pdf_rows
+
+
+def _batches(items, batch_size):
+    """
+    :return: generator of lists with batch_size PDFs to classify, and the skipped ones in between
+    """
+    batch = []
+    count = 0
+    for item in items:
+        batch.append(item)
+        if not item[0].get("skipped"):
+            count += 1
+        # skipped ones are cheap, but a batch should not grow without bound
+        if count >= batch_size or len(batch) >= 16 * batch_size:
+            yield batch
+            batch = []
+            count = 0
+    if batch:
+        yield batch
+
+
+def run(output_path, warc_paths=(), cdx_paths=(), warc_dir=None, modes="all", prefilter=None,
+        processes=None, batch_size=16, classifier=None):
+    """
+    Classify the PDFs of the WARC files, or of the WARC files of the CDX indexes, appending one
+    JSON line per PDF to output_path, skipping those in it already.
+    :param prefilter: UrlPrefilter, None to classify all PDFs
+    :param classifier: PdfClassifier to fork into the workers, created from the env if None
+    :return: all rows of the output file, including those of previous runs
+    """
+    rows = bulk.read_checkpoint(output_path)
+    done = set((row["filename"], row["offset"]) for row in rows)
+    if done:
+        log.warning("resuming, %d PDFs are done already" % len(done))
+    sources = [warc_pdf_records(path, prefilter, done) for path in warc_paths]
+    sources += [cdx_pdf_records(path, warc_dir, prefilter, done) for path in cdx_paths]
+    return bulk.run_batches(functools.partial(_classify_task, modes), _batches(itertools.chain(*sources), batch_size),
+                            output_path, rows, processes=processes, classifier=classifier)
+
+
+def summary(rows):
+    """
+    :return: map of counts of the PDFs, those skipped by the URL prior, classified and failed
+    """
+    counts = {"pdfs": len(rows), "skipped": 0, "classified": 0, "errors": 0}
+    for row in rows:
+        if row.get("skipped"):
+            counts["skipped"] += 1
+        elif row.get("error"):
+            counts["errors"] += 1
+        else:
+            counts["classified"] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--warc", type=str, default='',
+                        help="WARC files to read, use a comma sep for multiple files")
+    parser.add_argument("--cdx", type=str, default='',
+                        help="CDX indexes of WARC files to read instead, use a comma sep for multiple files")
+    parser.add_argument("--warc_dir", type=str, default=None,
+                        help="dir. of the WARC files of the CDX indexes, the dir. of each CDX file by default")
+    parser.add_argument("--output", type=str, default='warc_results.jsonl',
+                        help="JSONL results file, appended to; records already in it are skipped")
+    parser.add_argument("--modes", type=str, default='all',
+                        help="comma sep list of {auto, image, linear, bert, all}, all by default")
+    parser.add_argument("--url_threshold", type=str, default='',
+                        help="min URL confidence of the PDFs to classify (WARC_URL_THRESHOLD), 0.5 by default")
+    parser.add_argument("--url_uncertain", type=str, default=None,
+                        help="low,high range of URL confidences also classified (WARC_URL_UNCERTAIN), "
+                             "0.15,0.85 by default")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes, number of CPUs by default")
+    parser.add_argument("--batch_size", type=int, default=16,
+                        help="PDFs per worker task, their BERT and image examples share requests")
+    parser.add_argument("--feature_store", type=str, default='',
+                        help="dir. of extracted features (FEATURE_STORE_DIR), optional")
+    parser.add_argument("--temp", type=str, default='/tmp', help="temp dir to use during extraction, /tmp default")
+    parser.add_argument("--testing", default=False, help="testing mode, be verbose", action="store_true")
+    args = parser.parse_args()
+    if not (args.warc or args.cdx):
+        parser.error("give at least one of --warc, --cdx")
+
+    from pdf_trio import pdf_util
+    logging.basicConfig(level=logging.DEBUG if args.testing else logging.INFO)
+    pdf_util.use_temp_dir(args.temp)
+    if args.url_threshold:
+        os.environ['WARC_URL_THRESHOLD'] = args.url_threshold
+    if args.url_uncertain is not None:
+        os.environ['WARC_URL_UNCERTAIN'] = args.url_uncertain
+    if args.feature_store:
+        os.environ['FEATURE_STORE_DIR'] = args.feature_store
+    # the processes give the parallelism, few extraction threads are needed in each
+    os.environ.setdefault('PDF_EXTRACT_WORKERS', '2')
+    rows = run(args.output, [p for p in args.warc.split(",") if p], [p for p in args.cdx.split(",") if p],
+               warc_dir=args.warc_dir, modes=args.modes, prefilter=url_prefilter_from_env(),
+               processes=args.processes, batch_size=args.batch_size)
+    print(json.dumps(summary(rows)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+
+import time
+import threading
+
+import pytest
+
+from pdf_trio import admission
+
+
+def test_deadline():
+    assert admission.NO_DEADLINE.remaining() is None
+    assert admission.NO_DEADLINE.timeout(30) == 30
+    assert admission.NO_DEADLINE.timeout() is None
+
+    deadline = admission.Deadline(10)
+    assert 9 < deadline.timeout(30) <= 10
+    assert deadline.timeout(2) == 2
+    assert admission.latest([deadline, admission.Deadline(20)]).remaining() > 10
+    assert admission.latest([deadline, admission.NO_DEADLINE]) is admission.NO_DEADLINE
+
+    passed = admission.Deadline(0.001)
+    time.sleep(0.002)
+    assert passed.expired()
+    with pytest.raises(admission.DeadlineExceeded):
+        passed.timeout(30, "pdftotext")
+
+
+def test_request_deadline(monkeypatch):
+    monkeypatch.delenv("REQUEST_DEADLINE", raising=False)
+    assert admission.request_deadline().remaining() is None
+    assert 4 < admission.request_deadline("5").remaining() <= 5
+
+    monkeypatch.setenv("REQUEST_DEADLINE", "3")
+    assert 2 < admission.request_deadline().remaining() <= 3
+    # the client can ask for less, not for more
+    assert admission.request_deadline("60").remaining() <= 3
+    assert admission.request_deadline("1").remaining() <= 1
+    with pytest.raises(ValueError):
+        admission.request_deadline("soon")
+
+
+def test_request_queue():
+    queue = admission.RequestQueue(1, max_queued=1, queue_timeout=5, retry_after=7)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with queue.admit():
+            entered.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    entered.wait()
+
+    # one request may wait for the holder to finish, the next is rejected
+    waited = []
+
+    def wait_turn():
+        with queue.admit():
+            waited.append(True)
+
+    waiter = threading.Thread(target=wait_turn)
+    waiter.start()
+    while queue.stats()["waiting"] == 0:
+        time.sleep(0.001)
+    with pytest.raises(admission.Overloaded) as e:
+        with queue.admit():
+            pass
+    assert e.value.retry_after == 7
+
+    release.set()
+    holder.join()
+    waiter.join()
+    assert waited == [True]
+    stats = queue.stats()
+    assert stats["admitted"] == 2
+    assert stats["queue_full"] == 1
+    assert stats["active"] == 0
+
+
+def test_request_queue_timeout():
+    queue = admission.RequestQueue(1, max_queued=4, queue_timeout=0.05)
+    with queue.admit():
+        with pytest.raises(admission.Overloaded):
+            with queue.admit():
+                pass
+        # the deadline of the request bounds the wait too
+        with pytest.raises(admission.Overloaded):
+            with queue.admit(admission.Deadline(0.01)):
+                pass
+        with queue.admit_nowait():
+            pass
+    assert queue.stats()["queue_timeout"] == 2
+
+    unlimited = admission.RequestQueue(0)
+    with unlimited.admit(), unlimited.admit():
+        assert unlimited.stats()["active"] == 2
+
+
+def test_stage_limits(monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENT_EXTRACT_IMAGE", "1")
+    limits = admission.stage_limits_from_env()
+    assert limits.limits == {"extract_image": 1}
+    with limits.hold("extract_image"):
+        with pytest.raises(admission.DeadlineExceeded):
+            with limits.hold("extract_image", admission.Deadline(0.01)):
+                pass
+        # no limit for this one
+        with limits.hold("extract_text", admission.Deadline(0.01)):
+            pass
+    with limits.hold("extract_image", admission.Deadline(0.01)):
+        pass
+
+    with pytest.raises(ValueError):
+        admission.StageLimits({"upload": 2})
@@ -0,0 +1,158 @@
+import json
+
+import pytest
+
+from pdf_trio.fake_tf_serving import FakeTfServing
+from pdf_trio.pdf_classifier import PdfClassifier
+
+pytest.importorskip("starlette")
+pytest.importorskip("httpx")
+pytest.importorskip("multipart")
+from starlette.testclient import TestClient
+
+
+@pytest.fixture
+def fake_tf():
+    fake = FakeTfServing(scores=(0.1, 0.9))
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def asgi_client(fake_tf, monkeypatch):
+    from pdf_trio.asgi import create_app
+    base_url = fake_tf.start_rest()
+    monkeypatch.setenv("TF_BERT_SERVER_URL", base_url)
+    monkeypatch.setenv("TF_IMAGE_SERVER_URL", base_url)
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    monkeypatch.setenv("AUTO_SPECULATIVE_IMAGE", "1")
+    with TestClient(create_app()) as client:
+        yield client
+
+
+def test_asgi_misc_routes(asgi_client):
+    for r in ("/", "/api/list", "/api/stats"):
+        resp = asgi_client.get(r)
+        assert resp.status_code == 200
+
+
+def test_asgi_classify_url(asgi_client):
+    urls = ["https://arxiv.org/pdf/1607.01759.pdf", "https://example.com/maps/foo.pdf"]
+    resp = asgi_client.post("/classify/research-pub/url", json={"urls": urls})
+    assert resp.status_code == 200
+    predictions = resp.json()["predictions"]
+    assert sorted(predictions) == sorted(urls)
+
+
+def test_asgi_classify_pdf(asgi_client, fake_tf):
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    with open(test_pdf_path, 'rb') as f:
+        resp = asgi_client.post("/classify/research-pub/all", files={"pdf_content": f})
+    assert resp.status_code == 200
+    result = resp.json()
+    assert result['bert'] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+    assert result['image'] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+    assert result['linear'] != 0.5
+    assert 'is_research' in result
+    assert 'version' in result
+    assert fake_tf.requests == 2
+
+    resp = asgi_client.post("/classify/research-pub/all")
+    assert resp.status_code == 400
+
+    with open(test_pdf_path, 'rb') as f:
+        resp = asgi_client.post("/classify/research-pub/all", files={"pdf_content": f},
+                                headers={"X-Request-Timeout": "0.000001"})
+    assert resp.status_code == 504
+
+
+def test_asgi_classify_pdf_batch(asgi_client, fake_tf):
+    test_pdf_paths = [
+        'tests/files/research/submission_363.pdf',
+        'tests/files/scanned/scanned_page.pdf',
+    ]
+    files = [("pdf_content", (p.split('/')[-1], open(p, 'rb').read(), "application/pdf")) for p in test_pdf_paths]
+    resp = asgi_client.post("/classify/research-pub/batch", data={"type": "auto"}, files=files)
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert [r["filename"] for r in results] == ["submission_363.pdf", "scanned_page.pdf"]
+    assert 'linear' in results[0]
+    assert 'image' not in results[0]
+    # no text, so the speculatively rendered page 0 was classified
+    assert 'linear' not in results[1]
+    assert results[1]['image'] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+
+    resp = asgi_client.post("/classify/research-pub/batch", data={"type": "auto"})
+    assert resp.status_code == 400
+
+
+def test_asgi_single_flight(asgi_client, fake_tf):
+    pdf_content = open('tests/files/research/submission_363.pdf', 'rb').read()
+    # the second copy waits for the first
+    files = [("pdf_content", (name, pdf_content, "application/pdf")) for name in ("a.pdf", "b.pdf")]
+    resp = asgi_client.post("/classify/research-pub/batch", data={"type": "bert"}, files=files)
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert results[0]["bert"] == results[1]["bert"] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+    assert fake_tf.requests == 1
+    stats = asgi_client.get("/api/stats").json()["single_flight"]
+    assert stats["coalesced"] == 1 and stats["in_flight"] == 0
+
+
+def test_asgi_classify_url_ndjson(asgi_client):
+    urls = ["https://arxiv.org/pdf/1607.01759.pdf", "https://example.com/maps/foo.pdf"]
+    body = "".join('{"url": "%s"}\n' % u for u in urls)
+    resp = asgi_client.post("/classify/research-pub/url", content=body,
+                            headers={"content-type": "application/x-ndjson"})
+    assert resp.status_code == 200
+    assert [json.loads(line)["url"] for line in resp.text.splitlines()] == urls
+
+
+def test_async_classifier_event_loop(fake_tf, monkeypatch):
+    import asyncio
+    import threading
+    from pdf_trio import async_classifier
+    base_url = fake_tf.start_rest()
+    monkeypatch.setenv("TF_BERT_SERVER_URL", base_url)
+    monkeypatch.setenv("TF_IMAGE_SERVER_URL", base_url)
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "10")
+    monkeypatch.setenv("AUTO_SPECULATIVE_IMAGE", "1")
+    classifier = async_classifier.AsyncPdfClassifier(PdfClassifier())
+    pdf_content = open('tests/files/research/submission_363.pdf', 'rb').read()
+
+    # hashing, the result cache and single flight bookkeeping stay off the event loop thread
+    threads = []
+    cache = classifier.classifier.result_cache
+    for name in ("get", "put"):
+        def record(*args, _method=getattr(cache, name)):
+            threads.append(threading.current_thread())
+            return _method(*args)
+        monkeypatch.setattr(cache, name, record)
+
+    async def classify():
+        result = await classifier.classify_pdf_multi("linear", "a.pdf", pdf_content)
+        return result, threading.current_thread()
+    result, loop_thread = asyncio.run(classify())
+    assert result["linear"] != 0.5
+    assert len(threads) == 2 and loop_thread not in threads
+
+    # cancelled while waiting for a page 0 render, the other render is cancelled too
+    renders = []
+
+    async def extract_tokens(job, policy):
+        return []
+
+    async def extract_page0(job):
+        renders.append(asyncio.current_task())
+        await asyncio.sleep(60)
+    monkeypatch.setattr(classifier, "extract_tokens", extract_tokens)
+    monkeypatch.setattr(classifier, "extract_page0", extract_page0)
+
+    async def cancelled():
+        pdfs = [("b.pdf", pdf_content + b"b"), ("c.pdf", pdf_content + b"c")]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(classifier.classify_pdf_batch("auto", pdfs), 0.5)
+        await asyncio.sleep(0.1)
+        assert len(renders) == 2 and all(task.cancelled() for task in renders)
+    asyncio.run(cancelled())
+    assert classifier.classifier.single_flight.stats()["in_flight"] == 0
@@ -0,0 +1,92 @@
+
+import time
+import threading
+import concurrent.futures
+
+import pytest
+
+from pdf_trio.batcher import MicroBatcher, batcher_from_env
+
+
+def run_concurrently(fn, args):
+    results = [None] * len(args)
+
+    def worker(j):
+        results[j] = fn(args[j])
+
+    threads = [threading.Thread(target=worker, args=(j,)) for j in range(len(args))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_batcher_coalesces_concurrent_callers():
+    batch_sizes = []
+
+    def process(items):
+        batch_sizes.append(len(items))
+        time.sleep(0.01)
+        return [x * 2 for x in items]
+
+    b = MicroBatcher(process, max_batch_size=4, max_wait_ms=50, name="test")
+    results = run_concurrently(b.submit, list(range(12)))
+    assert results == [x * 2 for x in range(12)]
+    assert max(batch_sizes) <= 4
+    assert len(batch_sizes) < 12
+
+    stats = b.stats()
+    assert stats["items"] == 12
+    assert stats["batches"] == len(batch_sizes)
+    assert stats["queue_wait_ms_max"] >= 0.0
+    assert sum(int(k) * v for k, v in stats["batch_sizes"].items()) == 12
+
+
+def test_batcher_submit_many():
+    b = MicroBatcher(lambda items: [x + 1 for x in items], max_batch_size=3, max_wait_ms=1)
+    assert b.submit_many([1, 2, 3, 4, 5]) == [2, 3, 4, 5, 6]
+    assert b.stats()["batches"] >= 2
+
+
+def test_batcher_error_reaches_every_caller():
+
+    def process(items):
+        raise RuntimeError("back-end down")
+
+    b = MicroBatcher(process, max_batch_size=8, max_wait_ms=20)
+    errors = run_concurrently(lambda x: pytest.raises(RuntimeError, b.submit, x), list(range(5)))
+    assert len(errors) == 5
+
+    # batcher keeps working after a failed batch
+    b.process_batch = lambda items: items
+    assert b.submit(7) == 7
+
+
+def test_batcher_submit_timeout():
+    release = threading.Event()
+    processed = []
+
+    def process(items):
+        release.wait()
+        processed.extend(items)
+        return items
+
+    b = MicroBatcher(process, max_batch_size=1, max_wait_ms=1)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        b.submit_many([1, 2, 3], timeout=0.05)
+    release.set()
+    # the items still queued when the caller gave up are dropped
+    assert b.submit(4) == 4
+    assert 2 not in processed and 3 not in processed
+
+
+def test_batcher_from_env(monkeypatch):
+    monkeypatch.delenv("TESTX_BATCH_SIZE", raising=False)
+    assert batcher_from_env("TESTX", lambda items: items) is None
+
+    monkeypatch.setenv("TESTX_BATCH_SIZE", "16")
+    monkeypatch.setenv("TESTX_BATCH_WAIT_MS", "2.5")
+    b = batcher_from_env("TESTX", lambda items: items)
+    assert b.max_batch_size == 16
+    assert b.stats()["max_wait_ms"] == 2.5
@@ -0,0 +1,21 @@
+from benchmarks import synthetic_pdfs
+from benchmarks.run_benchmarks import compare, summarize
+from pdf_trio import pdf_util, text_prep
+
+
+def test_synthetic_corpus(tmp_path):
+    corpus = synthetic_pdfs.make_corpus(str(tmp_path), quick=True)
+    assert sorted(corpus) == ["huge", "scanned", "text", "tiny"]
+    text = pdf_util.extract_pdf_text(corpus["text"][0])
+    assert len(text_prep.extract_tokens(text)) > 500
+    assert len(pdf_util.extract_pdf_text(corpus["scanned"][0]).strip()) == 0
+    assert pdf_util.extract_pdf_image_from_content(open(corpus["scanned"][0], 'rb').read())
+    assert len(pdf_util.extract_pdf_text(corpus["tiny"][0])) < 300
+
+
+def test_compare_baseline():
+    baseline = {"a": summarize([0.010, 0.010], 0.020), "b": summarize([0.010], 0.010)}
+    results = {"a": summarize([0.011, 0.011], 0.022), "b": summarize([0.020], 0.020), "c": summarize([1.0], 1.0)}
+    regressions = compare(results, baseline, 0.2)
+    assert len(regressions) == 2
+    assert all(line.startswith("b ") for line in regressions)
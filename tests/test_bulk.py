@@ -0,0 +1,102 @@
+import os
+import json
+import shutil
+import pytest
+
+from pdf_trio import bulk
+from pdf_trio.fake_tf_serving import FakeTfServing
+from pdf_trio.pdf_classifier import PdfClassifier
+
+
+@pytest.fixture
+def pdf_dirs(tmp_path):
+    for label in ("research", "other"):
+        os.makedirs(str(tmp_path / label))
+        for name in os.listdir('tests/files/' + label):
+            shutil.copy(os.path.join('tests/files', label, name), str(tmp_path / label / name))
+    return tmp_path
+
+
+@pytest.fixture
+def fake_classifier(monkeypatch):
+    fake = FakeTfServing(scores=(0.1, 0.9))
+    base_url = fake.start_rest()
+    monkeypatch.setenv("TF_BERT_SERVER_URL", base_url)
+    monkeypatch.setenv("TF_IMAGE_SERVER_URL", base_url)
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    yield PdfClassifier()
+    fake.stop()
+
+
+def test_collect_pdf_files(pdf_dirs):
+    research = str(pdf_dirs / "research")
+    files = list(bulk.collect_pdf_files(research, "research"))
+    assert len(files) == len(os.listdir(research))
+    assert all(label == "research" for _, label in files)
+    files = list(bulk.collect_pdf_files(research, "research", skip={"submission_363.pdf"}))
+    assert len(files) == len(os.listdir(research)) - 1
+
+
+def test_bulk_run_and_resume(pdf_dirs, fake_classifier):
+    output = str(pdf_dirs / "results.jsonl")
+
+    def files():
+        return list(bulk.collect_pdf_files(str(pdf_dirs / "research"), "research")) + \
+            list(bulk.collect_pdf_files(str(pdf_dirs / "other"), "other"))
+
+    all_paths = sorted(path for path, _ in files())
+    rows = bulk.run(files()[:2], output, modes="all", processes=2, batch_size=1, classifier=fake_classifier)
+    assert len(rows) == 2
+
+    # simulate a run killed while writing a line
+    with open(output, 'a') as f:
+        f.write('{"path": "partial')
+
+    rows = bulk.run(files(), output, modes="all", processes=2, batch_size=2, classifier=fake_classifier)
+    with open(output) as f:
+        lines = [json.loads(line) for line in f]
+    assert sorted(r["path"] for r in lines) == all_paths
+    assert sorted(r["path"] for r in rows) == all_paths
+    for r in rows:
+        assert r["bert"] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+        assert "is_research" in r
+
+    matrices, agreement = bulk.confusion_matrices(rows)
+    # the fake back-end says research for everything
+    research_count = sum(1 for r in rows if r["label"] == "research")
+    assert matrices["bert"]["tp"] == research_count
+    assert matrices["bert"]["fp"] == len(rows) - research_count
+    assert agreement["bert/image"]["agree"] == len(rows)
+    assert "actual research" in bulk.format_confusion_matrices(matrices, agreement)
+
+
+def _pid_task(items):
+    return [{"item": item, "pid": os.getpid(), "after_fork_pid": bulk._classifier.after_fork_pid}
+            for item in items]
+
+
+def test_run_batches_after_fork(tmp_path, fake_classifier, monkeypatch):
+    # the workers must not use the connections and thread pools forked from the parent
+    def after_fork():
+        fake_classifier.after_fork_pid = os.getpid()
+    fake_classifier.after_fork_pid = None
+    monkeypatch.setattr(fake_classifier, "after_fork", after_fork)
+    batches = iter([[1, 2], [3], [4, 5]])
+    rows = bulk.run_batches(_pid_task, batches, str(tmp_path / "out.jsonl"), [], processes=2,
+                            classifier=fake_classifier)
+    assert sorted(row["item"] for row in rows) == [1, 2, 3, 4, 5]
+    assert all(row["after_fork_pid"] == row["pid"] != os.getpid() for row in rows)
+    assert fake_classifier.after_fork_pid is None
+
+
+def test_confusion_matrices():
+    rows = [
+        {"label": "research", "linear": 0.9, "bert": 0.5},
+        {"label": "other", "linear": 0.8, "bert": 0.1},
+        {"label": "other", "linear": 0.2, "bert": 0.1},
+        {"label": None, "linear": 0.2},
+    ]
+    matrices, agreement = bulk.confusion_matrices(rows)
+    assert matrices["linear"] == {"tp": 1, "fn": 0, "fp": 1, "tn": 1, "no_score": 0}
+    assert matrices["bert"] == {"tp": 0, "fn": 0, "fp": 0, "tn": 2, "no_score": 1}
+    assert agreement["linear/bert"] == {"agree": 1, "disagree": 1}
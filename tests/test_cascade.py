@@ -0,0 +1,69 @@
+
+import json
+import pytest
+
+from pdf_trio import cascade
+from pdf_trio.cascade import CascadePolicy, Stage
+from pdf_trio.pdf_classifier import _PdfJob
+
+
+def test_cascade_default(monkeypatch):
+    monkeypatch.delenv("AUTO_CASCADE", raising=False)
+    policy = cascade.cascade_policy_from_env()
+    assert policy.stages("url") == []
+    assert [s.classifier for s in policy.stages("text")] == ["linear", "bert"]
+    assert policy.stages("text")[0].uncertain == (0.15, 0.85)
+    assert policy.stages("text")[1].uncertain is None
+    assert policy.text_classifiers() == ["linear", "bert"]
+    assert policy.speculative_image()
+
+
+def test_cascade_advance():
+    policy = CascadePolicy.from_json(cascade.DEFAULT_CASCADE)
+    linear = policy.stages("text")[0]
+    jobs = [_PdfJob("a", b""), _PdfJob("b", b""), _PdfJob("c", b""), _PdfJob("d", b"")]
+    for job, confidence in zip(jobs, (0.9, 0.5, 0.15, 0.1)):
+        job.add_result("linear", confidence)
+    undecided = policy.advance(linear, jobs)
+    assert [job.name for job in undecided] == ["b", "c"]
+    assert [job.decided for job in jobs] == [True, False, False, True]
+    bert = policy.stages("text")[1]
+    assert policy.advance(bert, undecided) == []
+    assert jobs[1].path == ["linear", "bert"]
+    assert jobs[1].cost_ms == 255.0
+
+    policy.record(jobs)
+    stats = policy.stats()
+    assert stats["pdfs"] == 4
+    assert stats["linear_rate"] == 1.0
+    assert stats["bert_rate"] == 0.5
+    assert stats["expected_cost_ms"] == pytest.approx((4 * 5.0 + 2 * 250.0) / 4)
+
+
+def test_cascade_from_env(monkeypatch, tmp_path):
+    policy_map = {
+        "url": [{"classifier": "urlmeta", "uncertain": [0.05, 0.95], "cost_ms": 0.5}],
+        "text": [{"classifier": "linear"}],
+        "no_text": [],
+        "extract_text_cost_ms": 50,
+    }
+    path = tmp_path / "cascade.json"
+    path.write_text(json.dumps(policy_map))
+    monkeypatch.setenv("AUTO_CASCADE", str(path))
+    policy = cascade.cascade_policy_from_env()
+    assert policy.stages("url") == [Stage("urlmeta", (0.05, 0.95), 0.5)]
+    assert policy.stages("text") == [Stage("linear", None, 5.0)]
+    assert not policy.speculative_image()
+    assert policy.extract_text_cost_ms == 50.0
+    monkeypatch.setenv("AUTO_CASCADE", json.dumps(policy_map))
+    assert cascade.cascade_policy_from_env().to_json() == policy.to_json()
+
+    for bad in ('{"url": [{"classifier": "bert"}]}',
+                '{"text": [{"classifier": "linear", "uncertain": [0.9, 0.1]}]}',
+                '{"text": [{"uncertain": [0.1, 0.9]}]}',
+                '{"pdf": []}',
+                '["linear"]',
+                '{"text": '):
+        monkeypatch.setenv("AUTO_CASCADE", bad)
+        with pytest.raises(ValueError):
+            cascade.cascade_policy_from_env()
@@ -0,0 +1,84 @@
+
+import pytest
+
+from pdf_trio import admission
+from pdf_trio import pdf_util
+from pdf_trio.extract_pool import ExtractPool
+
+TEXT_PDF = 'tests/files/research/fea48178ffac3a42035ed27d6e2b897cb570cf13.pdf'
+IMAGE_PDF = 'tests/files/research/submission_363.pdf'
+
+
+@pytest.fixture
+def pool():
+    pool = ExtractPool(workers=2, max_jobs=2)
+    pdf_util.use_extract_pool(pool)
+    yield pool
+    pdf_util.use_extract_pool(None)
+    pool.close()
+
+
+def test_extract_pool_parity(pool):
+
+    with pdf_util.extraction_status() as status:
+        text = pdf_util.extract_pdf_text(TEXT_PDF)
+        with open(IMAGE_PDF, 'rb') as f:
+            jpg = pdf_util.extract_pdf_image_from_content(f.read())
+    assert status.complete
+    pdf_util.use_extract_pool(None)
+    assert "Yoshiyuki" in text
+    assert text == pdf_util.extract_pdf_text(TEXT_PDF)
+    with open(IMAGE_PDF, 'rb') as f:
+        assert jpg == pdf_util.extract_pdf_image_from_content(f.read())
+
+
+def test_extract_pool_recycle(pool):
+
+    # two workers of two jobs each, so some are recycled
+    for _ in range(6):
+        assert "Yoshiyuki" in pdf_util.extract_pdf_text(TEXT_PDF)
+    stats = pool.stats()
+    assert stats["calls"] == 6
+    assert stats["recycled"] >= 1
+
+
+def test_extract_pool_errors(pool):
+
+    with pytest.raises(AttributeError):
+        pdf_util.extract_pdf_text(TEXT_PDF, None)
+    assert "Yoshiyuki" in pdf_util.extract_pdf_text(TEXT_PDF)
+
+
+def test_extract_pool_timeout():
+
+    # the first call waits for the worker to import everything, much longer than this
+    pool = ExtractPool(workers=1, timeout=0.01)
+    pdf_util.use_extract_pool(pool)
+    try:
+        with pdf_util.extraction_status() as status:
+            assert pdf_util.extract_pdf_text(TEXT_PDF) == ""
+        # not an empty PDF, the caller must not remember it as one
+        assert not status.complete
+    finally:
+        pdf_util.use_extract_pool(None)
+        pool.close()
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_extract_pool_deadline():
+
+    pool = ExtractPool(workers=1)
+    pdf_util.use_extract_pool(pool)
+    try:
+        assert "Yoshiyuki" in pdf_util.extract_pdf_text(TEXT_PDF)
+        # all workers busy: the call fails at its deadline instead of queuing past it
+        busy = pool.idle.get()
+        with pytest.raises(admission.DeadlineExceeded):
+            pdf_util.extract_pdf_text(TEXT_PDF, pdf_util.WHOLE_DOCUMENT, admission.Deadline(0.05))
+        pool.idle.put(busy)
+        with pytest.raises(admission.DeadlineExceeded):
+            pdf_util.extract_pdf_text(TEXT_PDF, pdf_util.WHOLE_DOCUMENT, admission.Deadline(0.000001))
+        assert "Yoshiyuki" in pdf_util.extract_pdf_text(TEXT_PDF, pdf_util.WHOLE_DOCUMENT, admission.Deadline(30))
+    finally:
+        pdf_util.use_extract_pool(None)
+        pool.close()
@@ -0,0 +1,43 @@
+
+import numpy as np
+
+from pdf_trio.feature_store import FeatureStore, feature_store_from_env
+
+SHA1 = "fea48178ffac3a42035ed27d6e2b897cb570cf13"
+
+
+def test_feature_store(tmp_path):
+    store = FeatureStore(str(tmp_path / "features"))
+    assert store.get_tokens(SHA1, "policy=3,2,512") is None
+    store.put_tokens(SHA1, "policy=3,2,512", ["abstract", "naïve", "results"])
+    assert store.get_tokens(SHA1, "policy=3,2,512") == ["abstract", "naïve", "results"]
+    # other extraction settings, other entry
+    assert store.get_tokens(SHA1, "policy=0,0,0") is None
+    # too little text is remembered too
+    store.put_tokens(SHA1, "policy=0,0,0", [])
+    assert store.get_tokens(SHA1, "policy=0,0,0") == []
+
+    image = np.arange(224 * 224 * 3, dtype=np.uint32).astype(np.uint8).reshape((224, 224, 3))
+    store.put_array(SHA1, "page0", "rasterizer=convert", image)
+    stored = store.get_array(SHA1, "page0", "rasterizer=convert")
+    assert isinstance(stored, np.memmap)
+    assert stored.dtype == np.uint8 and np.array_equal(stored, image)
+
+    # shared with other processes by the directory
+    other = FeatureStore(str(tmp_path / "features"))
+    assert np.array_equal(other.get_array(SHA1, "page0", "rasterizer=convert"), image)
+    stats = store.stats()
+    assert stats["tokens_puts"] == 2 and stats["tokens_hits"] == 2 and stats["tokens_misses"] == 2
+    assert stats["page0_hits"] == 1
+
+    # a truncated file is a miss
+    with open(store.path(SHA1, "page0", "rasterizer=convert"), 'r+b') as f:
+        f.truncate(100)
+    assert store.get_array(SHA1, "page0", "rasterizer=convert") is None
+
+
+def test_feature_store_from_env(monkeypatch, tmp_path):
+    monkeypatch.delenv("FEATURE_STORE_DIR", raising=False)
+    assert feature_store_from_env() is None
+    monkeypatch.setenv("FEATURE_STORE_DIR", str(tmp_path / "features"))
+    assert feature_store_from_env().root == str(tmp_path / "features")
@@ -11,6 +11,8 @@ def test_api_misc_routes(flask_client):
     misc_routes = [
         "/",
         "/api/list",
+        "/api/stats",
+        "/metrics",
     ]
     for r in misc_routes:
         resp = flask_client.get(r)
@@ -73,3 +75,117 @@ def test_api_classify_pdf(flask_client):
             assert response.json['linear'] != 0.5
 
     assert len(responses.calls) == 2
+
+
+def tf_batch_callback(request):
+    """
+    Mock tensorflow-serving response with one score vector per example in the request.
+    """
+    body = json.loads(request.body)
+    if "inputs" in body:
+        count = len(body["inputs"]["input_ids"])
+        return (200, {}, json.dumps({'outputs': [[0.000686553773, 0.999313474]] * count}))
+    count = len(body["instances"])
+    return (200, {}, json.dumps({'predictions': [[0.999999881, 1.45352288e-07]] * count}))
+
+
+@responses.activate
+def test_api_classify_pdf_batch(flask_client):
+
+    test_pdf_paths = [
+        'tests/files/research/submission_363.pdf',
+        'tests/files/research/hidden-technical-debt-in-machine-learning-systems__2015.pdf',
+        'tests/files/other/ia_frontpage.pdf',
+    ]
+
+    responses.add_callback(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        callback=tf_batch_callback, content_type="application/json")
+    responses.add_callback(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        callback=tf_batch_callback, content_type="application/json")
+
+    files = [open(p, 'rb') for p in test_pdf_paths]
+    try:
+        form_data = {
+            "type": "all",
+            "pdf_content": [(f, p, "application/octet-stream") for f, p in zip(files, test_pdf_paths)],
+        }
+        response = flask_client.post(
+            "/classify/research-pub/batch",
+            data=form_data,
+        )
+    finally:
+        for f in files:
+            f.close()
+    assert response.status_code == 200
+
+    results = response.json['results']
+    assert [r['filename'] for r in results] == test_pdf_paths
+    for r in results:
+        assert r['is_research'] != 0.5
+    # one multi-example request per back-end
+    assert len(responses.calls) == 2
+
+
+def test_api_admission(flask_client, monkeypatch):
+    from pdf_trio import api_routes, admission
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+
+    def post(headers=None):
+        with open(test_pdf_path, 'rb') as f:
+            return flask_client.post("/classify/research-pub/linear", headers=headers,
+                                     data={"pdf_content": (test_pdf_path, f, "application/octet-stream")})
+
+    monkeypatch.setattr(api_routes.bp, "request_queue", admission.RequestQueue(1, retry_after=3))
+    monkeypatch.setattr(api_routes.bp.pdf_classifier, "result_cache", None)
+    with api_routes.bp.request_queue.admit():
+        response = post()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert post().status_code == 200
+
+    # the deadline passes before pdftotext is started
+    response = post({"X-Request-Timeout": "0.000001"})
+    assert response.status_code == 504
+    assert post({"X-Request-Timeout": "later"}).status_code == 400
+    assert flask_client.get("/api/stats").get_json()["request_queue"]["queue_full"] == 1
+
+
+def test_api_classify_pdf_batch_empty(flask_client):
+    response = flask_client.post("/classify/research-pub/batch", data={"type": "auto"})
+    assert response.status_code == 400
+
+
+@responses.activate
+def test_api_ready(flask_client):
+    from pdf_trio import api_routes
+    api_routes.after_fork()
+
+    # backends not answering yet
+    resp = flask_client.get("/ready")
+    assert resp.status_code == 503
+    assert not resp.get_json()["ready"]
+    assert len(resp.get_json()["errors"]) == 2
+
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json={'outputs': [[0.5, 0.5]]}, status=200)
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json={'predictions': [[0.5, 0.5]]}, status=200)
+    resp = flask_client.get("/ready")
+    assert resp.status_code == 200
+    assert resp.get_json()["ready"]
+    # warm up is done once
+    calls = len(responses.calls)
+    assert flask_client.get("/ready").status_code == 200
+    assert len(responses.calls) == calls
+
+
+def test_api_classify_url_ndjson(flask_client):
+    urls = ["https://arxiv.org/pdf/1607.01759.pdf", "https://example.com/maps/foo.pdf"]
+    body = "".join(json.dumps(u) + "\n" for u in urls)
+    resp = flask_client.post("/classify/research-pub/url", data=body,
+                             headers={"content-type": "application/x-ndjson"})
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    results = [json.loads(line) for line in resp.data.decode('utf-8').splitlines()]
+    assert [r["url"] for r in results] == urls
+    assert all(type(r["confidence"]) == float for r in results)
@@ -0,0 +1,60 @@
+
+import random
+
+import pytest
+
+from pdf_trio import near_dup
+from pdf_trio.near_dup import NearDupIndex
+
+
+def words(seed, n=600):
+    rng = random.Random(seed)
+    return ["w%d" % rng.randrange(5000) for _ in range(n)]
+
+
+def test_signature():
+    index = NearDupIndex(max_entries=10)
+    paper = words(1)
+    # a mirror with a watermark line on every page, and a copy from other pages
+    mirror = list(paper)
+    for offset in range(0, len(mirror), 150):
+        mirror[offset:offset] = ["downloaded", "from", "mirror"]
+    assert near_dup.similarity(index.signature(paper), index.signature(mirror)) > 0.9
+    assert near_dup.similarity(index.signature(paper), index.signature(paper[:300] + words(3, 20) + paper[300:])) > 0.9
+    assert near_dup.similarity(index.signature(paper), index.signature(words(2))) < 0.2
+    assert index.signature(["too", "short"]) is None
+
+
+def test_near_dup_index():
+    index = NearDupIndex(max_entries=2, threshold=0.9)
+    paper = words(1)
+    mirror = paper[:300] + ["downloaded", "from", "mirror"] + paper[300:]
+    index.add(index.signature(paper), "bert", "v1", 0.97)
+    assert index.lookup(index.signature(mirror), "bert", "v1") == 0.97
+    # no score of that model version, or of that model
+    assert index.lookup(index.signature(mirror), "bert", "v2") is None
+    assert index.lookup(index.signature(mirror), "linear", "v1") is None
+    assert index.lookup(index.signature(words(2)), "bert", "v1") is None
+    assert index.lookup(None, "bert", "v1") is None
+
+    # the least recently used is evicted
+    index.add(index.signature(words(2)), "bert", "v1", 0.1)
+    index.add(index.signature(words(3)), "bert", "v1", 0.2)
+    assert index.lookup(index.signature(mirror), "bert", "v1") is None
+    assert index.lookup(index.signature(words(3)), "bert", "v1") == 0.2
+    stats = index.stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    assert stats["bert_lookups"] == 6 and stats["bert_matches"] == 2
+    assert stats["bert_match_rate"] == pytest.approx(2 / 6)
+
+
+def test_near_dup_index_from_env(monkeypatch):
+    monkeypatch.delenv("NEAR_DUP_INDEX_SIZE", raising=False)
+    assert near_dup.near_dup_index_from_env() is None
+    monkeypatch.setenv("NEAR_DUP_INDEX_SIZE", "100")
+    monkeypatch.setenv("NEAR_DUP_THRESHOLD", "0.8")
+    index = near_dup.near_dup_index_from_env()
+    assert index.max_entries == 100 and index.threshold == 0.8
+    monkeypatch.setenv("NEAR_DUP_THRESHOLD", "80")
+    with pytest.raises(ValueError):
+        near_dup.near_dup_index_from_env()
@@ -1,12 +1,18 @@
 
+import io
 import os
 import json
+import time
+import concurrent.futures
 import pytest
 import requests
 import responses
 from werkzeug.datastructures import FileStorage
 
+from pdf_trio import pdf_util
+from pdf_trio import single_flight
 from pdf_trio.pdf_classifier import PdfClassifier
+from pdf_trio.fake_tf_serving import FakeTfServing
 
 
 @responses.activate
@@ -41,3 +47,535 @@ def test_pdf_classifier_basics():
             assert resp['is_research'] != 0.5
 
     assert len(responses.calls) == 4
+
+
+@responses.activate
+def test_pdf_classifier_batch():
+    c = PdfClassifier()
+
+    test_pdf_paths = [
+        'tests/files/research/submission_363.pdf',
+        'tests/files/research/fea48178ffac3a42035ed27d6e2b897cb570cf13.pdf',
+    ]
+
+    tf_bert_json = {'outputs': [[0.000686553773, 0.999313474], [0.000686553773, 0.999313474]]}
+    tf_image_json = {'predictions': [[0.999999881, 1.45352288e-07], [0.999999881, 1.45352288e-07]]}
+
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json=tf_bert_json, status=200)
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json=tf_image_json, status=200)
+
+    files = [open(p, 'rb') for p in test_pdf_paths]
+    try:
+        resp = c.classify_pdf_batch("all", [FileStorage(f) for f in files])
+    finally:
+        for f in files:
+            f.close()
+    assert len(resp) == 2
+    for r in resp:
+        assert r['bert'] != 0.5
+        assert r['image'] != 0.5
+        assert r['is_research'] != 0.5
+
+    # each back-end got a single request carrying both examples
+    assert len(responses.calls) == 2
+    bert_call = [call for call in responses.calls if 'bert_model' in call.request.url][0]
+    bert_request = json.loads(bert_call.request.body)
+    assert len(bert_request['inputs']['input_ids']) == 2
+
+
+@responses.activate
+def test_pdf_classifier_image_batcher(monkeypatch):
+    monkeypatch.setenv("IMAGE_BATCH_SIZE", "4")
+    monkeypatch.setenv("IMAGE_BATCH_WAIT_MS", "100")
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    # copies of one PDF, which would otherwise wait for the first
+    monkeypatch.setenv("SINGLE_FLIGHT", "0")
+    c = PdfClassifier()
+    assert c.image_batcher is not None
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+
+    tf_image_json = {'predictions': [[0.999999881, 1.45352288e-07]] * 3}
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json=tf_image_json, status=200)
+
+    def classify_image(j):
+        with open(test_pdf_path, 'rb') as f:
+            return c.classify_pdf_multi("image", FileStorage(f))
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+    resp = list(pool.map(classify_image, range(3)))
+    for r in resp:
+        assert r['image'] != 0.5
+
+    stats = c.image_batcher.stats()
+    assert stats['items'] == 3
+    assert len(responses.calls) == stats['batches']
+
+
+def test_pdf_classifier_grpc_transport(monkeypatch):
+    pytest.importorskip("grpc")
+    fake = FakeTfServing(scores=(0.1, 0.9))
+    try:
+        target = fake.start_grpc()
+        monkeypatch.setenv("TF_TRANSPORT", "grpc")
+        monkeypatch.setenv("TF_BERT_GRPC_TARGET", target)
+        monkeypatch.setenv("TF_IMAGE_GRPC_TARGET", target)
+        c = PdfClassifier()
+
+        test_pdf_path = 'tests/files/research/submission_363.pdf'
+        with open(test_pdf_path, 'rb') as f:
+            resp = c.classify_pdf_multi("all", FileStorage(f))
+        assert type(resp['bert']) == float
+        assert resp['bert'] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+        assert resp['image'] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+        assert fake.requests == 2
+    finally:
+        fake.stop()
+
+
+def test_pdf_classifier_onnx_transport(monkeypatch, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from pdf_trio import fake_onnx_models
+    monkeypatch.setenv("TF_TRANSPORT", "onnx")
+    monkeypatch.setenv("TF_BERT_ONNX_MODEL", fake_onnx_models.make_bert_model(str(tmp_path / "bert.onnx")))
+    monkeypatch.setenv("TF_IMAGE_ONNX_MODEL", fake_onnx_models.make_image_model(str(tmp_path / "image.onnx")))
+    monkeypatch.setenv("ONNX_INTRA_OP_THREADS", "1")
+    # no tensorflow-serving needed
+    monkeypatch.delenv("TF_BERT_SERVER_URL", raising=False)
+    monkeypatch.delenv("TF_IMAGE_SERVER_URL", raising=False)
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    c = PdfClassifier()
+    assert c.warm_up() == []
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    with open(test_pdf_path, 'rb') as f:
+        resp = c.classify_pdf_multi("all", FileStorage(f))
+    for classifier in ("bert", "image"):
+        assert type(resp[classifier]) == float
+        assert 0.0 <= resp[classifier] <= 1.0 and resp[classifier] != 0.5
+
+
+def test_pdf_classifier_bert_seq_buckets(monkeypatch, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from pdf_trio import fake_onnx_models
+    monkeypatch.setenv("TF_TRANSPORT", "onnx")
+    monkeypatch.setenv("TF_BERT_ONNX_MODEL", fake_onnx_models.make_bert_model(str(tmp_path / "bert.onnx")))
+    monkeypatch.setenv("TF_IMAGE_ONNX_MODEL", fake_onnx_models.make_image_model(str(tmp_path / "image.onnx")))
+    monkeypatch.setenv("ONNX_INTRA_OP_THREADS", "1")
+    monkeypatch.setenv("TF_MAX_BATCH_SIZE", "2")
+    padded = PdfClassifier()
+    assert padded.bert_seq_buckets == [512]
+    monkeypatch.setenv("BERT_SEQ_BUCKETS", "64,128,256")
+    bucketed = PdfClassifier()
+    assert bucketed.bert_seq_buckets == [64, 128, 256, 512]
+    assert bucketed.warm_up() == []
+
+    words = "abstract introduction method results references university journal".split()
+    token_lists = [(words * 80)[:n] for n in (0, 10, 64, 65, 200, 300, 512)]
+    assert [len(bucketed.bert_features(t)[0]) for t in token_lists] == [64, 64, 64, 128, 256, 512, 512]
+    # scores match the padded-512 path, in request chunks of mixed lengths too
+    expected = padded.classify_pdf_bert_batch(token_lists)
+    assert bucketed.classify_pdf_bert_batch(token_lists) == pytest.approx(expected, abs=1e-6)
+    assert bucketed.classify_pdf_bert_batch(token_lists[::-1]) == pytest.approx(expected[::-1], abs=1e-6)
+    monkeypatch.setenv("BERT_BATCH_SIZE", "4")
+    batched = PdfClassifier()
+    assert batched.classify_pdf_bert_batch(token_lists) == pytest.approx(expected, abs=1e-6)
+
+    monkeypatch.setenv("BERT_SEQ_BUCKETS", "128,1024")
+    with pytest.raises(ValueError):
+        PdfClassifier()
+
+
+@responses.activate
+def test_pdf_classifier_result_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("RESULT_CACHE_DB", str(tmp_path / "results.sqlite"))
+    c = PdfClassifier()
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+
+    tf_bert_json = {'outputs': [[0.000686553773, 0.999313474]]}
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json=tf_bert_json, status=200)
+
+    with open(test_pdf_path, 'rb') as f:
+        first = c.classify_pdf_multi("linear,bert", FileStorage(f))
+    assert len(responses.calls) == 1
+    with open(test_pdf_path, 'rb') as f:
+        second = c.classify_pdf_multi("bert,linear", FileStorage(f))
+    assert second == first
+    assert len(responses.calls) == 1
+    assert c.result_cache.stats()['memory_hits'] == 1
+
+    # persistent tier survives a restart
+    c2 = PdfClassifier()
+    with open(test_pdf_path, 'rb') as f:
+        third = c2.classify_pdf_multi("linear,bert", FileStorage(f))
+    assert third == first
+    assert c2.result_cache.stats()['disk_hits'] == 1
+
+    # a model version bump misses
+    c2.version_map = dict(c2.version_map, bert="20200101")
+    with open(test_pdf_path, 'rb') as f:
+        c2.classify_pdf_multi("linear,bert", FileStorage(f))
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_pdf_classifier_feature_store(monkeypatch, tmp_path):
+    monkeypatch.setenv("FEATURE_STORE_DIR", str(tmp_path / "features"))
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    c = PdfClassifier()
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json={'outputs': [[0.000686553773, 0.999313474]]}, status=200)
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json={'predictions': [[0.999999881, 1.45352288e-07]]}, status=200)
+    with open(test_pdf_path, 'rb') as f:
+        first = c.classify_pdf_multi("all", FileStorage(f))
+    stats = c.feature_store.stats()
+    assert stats["tokens_puts"] == 1 and stats["bert_ids_puts"] == 1 and stats["page0_puts"] == 1
+
+    # re-scoring with a new model version only runs the models
+    def no_extraction(*args, **kwargs):
+        raise AssertionError("extracted again")
+
+    for name in ("extract_pdf_text", "extract_pdf_image", "extract_pdf_text_from_content",
+                 "extract_pdf_image_from_content", "render_pdf_page0"):
+        monkeypatch.setattr(pdf_util, name, no_extraction)
+    c.version_map = dict(c.version_map, bert="20200101")
+    with open(test_pdf_path, 'rb') as f:
+        second = c.classify_pdf_multi("all", FileStorage(f))
+    assert second["bert"] == first["bert"] and second["image"] == first["image"]
+    assert second["linear"] == first["linear"]
+    stats = c.feature_store.stats()
+    assert stats["tokens_hits"] == 1 and stats["bert_ids_hits"] == 1 and stats["page0_hits"] == 1
+    # the models got the same inputs
+    assert len(responses.calls) == 4
+    assert responses.calls[2].request.body == responses.calls[0].request.body
+    assert responses.calls[3].request.body == responses.calls[1].request.body
+
+
+@responses.activate
+def test_pdf_classifier_feature_store_timeout(monkeypatch, tmp_path):
+    monkeypatch.setenv("FEATURE_STORE_DIR", str(tmp_path / "features"))
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    c = PdfClassifier()
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json={'predictions': [[0.999999881, 1.45352288e-07]]}, status=200)
+    # pdftotext and convert time out, which is not remembered as a PDF without text or image
+    monkeypatch.setattr(pdf_util, "SUBPROCESS_TIMEOUT", 0.000001)
+    with open(test_pdf_path, 'rb') as f:
+        first = c.classify_pdf_multi("linear,image", FileStorage(f))
+    assert "image" not in first
+    stats = c.feature_store.stats()
+    assert stats.get("tokens_puts", 0) == 0 and stats.get("page0_puts", 0) == 0
+
+    # so the next time they are extracted again
+    monkeypatch.setattr(pdf_util, "SUBPROCESS_TIMEOUT", 30)
+    with open(test_pdf_path, 'rb') as f:
+        second = c.classify_pdf_multi("linear,image", FileStorage(f))
+    assert "image" in second and second["linear"] != 0.5
+    stats = c.feature_store.stats()
+    assert stats["tokens_puts"] == 1 and stats["page0_puts"] == 1
+    assert stats.get("tokens_hits", 0) == 0 and stats.get("page0_hits", 0) == 0
+
+
+@responses.activate
+def test_pdf_classifier_near_dup(monkeypatch):
+    monkeypatch.setenv("NEAR_DUP_INDEX_SIZE", "100")
+    c = PdfClassifier()
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json={'outputs': [[0.000686553773, 0.999313474]]}, status=200)
+    with open(test_pdf_path, 'rb') as f:
+        pdf_content = f.read()
+    first = c.classify_pdf_multi("linear,bert", FileStorage(io.BytesIO(pdf_content)))
+    assert len(responses.calls) == 1
+
+    # a byte-different copy with the same text misses the result cache, not the near-dup index
+    second = c.classify_pdf_multi("linear,bert", FileStorage(io.BytesIO(pdf_content + b"\n% mirror copy\n")))
+    assert len(responses.calls) == 1
+    assert second == first
+    stats = c.near_dup.stats()
+    assert stats["bert_matches"] == 1 and stats["linear_matches"] == 1
+
+    # not for scores of another model version
+    c.version_map = dict(c.version_map, bert="20200101")
+    c.classify_pdf_multi("bert", FileStorage(io.BytesIO(pdf_content + b"\n% another copy\n")))
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_pdf_classifier_single_flight(monkeypatch):
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    c = PdfClassifier()
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    with open(test_pdf_path, 'rb') as f:
+        pdf_content = f.read()
+
+    def wait_for_copy():
+        # the first request is at the back-end; let the copy arrive
+        deadline = time.time() + 10
+        while c.single_flight.stats().get("coalesced", 0) < 1 and time.time() < deadline:
+            time.sleep(0.001)
+
+    def bert_callback(request):
+        wait_for_copy()
+        return 200, {}, json.dumps({'outputs': [[0.000686553773, 0.999313474]]})
+
+    responses.add_callback(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+                           callback=bert_callback, content_type='application/json')
+
+    def classify():
+        return c.classify_pdf_multi("bert", FileStorage(io.BytesIO(pdf_content)))
+
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        first = pool.submit(classify)
+        while c.single_flight.stats().get("leaders", 0) < 1:
+            time.sleep(0.001)
+        copy = pool.submit(classify)
+        assert first.result() == copy.result()
+    assert first.result()["bert"] != 0.5
+    assert len(responses.calls) == 1
+
+    # an error of the first request is raised to the copies too
+    def failing_extract(job, policy):
+        wait_for_copy()
+        raise RuntimeError("pdftotext crashed")
+
+    c.single_flight = single_flight.SingleFlight()
+    monkeypatch.setattr(c, "extract_tokens", failing_extract)
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        first = pool.submit(classify)
+        while c.single_flight.stats().get("leaders", 0) < 1:
+            time.sleep(0.001)
+        copy = pool.submit(classify)
+        for future in (first, copy):
+            with pytest.raises(RuntimeError):
+                future.result()
+    assert c.single_flight.stats()["in_flight"] == 0
+
+
+@responses.activate
+def test_pdf_classifier_in_memory(monkeypatch):
+    monkeypatch.setenv("PDF_EXTRACT_IN_MEMORY", "1")
+    c = PdfClassifier()
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+
+    tf_bert_json = {'outputs': [[0.000686553773, 0.999313474]]}
+    tf_image_json = {'predictions': [[0.999999881, 1.45352288e-07]]}
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json=tf_bert_json, status=200)
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json=tf_image_json, status=200)
+
+    tmp_files_before = set(os.listdir(pdf_util.tmp_area))
+    with open(test_pdf_path, 'rb') as f:
+        resp = c.classify_pdf_multi("all", FileStorage(f))
+    for mode in ("image", "linear", "bert"):
+        assert resp[mode] != 0.5
+    # nothing was written to the tmp area
+    assert set(os.listdir(pdf_util.tmp_area)) == tmp_files_before
+
+
+@responses.activate
+def test_pdf_classifier_speculative_image(monkeypatch):
+    monkeypatch.setenv("AUTO_SPECULATIVE_IMAGE", "1")
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    c = PdfClassifier()
+
+    tf_image_json = {'predictions': [[0.999999881, 1.45352288e-07]]}
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json=tf_image_json, status=200)
+
+    # enough text: linear decides, the speculative render is thrown away
+    tmp_files_before = set(os.listdir(pdf_util.tmp_area))
+    with open('tests/files/research/submission_363.pdf', 'rb') as f:
+        resp = c.classify_pdf_multi("auto", FileStorage(f))
+    assert 'linear' in resp
+    assert 'image' not in resp
+    for j in range(50):
+        if set(os.listdir(pdf_util.tmp_area)) == tmp_files_before:
+            break
+        time.sleep(0.1)
+    assert set(os.listdir(pdf_util.tmp_area)) == tmp_files_before
+    assert len(responses.calls) == 0
+
+    # scanned page without text: the already rendered page 0 is used
+    with open('tests/files/scanned/scanned_page.pdf', 'rb') as f:
+        resp = c.classify_pdf_multi("auto", FileStorage(f))
+    assert 'linear' not in resp
+    assert resp['image'] != 0.5
+    assert len(responses.calls) == 1
+
+    # a failure before the image stage gets the rendered page 0 does not leave it behind
+    def fail(branches):
+        raise RuntimeError("branch failed")
+    monkeypatch.setattr(c, "run_branches", fail)
+    tmp_files_before = set(os.listdir(pdf_util.tmp_area))
+    with open('tests/files/scanned/scanned_page.pdf', 'rb') as f:
+        with pytest.raises(RuntimeError):
+            c.classify_pdf_multi("auto", FileStorage(f))
+    assert set(os.listdir(pdf_util.tmp_area)) <= tmp_files_before
+
+
+@responses.activate
+def test_pdf_classifier_serial_branches(monkeypatch):
+    monkeypatch.setenv("PARALLEL_BRANCHES", "0")
+    c = PdfClassifier()
+
+    tf_bert_json = {'outputs': [[0.000686553773, 0.999313474]]}
+    tf_image_json = {'predictions': [[0.999999881, 1.45352288e-07]]}
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json=tf_bert_json, status=200)
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json=tf_image_json, status=200)
+
+    with open('tests/files/research/submission_363.pdf', 'rb') as f:
+        resp = c.classify_pdf_multi("all", FileStorage(f))
+    for mode in ("image", "linear", "bert"):
+        assert resp[mode] != 0.5
+
+
+@responses.activate
+def test_pdf_classifier_pdfium_rasterizer(monkeypatch):
+    pytest.importorskip("pypdfium2")
+    monkeypatch.setenv("PDF_RASTERIZER", "pdfium")
+    monkeypatch.setenv("PDF_EXTRACT_IN_MEMORY", "1")
+    c = PdfClassifier()
+
+    tf_image_json = {'predictions': [[0.999999881, 1.45352288e-07]]}
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json=tf_image_json, status=200)
+
+    with open('tests/files/research/submission_363.pdf', 'rb') as f:
+        resp = c.classify_pdf_multi("image", FileStorage(f))
+    assert resp['image'] != 0.5
+    image_request = json.loads(responses.calls[0].request.body)
+    assert len(image_request['instances'][0]) == 299
+
+
+@responses.activate
+def test_pdf_classifier_metrics(monkeypatch):
+    from prometheus_client import REGISTRY
+    from pdf_trio import metrics
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    c = PdfClassifier()
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json={'error': 'model not loaded'}, status=503)
+    responses.add(responses.POST, 'http://localhost:8501/v1/models/image_model:predict',
+        json={'predictions': [[0.999999881, 1.45352288e-07]]}, status=200)
+
+    before_text = sample('pdf_trio_stage_seconds_count', stage='extract_text')
+    before_image = sample('pdf_trio_stage_seconds_count', stage='image_request')
+    before_errors = sample('pdf_trio_backend_errors_total', model='bert')
+    with open('tests/files/research/submission_363.pdf', 'rb') as f:
+        resp = c.classify_pdf_multi("all", FileStorage(f))
+    # the failed BERT request still shows up as 0.5, but is counted
+    assert resp['bert'] == 0.5
+    assert sample('pdf_trio_backend_errors_total', model='bert') == before_errors + 1
+    assert sample('pdf_trio_stage_seconds_count', stage='extract_text') == before_text + 1
+    assert sample('pdf_trio_stage_seconds_count', stage='image_request') == before_image + 1
+
+    before_image_path = sample('pdf_trio_auto_path_total', path='image')
+    with open('tests/files/scanned/scanned_page.pdf', 'rb') as f:
+        c.classify_pdf_multi("auto", FileStorage(f))
+    assert sample('pdf_trio_auto_path_total', path='image') == before_image_path + 1
+
+    data, content_type = metrics.generate()
+    assert b'pdf_trio_stage_seconds_bucket{le="0.005",stage="extract_text"}' in data
+
+
+@responses.activate
+def test_pdf_classifier_text_policy(monkeypatch):
+    from benchmarks import synthetic_pdfs
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    monkeypatch.setenv("BERT_HEAD_PAGES", "1")
+    monkeypatch.setenv("BERT_TAIL_PAGES", "1")
+    monkeypatch.setenv("LINEAR_MAX_TOKENS", "0")
+    c = PdfClassifier()
+    assert c.text_policy(["bert"]) == (1, 1, 512)
+    # the linear classifier gets all of the text by default
+    assert c.text_policy(["linear", "bert"]) == pdf_util.WHOLE_DOCUMENT
+
+    extracted = []
+    extract_pdf_text = pdf_util.extract_pdf_text
+
+    def spy(pdf_tmp_file, policy=pdf_util.WHOLE_DOCUMENT, *args):
+        text = extract_pdf_text(pdf_tmp_file, policy, *args)
+        extracted.append(text)
+        return text
+
+    monkeypatch.setattr(pdf_util, "extract_pdf_text", spy)
+    responses.add(responses.POST, 'http://localhost:8601/v1/models/bert_model:predict',
+        json={'outputs': [[0.000686553773, 0.999313474]]}, status=200)
+    pdf_content = synthetic_pdfs.text_pdf(20, lines_per_page=10)
+    resp = c.classify_pdf_multi("bert", FileStorage(io.BytesIO(pdf_content), filename="long.pdf"))
+    assert resp['bert'] != 0.5
+    whole = pdf_util.extract_pdf_text_from_content(pdf_content)
+    assert len(extracted[0]) < len(whole) / 5
+    bert_request = json.loads(responses.calls[0].request.body)
+    assert sum(bert_request['inputs']['input_mask'][0]) <= 512
+
+    monkeypatch.setenv("LINEAR_HEAD_PAGES", "-1")
+    with pytest.raises(ValueError):
+        PdfClassifier()
+
+
+def test_pdf_classifier_after_fork():
+    c = PdfClassifier()
+    extract_pool = c.extract_pool
+    fasttext_model = c.fasttext_model
+    c.after_fork()
+    # new per-process state, same models
+    assert c.extract_pool is not extract_pool
+    assert c.fasttext_model is fasttext_model
+
+    fake = FakeTfServing()
+    base_url = fake.start_rest()
+    try:
+        c.bert_server_prefix = c.image_server_prefix = base_url
+        assert len(c.warm_up()) == 2
+        c.after_fork()
+        assert c.warm_up() == []
+    finally:
+        fake.stop()
+
+
+@responses.activate
+def test_pdf_classifier_cascade(monkeypatch):
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "10")
+    monkeypatch.setenv("AUTO_CASCADE", json.dumps({
+        "url": [{"classifier": "urlmeta", "uncertain": [0.5, 0.5]}],
+        "text": [{"classifier": "linear"}],
+        "no_text": [{"classifier": "image"}],
+    }))
+    c = PdfClassifier()
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+
+    # a confident URL prior, nothing else to run
+    with open(test_pdf_path, 'rb') as f:
+        resp = c.classify_pdf_multi("auto", FileStorage(f), url="https://arxiv.org/pdf/1607.01759.pdf")
+    assert set(resp) == {"version", "urlmeta", "is_research"}
+    # without a URL, the linear classifier is final
+    with open(test_pdf_path, 'rb') as f:
+        resp = c.classify_pdf_multi("auto", FileStorage(f))
+    assert set(resp) == {"version", "linear", "is_research"}
+    assert len(responses.calls) == 0
+    stats = c.cascade.stats()
+    assert stats["linear_rate"] > 0
+    assert stats["expected_cost_ms"] > 0
@@ -1,7 +1,13 @@
 
 import os
+import asyncio
+import subprocess
 
-from pdf_trio import pdf_util
+import pytest
+import numpy as np
+from cv2 import cv2
+
+from pdf_trio import pdf_util, text_prep
 
 
 def test_extract_pdf_text():
@@ -36,3 +42,134 @@ def test_extract_pdf_prev():
 
     assert text
     assert "Yoshiyuki" in text
+
+
+def test_extract_from_content():
+
+    test_pdf_path = 'tests/files/research/fea48178ffac3a42035ed27d6e2b897cb570cf13.pdf'
+    with open(test_pdf_path, 'rb') as f:
+        pdf_content = f.read()
+    text = pdf_util.extract_pdf_text_from_content(pdf_content)
+    assert "Yoshiyuki" in text
+    assert text_prep.extract_tokens(text) == text_prep.extract_tokens(pdf_util.extract_pdf_text(test_pdf_path))
+
+    jpg = pdf_util.extract_pdf_image_from_content(pdf_content)
+    assert jpg.startswith(b'\xff\xd8')  # jpeg magic
+
+    assert pdf_util.extract_pdf_text_from_content(b"not a pdf") == ""
+    assert pdf_util.extract_pdf_image_from_content(b"not a pdf") == b""
+
+
+def test_render_pdf_page0():
+    pytest.importorskip("pypdfium2")
+
+    test_pdf_path = 'tests/files/research/submission_363.pdf'
+    img = pdf_util.render_pdf_page0(test_pdf_path)
+    assert img.shape == (224, 224, 3)
+    assert img.dtype == 'uint8'
+    # 156 px wide thumbnail centered on a white extent
+    assert (img[:, :34] == 255).all()
+    assert (img[:, 190:] == 255).all()
+
+    with open(test_pdf_path, 'rb') as f:
+        assert (pdf_util.render_pdf_page0(f.read()) == img).all()
+
+    assert pdf_util.render_pdf_page0(b"not a pdf") is None
+
+
+def imagemagick_installed():
+    try:
+        return b"ImageMagick" in subprocess.run(['convert', '-version'], stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def test_render_pdf_page0_parity():
+    pytest.importorskip("pypdfium2")
+    if not imagemagick_installed():
+        pytest.skip("the convert parity reference needs ImageMagick")
+
+    for path in ('tests/files/research/submission_363.pdf', 'tests/files/other/ia_frontpage.pdf',
+                 'tests/files/scanned/scanned_page.pdf'):
+        with open(path, 'rb') as f:
+            pdf_content = f.read()
+        jpg = pdf_util.extract_pdf_image_from_content(pdf_content)
+        expected = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        img = pdf_util.render_pdf_page0(pdf_content)
+        assert img.shape == expected.shape
+        # ghostscript and pdfium anti-alias differently; a missing step, like equalize, is 10 to 20 off
+        assert np.abs(img.astype(int) - expected.astype(int)).mean() < 8, path
+
+
+def test_extraction_status():
+
+    with pdf_util.extraction_status() as status:
+        assert pdf_util.run_piped(['cat'], b"text") == b"text"
+    assert status.complete
+    with pdf_util.extraction_status() as status:
+        pdf_util.run_piped(['sleep', '5'], b"", timeout=0.01)
+    assert not status.complete
+
+    async def timed_out():
+        with pdf_util.extraction_status() as status:
+            await pdf_util.run_piped_async(['sleep', '5'], b"", timeout=0.01)
+        return status
+    assert not asyncio.run(timed_out()).complete
+    # outside of extraction_status() nothing is tracked
+    pdf_util.mark_incomplete()
+
+
+def test_page_ranges():
+    policy = pdf_util.TextPolicy(head_pages=3, tail_pages=2, max_tokens=0)
+    assert pdf_util.page_ranges(100, policy) == [(1, 3), (99, 100)]
+    assert pdf_util.page_ranges(5, policy) == [None]
+    assert pdf_util.page_ranges(0, policy) == [None]  # page count unknown
+    assert pdf_util.page_ranges(100, pdf_util.TextPolicy(0, 4, 0)) == [(97, 100)]
+    assert pdf_util.page_ranges(100, pdf_util.WHOLE_DOCUMENT) == [None]
+
+    assert policy.union(pdf_util.TextPolicy(50, 0, 512)) == (50, 2, 0)
+    assert pdf_util.TextPolicy(1, 1, 512).union(pdf_util.TextPolicy(2, 0, 30000)) == (2, 1, 30000)
+    assert policy.union(pdf_util.WHOLE_DOCUMENT) == pdf_util.WHOLE_DOCUMENT
+
+    assert pdf_util.parse_page_count(b"Producer: x\nPages:          12\n") == 12
+    assert pdf_util.parse_page_count(b"") == 0
+
+
+def test_extract_pdf_text_page_bounded(tmp_path):
+    from benchmarks import synthetic_pdfs
+
+    pdf_content = synthetic_pdfs.text_pdf(12, seed=3, lines_per_page=5)
+    pdf_path = str(tmp_path / "pages.pdf")
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf_content)
+    head = text_prep.extract_tokens(pdf_util.extract_pdf_text(pdf_path, pdf_util.TextPolicy(2, 0, 0)))
+    tail = text_prep.extract_tokens(pdf_util.extract_pdf_text(pdf_path, pdf_util.TextPolicy(0, 1, 0)))
+    whole = text_prep.extract_tokens(pdf_util.extract_pdf_text(pdf_path))
+    assert head == whole[:len(head)]
+    assert tail == whole[-len(tail):]
+    assert len(head) + len(tail) < len(whole) / 3
+
+    policy = pdf_util.TextPolicy(head_pages=2, tail_pages=1, max_tokens=0)
+    tokens = text_prep.extract_tokens(pdf_util.extract_pdf_text(pdf_path, policy))
+    assert tokens == head + tail
+    assert text_prep.extract_tokens(pdf_util.extract_pdf_text_from_content(pdf_content, policy)) == tokens
+
+    # head pages only need no page count, pdfinfo is not run
+    def no_pdfinfo(*args):
+        raise AssertionError("pdfinfo run")
+    assert pdf_util.text_page_ranges(pdf_util.TextPolicy(2, 0, 0), no_pdfinfo) == [(1, 2)]
+    assert pdf_util.text_page_ranges(pdf_util.WHOLE_DOCUMENT, no_pdfinfo) == [None]
+    assert pdf_util.text_page_ranges(policy, lambda: 12) == [(1, 2), (12, 12)]
+    assert pdf_util.text_page_ranges(policy, lambda: 3) == [None]
+
+
+def test_extract_tokens_budget():
+    test_pdf_path = 'tests/files/research/fea48178ffac3a42035ed27d6e2b897cb570cf13.pdf'
+    text = pdf_util.extract_pdf_text(test_pdf_path)
+    tokens = text_prep.extract_tokens(text)
+    for max_tokens in (1, 2, 511, 512, len(tokens), len(tokens) + 1):
+        assert text_prep.extract_tokens(text, max_tokens) == text_prep.trim_tokens(tokens, max_tokens)
+    # a budget that needs the tail window to grow
+    long_tokens = " ".join(str(j) * 40 for j in range(100))
+    assert text_prep.extract_tokens(long_tokens, 10) == text_prep.trim_tokens(long_tokens.split(), 10)
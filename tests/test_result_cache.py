@@ -0,0 +1,63 @@
+
+from pdf_trio.result_cache import ResultCache, result_cache_from_env
+
+
+VERSIONS = {"linear": "20190720", "bert": "20190923T2215"}
+
+
+def test_make_key():
+    k = ResultCache.make_key(b"%PDF-1.4 one", "bert,linear", VERSIONS)
+    assert k == ResultCache.make_key(b"%PDF-1.4 one", "linear,bert", VERSIONS)
+    assert k != ResultCache.make_key(b"%PDF-1.4 two", "linear,bert", VERSIONS)
+    assert k != ResultCache.make_key(b"%PDF-1.4 one", "linear", VERSIONS)
+    assert k != ResultCache.make_key(b"%PDF-1.4 one", "linear,bert", dict(VERSIONS, bert="20200101"))
+
+
+def test_memory_lru():
+    c = ResultCache(max_entries=2)
+    c.put("a", {"is_research": 0.9})
+    c.put("b", {"is_research": 0.8})
+    assert c.get("a") == {"is_research": 0.9}
+    c.put("c", {"is_research": 0.7})
+    # b was least recently used
+    assert c.get("b") is None
+    assert c.get("a") is not None
+    assert c.get("c") is not None
+
+    # callers get copies
+    c.get("a")["is_research"] = 0.0
+    assert c.get("a") == {"is_research": 0.9}
+
+    stats = c.stats()
+    assert stats["memory_hits"] == 5
+    assert stats["misses"] == 1
+    assert stats["memory_evictions"] == 1
+    assert stats["memory_entries"] == 2
+
+
+def test_disk_tier_eviction(tmp_path):
+    db_path = str(tmp_path / "results.sqlite")
+    c = ResultCache(max_entries=0, db_path=db_path, max_db_mb=0.001)  # about 1000 bytes
+    for j in range(40):
+        c.put("k%d" % j, {"is_research": j / 40.0, "pad": "x" * 50})
+    stats = c.stats()
+    assert stats["disk_evictions"] > 0
+    assert stats["disk_bytes"] <= 0.001 * 1024 * 1024
+    # newest entries are kept, oldest evicted
+    assert c.get("k39")["pad"] == "x" * 50
+    assert c.get("k0") is None
+
+    reopened = ResultCache(max_entries=10, db_path=db_path)
+    assert reopened.get("k39") is not None
+    assert reopened.stats()["disk_hits"] == 1
+    # promoted to the memory tier
+    reopened.get("k39")
+    assert reopened.stats()["memory_hits"] == 1
+
+
+def test_result_cache_from_env(monkeypatch):
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    monkeypatch.delenv("RESULT_CACHE_DB", raising=False)
+    assert result_cache_from_env() is None
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "5")
+    assert result_cache_from_env().max_entries == 5
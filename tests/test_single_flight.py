@@ -0,0 +1,62 @@
+
+import asyncio
+import threading
+import concurrent.futures
+
+import pytest
+
+from pdf_trio import admission
+from pdf_trio.single_flight import SingleFlight, LeaderGone, single_flight_from_env
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    future, first = flights.begin("a")
+    assert first
+    waiters = [flights.begin("a") for _ in range(3)]
+    assert all(f is future and not first for f, first in waiters)
+    assert flights.begin("b")[1]
+    with pytest.raises(concurrent.futures.TimeoutError):
+        SingleFlight.wait(future, 0.01)
+
+    got = []
+    threads = [threading.Thread(target=lambda: got.append(SingleFlight.wait(future))) for _ in range(3)]
+    for t in threads:
+        t.start()
+    flights.finish("a", future, {"is_research": 0.9})
+    for t in threads:
+        t.join()
+    assert got == [{"is_research": 0.9}] * 3
+    # waiters get copies
+    got[0]["is_research"] = 0.0
+    assert SingleFlight.wait(future) == {"is_research": 0.9}
+
+    # done, so the next request for the key goes first
+    assert flights.begin("a")[1]
+    stats = flights.stats()
+    assert stats["leaders"] == 3 and stats["coalesced"] == 3 and stats["in_flight"] == 2
+
+
+def test_single_flight_errors():
+    flights = SingleFlight()
+    future, _ = flights.begin("a")
+    flights.finish("a", future, error=ValueError("not a PDF"))
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            SingleFlight.wait(future)
+
+    # the first request running out of its own time is not an error of the others
+    for error in (admission.DeadlineExceeded("deadline passed"), KeyboardInterrupt(), asyncio.CancelledError(),
+                  concurrent.futures.CancelledError()):
+        future, _ = flights.begin("b")
+        flights.finish("b", future, error=error)
+        with pytest.raises(LeaderGone):
+            SingleFlight.wait(future)
+    assert flights.stats()["errors"] == 5
+
+
+def test_single_flight_from_env(monkeypatch):
+    monkeypatch.delenv("SINGLE_FLIGHT", raising=False)
+    assert single_flight_from_env() is not None
+    monkeypatch.setenv("SINGLE_FLIGHT", "0")
+    assert single_flight_from_env() is None
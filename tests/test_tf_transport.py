@@ -0,0 +1,131 @@
+
+import collections
+
+import numpy as np
+import pytest
+
+from pdf_trio import tf_transport
+from pdf_trio.fake_tf_serving import FakeTfServing
+
+
+@pytest.fixture
+def fake_tf_serving():
+    fake = FakeTfServing(scores=(0.2, 0.8))
+    yield fake
+    fake.stop()
+
+
+def bert_inputs(batch_size):
+    inputs = collections.OrderedDict()
+    inputs["input_ids"] = np.arange(batch_size * 512, dtype=np.int32).reshape(batch_size, 512)
+    inputs["input_mask"] = np.ones((batch_size, 512), dtype=np.int32)
+    inputs["label_ids"] = np.zeros(batch_size, dtype=np.int32)
+    inputs["segment_ids"] = np.zeros((batch_size, 512), dtype=np.int32)
+    return inputs
+
+
+def test_tensor_codec_roundtrip():
+    for array in (np.random.rand(2, 3, 4).astype(np.float32),
+                  np.arange(10, dtype=np.int32).reshape(2, 5),
+                  np.array([-1, 2**40], dtype=np.int64)):
+        decoded = tf_transport.decode_tensor(tf_transport.encode_tensor(array))
+        assert decoded.dtype == array.dtype
+        assert decoded.shape == array.shape
+        assert np.array_equal(decoded, array)
+
+    request = tf_transport.encode_predict_request("bert_model", "serving_default", bert_inputs(3))
+    model_name, signature_name, inputs = tf_transport.decode_predict_request(request)
+    assert model_name == "bert_model"
+    assert signature_name == "serving_default"
+    assert list(inputs) == ["input_ids", "input_mask", "label_ids", "segment_ids"]
+    assert np.array_equal(inputs["input_ids"], bert_inputs(3)["input_ids"])
+
+
+def test_decode_tensor_float_val():
+    # tensorflow-serving often answers with packed float_val instead of tensor_content
+    shape = b"".join(tf_transport._field_bytes(2, tf_transport._field_varint(1, d)) for d in (2, 2))
+    values = np.array([0.25, 0.75, 0.5, 0.5], dtype='<f4').tobytes()
+    buf = (tf_transport._field_varint(1, tf_transport.DT_FLOAT) + tf_transport._field_bytes(2, shape) +
+           tf_transport._field_bytes(5, values))
+    assert np.allclose(tf_transport.decode_tensor(buf), [[0.25, 0.75], [0.5, 0.5]])
+
+
+def test_rest_transport(fake_tf_serving):
+    server_prefix = fake_tf_serving.start_rest()
+    bert = tf_transport.RestTransport(server_prefix, "bert_model")
+    outputs = bert.predict(bert_inputs(3))
+    assert outputs.shape == (3, 2)
+    assert np.allclose(outputs[:, 1], 0.8)
+
+    image = tf_transport.RestTransport(server_prefix, "image_model", instances_input="image")
+    predictions = image.predict({"image": np.zeros((2, 299, 299, 3), dtype=np.float32)})
+    assert predictions.shape == (2, 2)
+    assert fake_tf_serving.requests == 2
+    assert fake_tf_serving.examples == 5
+
+    missing = tf_transport.RestTransport(server_prefix.replace("/v1", "/nope"), "bert_model")
+    missing.url = server_prefix + "/models/bert_model"  # not a :predict path
+    with pytest.raises(tf_transport.TransportError):
+        missing.predict(bert_inputs(1))
+
+
+def test_grpc_transport(fake_tf_serving):
+    pytest.importorskip("grpc")
+    target = fake_tf_serving.start_grpc()
+    bert = tf_transport.GrpcTransport(target, "bert_model")
+    outputs = bert.predict(bert_inputs(4))
+    assert outputs.shape == (4, 2)
+    assert np.allclose(outputs[:, 1], 0.8)
+
+    image = tf_transport.GrpcTransport(target, "image_model", output_key="probabilities")
+    predictions = image.predict({"image": np.zeros((1, 299, 299, 3), dtype=np.float32)})
+    assert predictions.shape == (1, 2)
+
+    wrong_key = tf_transport.GrpcTransport(target, "image_model", output_key="scores")
+    with pytest.raises(tf_transport.TransportError):
+        wrong_key.predict({"image": np.zeros((1, 299, 299, 3), dtype=np.float32)})
+
+
+def test_transport_from_env(monkeypatch):
+    monkeypatch.delenv("TF_TRANSPORT", raising=False)
+    t = tf_transport.transport_from_env("BERT", "bert_model", "http://localhost:8601/v1")
+    assert isinstance(t, tf_transport.RestTransport)
+    assert t.url == "http://localhost:8601/v1/models/bert_model:predict"
+
+    monkeypatch.setenv("TF_TRANSPORT", "grpc")
+    monkeypatch.delenv("TF_BERT_GRPC_TARGET", raising=False)
+    with pytest.raises(ValueError):
+        tf_transport.transport_from_env("BERT", "bert_model", "http://localhost:8601/v1")
+
+
+def test_onnx_transport(tmp_path, monkeypatch):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from pdf_trio import fake_onnx_models
+    bert_path = fake_onnx_models.make_bert_model(str(tmp_path / "bert_model.onnx"))
+    image_path = fake_onnx_models.make_image_model(str(tmp_path / "image_model.onnx"))
+
+    bert = tf_transport.OnnxTransport(bert_path, intra_op_threads=1)
+    outputs = bert.predict(bert_inputs(3))
+    assert outputs.shape == (3, 2)
+    assert np.allclose(outputs.sum(axis=1), 1.0)
+    # same scores one at a time as in a batch, also from int64 inputs
+    inputs = bert_inputs(3)
+    one = collections.OrderedDict((k, v[1:2].astype(np.int64)) for k, v in inputs.items())
+    assert np.allclose(bert.predict(one)[0], outputs[1], atol=1e-6)
+    with pytest.raises(tf_transport.TransportError):
+        bert.predict({"input_ids": inputs["input_ids"]})
+
+    image = tf_transport.OnnxTransport(image_path)
+    predictions = image.predict({"pixels": np.zeros((2, 299, 299, 3), dtype=np.float32)})
+    assert predictions.shape == (2, 2)
+    with pytest.raises(ValueError):
+        tf_transport.OnnxTransport(image_path, output_key="scores")
+
+    monkeypatch.setenv("TF_TRANSPORT", "onnx")
+    monkeypatch.delenv("TF_BERT_ONNX_MODEL", raising=False)
+    with pytest.raises(ValueError):
+        tf_transport.transport_from_env("BERT", "bert_model", "")
+    monkeypatch.setenv("TF_BERT_ONNX_MODEL", bert_path)
+    assert isinstance(tf_transport.transport_from_env("BERT", "bert_model", ""), tf_transport.OnnxTransport)
+    assert tf_transport.async_transport_from_env("BERT", "bert_model", "") is None
@@ -1,4 +1,8 @@
 
+import json
+import pytest
+
+from pdf_trio.pdf_classifier import PdfClassifier
 from pdf_trio.url_classifier import UrlClassifier
 
 
@@ -16,3 +20,41 @@ def test_url_classify():
     resp = u.classify_url("https://web.archive.org/web/20200102030405/http://fatcat.wiki/one.pdf")
     assert type(resp) == float
     assert resp != 0.5
+
+
+def test_url_classify_batch():
+    u = UrlClassifier()
+    urls = [
+        "https://arxiv.org/pdf/1607.01759.pdf",
+        "https://web.archive.org/web/20180511040716/https://ekja.org/upload/pdf/kjae-57-444.pdf",
+        "https://example.com/maps/foo.pdf",
+        "https://example.com/maps/bar.pdf",
+        "https://arxiv.org/pdf/1607.01759.pdf",
+    ]
+    expected = []
+    for url in urls:
+        label, confidence = u.fasttext_url_model.predict(u.gen_tokens(u.extract_url_tokens(u.remove_wayback_prefix(url))))
+        expected.append(PdfClassifier.encode_confidence(label[0], confidence[0]))
+    assert u.classify_urls(urls) == pytest.approx(expected)
+    # the model sees domain and path only, so foo and bar share a prediction
+    assert u.stats()["predictions"] == 3
+    assert u.classify_urls(urls[:2]) == pytest.approx(expected[:2])
+    assert u.stats()["predictions"] == 3
+    assert u.classify_urls([]) == []
+
+
+def test_url_classify_ndjson():
+    u = UrlClassifier()
+    lines = [
+        '"https://arxiv.org/pdf/1607.01759.pdf"\n',
+        '\n',
+        b'{"url": "https://example.com/maps/foo.pdf", "digest": "ABC"}\n',
+        'not json\n',
+        '{"no_url": 1}\n',
+    ]
+    out = [json.loads(line) for line in u.classify_ndjson(lines)]
+    assert len(out) == 4
+    assert out[0]["url"] == "https://arxiv.org/pdf/1607.01759.pdf"
+    assert out[0]["confidence"] == u.classify_url(out[0]["url"])
+    assert out[1]["digest"] == "ABC" and "confidence" in out[1]
+    assert "error" in out[2] and "error" in out[3]
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+
+from pdf_trio import text_prep, vocab_index
+
+
+def write_vocab(path, tokens):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(tokens) + "\n")
+
+
+def test_vocab_index_parity(tmp_path):
+    vocab_path = str(tmp_path / "vocab.txt")
+    write_vocab(vocab_path, ["[PAD]", "[UNK]", "the", "##s", "Über", "研究", "a" * 30, "the", "b", "", "ab", "rz", "sz"])
+    index = vocab_index.load_vocab_index(vocab_path)
+    vocab = text_prep.load_bert_vocab(vocab_path)
+    assert os.path.exists(vocab_path + ".index.npy")
+    assert len(index) == len(vocab)
+
+    tokens = ["the", "Über", "研究", "unknown", "a" * 30, "a" * 31, "", "b", "ab", "abc", "##s", "s", "rz", "sz"]
+    ids = index.lookup(tokens)
+    assert ids.dtype == np.int32
+    assert ids[3] == -1 and ids[5] == -1
+    assert ids[0] == 7  # the last id of a repeated token, like load_bert_vocab
+    assert index.lookup_ids(tokens).tolist() == text_prep.convert_to_bert_vocab(vocab, tokens)
+    assert index.lookup_ids([]).tolist() == []
+
+    # many tokens, so that some are not in their home slot
+    many = ["t%d" % j for j in range(20000)]
+    write_vocab(vocab_path, many)
+    index = vocab_index.VocabIndex(vocab_index.build_vocab_index(vocab_path))
+    query = many[::7] + ["x%d" % j for j in range(1000)]
+    assert index.lookup_ids(query).tolist() == list(range(0, 20000, 7))
+
+
+def test_vocab_index_rebuild(tmp_path):
+    vocab_path = str(tmp_path / "vocab.txt")
+    write_vocab(vocab_path, ["x", "y"])
+    assert vocab_index.load_vocab_index(vocab_path).lookup(["y"]).tolist() == [1]
+
+    # a newer vocab file replaces the index
+    write_vocab(vocab_path, ["y", "x", "z"])
+    later = os.path.getmtime(vocab_path) + 10
+    os.utime(vocab_path, (later, later))
+    assert vocab_index.load_vocab_index(vocab_path).lookup(["y", "z"]).tolist() == [0, 2]
+
+    # cannot write the index file
+    index = vocab_index.load_vocab_index(vocab_path, str(tmp_path / "missing" / "vocab.index.npy"))
+    assert index.lookup(["z"]).tolist() == [2]
+
+
+def test_token_hashes_any_string(tmp_path):
+    # one hash per token, whatever the token contains
+    tokens = ["a\nb", "", "b", "\n", "研究", ""]
+    hashes, lengths = vocab_index.token_hashes(tokens)
+    assert len(hashes) == len(tokens)
+    assert lengths.tolist() == [3, 0, 1, 1, 6, 0]
+    for token, h in zip(tokens, hashes.tolist()):
+        assert vocab_index.token_hashes([token])[0].tolist() == [h]
+
+    vocab_path = str(tmp_path / "vocab.txt")
+    write_vocab(vocab_path, ["a", "b", "c"])
+    index = vocab_index.load_vocab_index(vocab_path)
+    assert index.lookup(["a\nb", "c", ""]).tolist() == [-1, 2, -1]
+    assert index.lookup([""]).tolist() == [-1]
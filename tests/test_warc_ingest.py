@@ -0,0 +1,108 @@
+import io
+import json
+import pytest
+
+from pdf_trio import warc_ingest
+from pdf_trio.fake_tf_serving import FakeTfServing
+from pdf_trio.pdf_classifier import PdfClassifier
+from pdf_trio.url_classifier import UrlClassifier
+
+warcio = pytest.importorskip("warcio")
+
+RESEARCH_URL = "https://arxiv.org/pdf/1607.01759.pdf"
+OTHER_URL = "https://example.com/maps/foo.pdf"
+
+
+@pytest.fixture
+def warc_file(tmp_path):
+    from warcio.warcwriter import WARCWriter
+    from warcio.statusandheaders import StatusAndHeaders
+    with open('tests/files/research/submission_363.pdf', 'rb') as f:
+        pdf = f.read()
+    path = str(tmp_path / "crawl.warc.gz")
+    with open(path, 'wb') as out:
+        writer = WARCWriter(out, gzip=True)
+        for url, status, mime, body in [
+                (RESEARCH_URL, "200 OK", "application/pdf", pdf),
+                ("https://example.com/", "200 OK", "text/html", b"<html></html>"),
+                (OTHER_URL, "200 OK", "application/pdf; charset=binary", pdf),
+                ("https://arxiv.org/pdf/missing.pdf", "404 Not Found", "application/pdf", b"")]:
+            headers = StatusAndHeaders(status, [("Content-Type", mime)], protocol="HTTP/1.1")
+            writer.write_record(writer.create_warc_record(url, 'response', payload=io.BytesIO(body),
+                                                          http_headers=headers))
+    return path
+
+
+@pytest.fixture
+def fake_classifier(monkeypatch):
+    fake = FakeTfServing(scores=(0.1, 0.9))
+    base_url = fake.start_rest()
+    monkeypatch.setenv("TF_BERT_SERVER_URL", base_url)
+    monkeypatch.setenv("TF_IMAGE_SERVER_URL", base_url)
+    monkeypatch.setenv("RESULT_CACHE_SIZE", "0")
+    yield PdfClassifier()
+    fake.stop()
+
+
+def test_warc_pdf_records(warc_file):
+    records = list(warc_ingest.warc_pdf_records(warc_file))
+    assert [row["url"] for row, _, _ in records] == [RESEARCH_URL, OTHER_URL]
+    row, path, content = records[0]
+    assert path == warc_file
+    assert content.startswith(b"%PDF")
+    assert row["offset"] == 0 and row["length"] > len(content) / 2
+    assert len(row["timestamp"]) == 14 and row["mime"] == "application/pdf" and row["status"] == "200"
+    # the payload can be read again at the offset, like the CDX mode does
+    assert warc_ingest.read_warc_payload(warc_file, records[1][0]["offset"]) == content
+
+    prefilter = warc_ingest.UrlPrefilter(UrlClassifier(), threshold=0.5, uncertain=(0.15, 0.85))
+    records = list(warc_ingest.warc_pdf_records(warc_file, prefilter, done={("crawl.warc.gz", 0)}))
+    assert len(records) == 1
+    row, _, content = records[0]
+    assert row["skipped"] == "url_prior" and row["urlmeta"] < 0.15
+    assert content is None
+
+
+def test_url_prefilter(monkeypatch):
+    prefilter = warc_ingest.UrlPrefilter(None, threshold=0.9, uncertain=(0.3, 0.6))
+    assert [prefilter.wanted(c) for c in (0.95, 0.7, 0.5, 0.1)] == [True, False, True, False]
+    monkeypatch.setenv("WARC_URL_UNCERTAIN", "")
+    prefilter = warc_ingest.url_prefilter_from_env(url_classifier=prefilter.url_classifier)
+    assert prefilter.threshold == 0.5 and prefilter.uncertain is None
+    monkeypatch.setenv("WARC_URL_UNCERTAIN", "0.6,0.3")
+    with pytest.raises(ValueError):
+        warc_ingest.url_prefilter_from_env(url_classifier=prefilter.url_classifier)
+
+
+def test_warc_run_and_cdx(warc_file, tmp_path, fake_classifier):
+    prefilter = warc_ingest.UrlPrefilter(UrlClassifier(), threshold=0.5, uncertain=(0.15, 0.85))
+    output = str(tmp_path / "results.jsonl")
+    rows = warc_ingest.run(output, [warc_file], modes="all", prefilter=prefilter, processes=2, batch_size=1,
+                           classifier=fake_classifier)
+    by_url = dict((row["url"], row) for row in rows)
+    assert sorted(by_url) == sorted([RESEARCH_URL, OTHER_URL])
+    assert by_url[RESEARCH_URL]["bert"] == pytest.approx(PdfClassifier.encode_confidence("research", 0.9))
+    assert by_url[RESEARCH_URL]["urlmeta"] > 0.85
+    assert "bert" not in by_url[OTHER_URL]
+    assert warc_ingest.summary(rows) == {"pdfs": 2, "skipped": 1, "classified": 1, "errors": 0}
+
+    # a rerun has nothing left to do
+    assert len(warc_ingest.run(output, [warc_file], prefilter=prefilter, processes=1,
+                               classifier=fake_classifier)) == 2
+
+    # the same records from a CDX index, read at their offsets by the workers
+    cdx_path = str(tmp_path / "crawl.cdx")
+    with open(cdx_path, 'w') as f:
+        f.write(" CDX N b a m s k r M S V g\n")
+        for row in rows:
+            f.write("key %s %s %s %s %s - - %d %d %s\n" % (row["timestamp"], row["url"], row["mime"], row["status"],
+                                                          row["digest"], row["length"], row["offset"],
+                                                          row["filename"]))
+        f.write("key 20200101000000 https://example.com/ text/html 200 X - - 320 1 crawl.warc.gz\n")
+    cdx_output = str(tmp_path / "cdx_results.jsonl")
+    cdx_rows = warc_ingest.run(cdx_output, cdx_paths=[cdx_path], modes="all", prefilter=prefilter, processes=2,
+                               classifier=fake_classifier)
+    key_fields = ("url", "offset", "length", "filename", "digest", "skipped")
+    assert sorted(json.dumps([r.get(k) for k in key_fields]) for r in cdx_rows) == \
+        sorted(json.dumps([r.get(k) for k in key_fields]) for r in rows)
+    assert warc_ingest.summary(cdx_rows)["classified"] == 1